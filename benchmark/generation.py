@@ -0,0 +1,115 @@
+"""
+Benchmark of the simulator LLM backends.
+
+Runs concurrent simulated conversations with the generation arguments of the
+planning-based user simulator against each backend and reports the generated
+tokens per second and the latency percentiles of a turn.
+
+Run it from the repository root, e.g.:
+
+    PYTHONPATH=src python benchmark/generation.py --backend transformers --backend vllm
+"""
+
+import copy
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import click
+from transformers import AutoTokenizer
+
+import config
+from simulation.llm import create_llm, LLM_BACKENDS
+from simulation.user import PlanningBasedUserSimulator
+
+ASSISTANT_RESPONSE = (
+    "There are several aspects to consider. Recent studies compare the options "
+    "with respect to cost, availability, and long-term effects. Which of these "
+    "aspects are you most interested in?"
+)
+
+
+def conversation(llm, session_id: str, num_turns: int) -> List[Dict]:
+    system_prompt = PlanningBasedUserSimulator.base_prompt.format(
+        topic="renewable energy for a small household",
+        property_list="I live in a rented apartment.\n- I have a limited budget.",
+    )
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": "How can I help you?"},
+    ]
+
+    turns = []
+    for _ in range(num_turns):
+        start = time.perf_counter()
+        responses = llm.generate(
+            messages, session_id, **PlanningBasedUserSimulator.gen_kwargs
+        )
+        turns.append({"latency": time.perf_counter() - start, "outputs": responses})
+
+        messages.append({"role": "assistant", "content": responses[0]})
+        messages.append({"role": "user", "content": ASSISTANT_RESPONSE})
+
+    llm.release_session(session_id)
+    return turns
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+@click.command()
+@click.option(
+    "--backend",
+    "backends",
+    type=click.Choice(list(LLM_BACKENDS)),
+    multiple=True,
+    required=True,
+    help="Backends to compare. Other settings are taken from the configuration.",
+)
+@click.option("--sessions", type=int, default=16, help="Number of conversations.")
+@click.option("--concurrency", type=int, default=8, help="Concurrent conversations.")
+@click.option("--turns", type=int, default=4, help="Turns per conversation.")
+def main(backends: List[str], sessions: int, concurrency: int, turns: int):
+    conf = config.CONFIG["simulation"]["llm"]
+    # every session asks the same greedy questions, which would be answered from
+    # the cache instead of the backend
+    config.CONFIG["simulation"]["generation_cache"]["max_size"] = 0
+    tokenizer = AutoTokenizer.from_pretrained(conf["model"])
+
+    print(f"{'backend':<20} {'tokens/s':>10} {'p50 turn [s]':>13} {'p95 turn [s]':>13}")
+    for backend in backends:
+        backend_conf = copy.deepcopy(conf)
+        backend_conf["backend"] = backend
+        llm = create_llm(backend_conf)
+
+        # warm-up, e.g., for CUDA graphs and kernel compilation
+        conversation(llm, "warm-up", 1)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(
+                executor.map(
+                    lambda i: conversation(llm, f"session-{i}", turns), range(sessions)
+                )
+            )
+        duration = time.perf_counter() - start
+
+        latencies = [turn["latency"] for result in results for turn in result]
+        num_tokens = sum(
+            len(tokenizer.encode(output, add_special_tokens=False))
+            for result in results
+            for turn in result
+            for output in turn["outputs"]
+        )
+        print(
+            f"{backend:<20} {num_tokens / duration:>10.1f} "
+            f"{statistics.median(latencies):>13.2f} {percentile(latencies, 95):>13.2f}"
+        )
+        del llm
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Load benchmark that replays full simulated runs against the API.
+
+The app is set up with ``serve.setup_app`` for a shared task, the dummy task by
+default, and served by uvicorn on a local port. Concurrent teams start runs and
+respond until the last utterance of their run. The benchmark reports the
+throughput, latency percentiles per endpoint, Sqlite3 pool and lock waits, and
+the memory of the process, to catch overheads of authentication, budgets, and
+request tracking.
+
+Run it from the repository root, e.g.:
+
+    PYTHONPATH=src python benchmark/load.py --teams 16 --runs 2 --latency 0.05
+
+The simulators of other shared tasks can be benchmarked without a GPU on the
+fake model backend:
+
+    PYTHONPATH=src python benchmark/load.py --shared-task trec-ikat25 --fake-llm
+"""
+
+import asyncio
+import resource
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import click
+import httpx
+import uvicorn
+
+import config
+from security.authenticator import Authenticator
+from security.request_tracker import RequestTracker
+from serve import setup_app, setup_storage
+from shared_task.sessions import Session
+from shared_task.shared_task import SharedTaskManager
+from shared_task.warm_up import WarmUp
+from simulation.user import DummyUser, UserUtterance
+from storage.database import ConnectionPool
+
+
+class FakeLatencyUser(DummyUser):
+    """Dummy user that takes a fixed time per utterance, like a simulator would."""
+
+    def __init__(self, topics, latency: float):
+        super().__init__(topics)
+        self.latency = latency
+
+    def initiate(self, session: Session) -> UserUtterance:
+        time.sleep(self.latency)
+        return super().initiate(session)
+
+    def respond(self, session: Session) -> UserUtterance:
+        time.sleep(self.latency)
+        return super().respond(session)
+
+
+def setup_task(task_name: str, latency: float, fake_llm: bool):
+    # teams ask the same topics, so cached outputs would hide the model's latency
+    config.CONFIG["simulation"]["generation_cache"]["max_size"] = 0
+    if fake_llm:
+        config.CONFIG["simulation"]["llm"]["backend"] = "fake"
+        config.CONFIG["simulation"]["sentence_encoder"] = "fake"
+        config.CONFIG["simulation"]["embedding_cache_dir"] = None
+
+    task_manager = SharedTaskManager()
+    task_manager.set_active_task(task_name)
+    task = task_manager.active_task
+    task.initialize()
+
+    if latency > 0:
+        for users in [task.users_per_topic, task.debug_users_per_topic]:
+            for topic_id in users:
+                users[topic_id] = [FakeLatencyUser(task.topics, latency)]
+                task.users_by_id[users[topic_id][0].id] = users[topic_id][0]
+
+    # models are not loaded and openings not generated during the measurement
+    WarmUp().start(task, background=False)
+    setup_storage(task_name)
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def replay_run(
+    client: httpx.AsyncClient, token: str, latencies: Dict, errors: Dict
+):
+    headers = {"Authorization": f"Bearer {token}"}
+    run_id = f"_bench-{uuid.uuid4().hex}"
+
+    async def post(endpoint: str, payload: Dict) -> Dict:
+        while True:
+            start = time.perf_counter()
+            response = await client.post(endpoint, headers=headers, json=payload)
+            latency = time.perf_counter() - start
+            if response.status_code == 429:
+                # the simulators are saturated, retry soon to keep the load up
+                errors[f"{endpoint} 429"] += 1
+                await asyncio.sleep(0.05)
+                continue
+
+            latencies[endpoint].append(latency)
+            if response.status_code != 200:
+                errors[f"{endpoint} {response.status_code}"] += 1
+                return None
+            return response.json()
+
+    utterance = await post(
+        "/run/start",
+        {"run_id": run_id, "description": "Load benchmark", "extra": {"bench": True}},
+    )
+    while utterance is not None and not utterance["last_response_of_run"]:
+        utterance = await post(
+            "/run/continue",
+            {
+                "run_id": run_id,
+                "response": "This is a benchmark response.",
+                "citations": {"docA": 0.9, "docB": 0.5},
+                "meta": {"bench": True},
+            },
+        )
+
+
+async def replay(base_url: str, tokens: List[str], runs: int):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    limits = httpx.Limits(max_connections=len(tokens))
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=600
+    ) as client:
+
+        async def team(token: str):
+            for _ in range(runs):
+                await replay_run(client, token, latencies, errors)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[team(token) for token in tokens])
+        duration = time.perf_counter() - start
+
+    return latencies, errors, duration
+
+
+@click.command()
+@click.option(
+    "--shared-task",
+    type=click.Choice(SharedTaskManager().task_classes.keys()),
+    default="dummy",
+    help="Shared task whose users are simulated.",
+)
+@click.option(
+    "--fake-llm",
+    is_flag=True,
+    help="Run the simulators on the fake model and sentence encoder backends.",
+)
+@click.option("--teams", type=int, default=8, help="Number of concurrent teams.")
+@click.option("--runs", type=int, default=1, help="Runs per team.")
+@click.option(
+    "--latency",
+    type=float,
+    default=0.0,
+    help="Replace the users by dummy users that take this many seconds per utterance.",
+)
+@click.option("--port", type=int, default=8899, help="Port of the benchmarked app.")
+def main(
+    shared_task: str, fake_llm: bool, teams: int, runs: int, latency: float, port: int
+):
+    setup_task(shared_task, latency, fake_llm)
+    authenticator = Authenticator()
+    team_names = [f"_bench_team_{i}" for i in range(teams)]
+    tokens = []
+    for name in team_names:
+        authenticator.rm_team(name)
+        tokens.append(authenticator.add_team(name))
+
+    server = uvicorn.Server(
+        uvicorn.Config(setup_app(), host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    pool_before = ConnectionPool().stats()
+    latencies, errors, duration = asyncio.run(
+        replay(f"http://127.0.0.1:{port}", tokens, runs)
+    )
+    RequestTracker().flush()
+    pool_after = ConnectionPool().stats()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    num_requests = sum(len(values) for values in latencies.values())
+    print(
+        f"{num_requests} requests of {teams * runs} runs in {duration:.2f}s "
+        f"({num_requests / duration:.1f} requests/s)"
+    )
+    print(
+        f"{'endpoint':<16} {'count':>7} {'mean [ms]':>10} {'p50 [ms]':>10} "
+        f"{'p95 [ms]':>10} {'p99 [ms]':>10}"
+    )
+    for endpoint, values in sorted(latencies.items()):
+        print(
+            f"{endpoint:<16} {len(values):>7} "
+            f"{statistics.mean(values) * 1000:>10.1f} "
+            f"{percentile(values, 50) * 1000:>10.1f} "
+            f"{percentile(values, 95) * 1000:>10.1f} "
+            f"{percentile(values, 99) * 1000:>10.1f}"
+        )
+
+    stats = {k: pool_after[k] - pool_before[k] for k in pool_after}
+    print(
+        f"sqlite: {stats['transactions']} transactions in "
+        f"{stats['transaction_time']:.2f}s, {stats['acquire_waits']} pool waits of "
+        f"{stats['acquire_wait_time']:.2f}s, {stats['acquire_timeouts']} pool "
+        f"timeouts, {stats['lock_timeouts']} lock timeouts"
+    )
+    # ru_maxrss is reported in KiB on Linux
+    print(
+        f"memory: peak RSS {rss_after / 1024:.1f} MiB "
+        f"(+{(rss_after - rss_before) / 1024:.1f} MiB during the benchmark)"
+    )
+    for error, count in sorted(errors.items()):
+        print(f"error: {count}x {error}")
+
+    server.should_exit = True
+    thread.join()
+    for name in team_names:
+        authenticator.rm_team(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 CREATE TABLE IF NOT EXISTS teams(
     id    VARCHAR(256) NOT NULL PRIMARY KEY,
-    token   CHAR(32) NOT NULL UNIQUE
+    token   CHAR(32) NOT NULL UNIQUE,
+    token_digest    CHAR(64)
 );
 
+CREATE UNIQUE INDEX IF NOT EXISTS teams_token_digest ON teams(token_digest);
+
 CREATE TABLE IF NOT EXISTS admins(
     name        VARCHAR(256) NOT NULL PRIMARY KEY,
     password    CHAR(32) NOT NULL
@@ -16,8 +19,11 @@ CREATE TABLE IF NOT EXISTS runs(
     FOREIGN KEY (team_id) REFERENCES teams(id)
 );
 
+CREATE INDEX IF NOT EXISTS runs_team_id ON runs(team_id);
+
 CREATE TABLE IF NOT EXISTS requests(
-    timestamp       DATETIME NOT NULL PRIMARY KEY,
+    id              INTEGER PRIMARY KEY,
+    timestamp       DATETIME NOT NULL,
     run_id          VARCHAR(256) NOT NULL,
     team_id         VARCHAR(256) NOT NULL,
     session_id      CHAR(36) NOT NULL,
@@ -34,4 +40,47 @@ CREATE TABLE IF NOT EXISTS requests(
     count_towards_credits BOOLEAN DEFAULT true,
     FOREIGN KEY(run_id) REFERENCES runs(id),
     FOREIGN KEY (team_id) REFERENCES teams(id)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS requests_run_api_timestamp ON requests(run_id, api, timestamp);
+CREATE INDEX IF NOT EXISTS requests_team_api_credits_session ON requests(team_id, api, count_towards_credits, session_id);
+CREATE INDEX IF NOT EXISTS requests_run_topic ON requests(run_id, topic_id);
+
+CREATE TABLE IF NOT EXISTS budgets(
+    team_id     VARCHAR(256) NOT NULL,
+    api         VARCHAR(10) NOT NULL,
+    sessions    INTEGER NOT NULL DEFAULT 0,
+    runs        INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (team_id, api)
+);
+
+CREATE TABLE IF NOT EXISTS active_runs(
+    api         VARCHAR(10) NOT NULL,
+    run_id      VARCHAR(256) NOT NULL,
+    team_id     VARCHAR(256) NOT NULL,
+    description TEXT NOT NULL,
+    extra       TEXT,
+    open_topics TEXT NOT NULL,
+    version     INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (api, run_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sessions(
+    id          CHAR(36) NOT NULL PRIMARY KEY,
+    api         VARCHAR(10) NOT NULL,
+    run_id      VARCHAR(256) NOT NULL,
+    team_id     VARCHAR(256) NOT NULL,
+    user_id     CHAR(36) NOT NULL,
+    topic_id    VARCHAR(20) NOT NULL,
+    version     INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (api, run_id)
+);
+
+CREATE TABLE IF NOT EXISTS session_entries(
+    session_id  CHAR(36) NOT NULL,
+    kind        VARCHAR(16) NOT NULL,
+    position    INTEGER NOT NULL,
+    content     TEXT NOT NULL,
+    PRIMARY KEY (session_id, kind, position),
+    FOREIGN KEY(session_id) REFERENCES sessions(id)
+) WITHOUT ROWID;
@@ -8,7 +8,6 @@ from starlette.responses import JSONResponse
 from config import CONFIG
 from security.authenticator import authenticate, Authenticator
 from security.budget_tracker import BudgetTracker, check_budget
-from shared_task.participant_run import RunManager
 
 router = APIRouter(
     prefix="/budget",
@@ -26,7 +25,6 @@ def check(teamname: Annotated[str, Depends(authenticate)]):
     for api in apis:
         try:
             remaining = check_budget(
-                RunManager(debug=api == "debug"),
                 teamname,
                 api,
                 CONFIG["api"][api]["limits"]["value"],
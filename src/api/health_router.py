@@ -0,0 +1,22 @@
+from fastapi import APIRouter
+from starlette import status
+from starlette.responses import JSONResponse
+
+from config import CONFIG
+from shared_task.warm_up import WarmUp
+
+router = APIRouter(
+    prefix="/health",
+)
+
+
+@router.get("/ready", **CONFIG["api"]["health"]["docs"]["ready"])
+def ready():
+    """Reports whether the user simulators are loaded and how far loading is."""
+    warm_up = WarmUp()
+    return JSONResponse(
+        warm_up.status(),
+        status_code=(
+            status.HTTP_200_OK if warm_up.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
@@ -1,12 +1,24 @@
+from functools import lru_cache
 from typing import Dict, Any
 
-import spacy
 from pydantic import StrictStr, field_validator
 from pydantic.dataclasses import dataclass
 
 # typedef for the citation field to make annotations more concise
 CitationType = dict[StrictStr, float] | None
 
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    """
+    Returns the tokenizer that counts the tokens of responses. spaCy is imported
+    on first use because importing it takes seconds.
+    """
+    import spacy
+
+    return spacy.blank("en")
+
+
 # Pydantic dataclasses for the API endpoints
 
 
@@ -27,12 +39,10 @@ class AssistantResponseMessage:
     # ptkb provenance listing may or may not be provided
     # ptkb_provenance: list[StrictStr] | None = None
 
-    _nlp = spacy.blank("en")
-
     @field_validator("response", mode="before")
     @classmethod
     def check_response(cls, value: StrictStr) -> StrictStr:
-        doc = cls._nlp(value)
+        doc = get_tokenizer()(value)
         if len(doc) <= 250:
             return value
 
@@ -0,0 +1,159 @@
+import sys
+import time
+
+from fastapi import APIRouter
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+from config import CONFIG
+from security.authenticator import token_cache
+from security.request_tracker import RequestTracker
+from simulation.inference import InferenceService
+from simulation.user import PlanningBasedUserSimulator, UnrestrictedUserSimulator
+
+router = APIRouter()
+
+INFERENCE_PENDING = metrics.Gauge(
+    "sim_api_inference_pending",
+    "Simulator calls that are queued or running on the inference workers.",
+)
+REQUEST_QUEUE = metrics.Gauge(
+    "sim_api_request_queue",
+    "Tracked requests that wait to be written to the database.",
+)
+BATCH_QUEUE = metrics.Gauge(
+    "sim_api_batch_queue",
+    "Generation calls that wait to be batched.",
+    ["model"],
+)
+GPU_MEMORY = metrics.Gauge(
+    "sim_api_gpu_memory_bytes",
+    "Memory of the GPUs that is allocated or reserved by tensors.",
+    ["device", "kind"],
+)
+CACHE_HITS = metrics.Counter(
+    "sim_api_cache_hits", "Lookups that were answered by a cache.", ["cache"]
+)
+CACHE_MISSES = metrics.Counter(
+    "sim_api_cache_misses", "Lookups that missed a cache.", ["cache"]
+)
+CACHE_MEMORY = metrics.Gauge(
+    "sim_api_cache_memory_bytes", "Memory of the cached keys and values.", ["cache"]
+)
+
+
+class MetricsMiddleware:
+    """
+    Labels every request with its API, run or debug, and measures how long
+    serving it takes.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.apis = {
+            CONFIG["api"]["run"]["name"]: "run",
+            CONFIG["api"]["debug"]["name"]: "debug",
+        }
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        api = self.apis.get(scope["path"].strip("/").split("/")[0], "")
+        token = metrics.API.set(api)
+        status_code = 500
+
+        async def send_status(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                api=api,
+                # unknown paths would make the number of label values unbounded
+                endpoint=scope["path"] if status_code != 404 else "unmatched",
+                status=str(status_code),
+            )
+            metrics.API.reset(token)
+
+
+def collect():
+    """
+    Update the gauges and totals that are read from other components on each
+    scrape.
+
+    :return: None
+    """
+    INFERENCE_PENDING.set(InferenceService().pending)
+    REQUEST_QUEUE.set(RequestTracker().queue_size())
+
+    stats = token_cache.stats()
+    CACHE_HITS.set_total(stats["hits"], cache="token")
+    CACHE_MISSES.set_total(stats["misses"], cache="token")
+
+    # the simulators share their model, which is None until it is loaded
+    llms = {
+        id(llm): llm
+        for llm in [PlanningBasedUserSimulator.llm, UnrestrictedUserSimulator.llm]
+        if llm is not None
+    }
+    for llm in llms.values():
+        generation_cache = getattr(llm, "cache", None)
+        if generation_cache is not None:
+            stats = generation_cache.stats()
+            CACHE_HITS.set_total(
+                stats["memory_hits"] + stats["disk_hits"], cache="generation"
+            )
+            CACHE_MISSES.set_total(stats["misses"], cache="generation")
+
+        if hasattr(llm, "queue_size"):
+            BATCH_QUEUE.set(llm.queue_size(), model=str(llm))
+
+        prefix_cache = getattr(llm, "prefix_cache", None)
+        if prefix_cache is not None:
+            for name, cache in [
+                ("prefix", prefix_cache),
+                ("shared_prefix", prefix_cache.shared),
+            ]:
+                if cache is not None:
+                    CACHE_HITS.set_total(cache.hits, cache=name)
+                    CACHE_MISSES.set_total(cache.misses, cache=name)
+                    CACHE_MEMORY.set(cache.memory, cache=name)
+
+    # only report the GPUs if the models were loaded
+    torch = sys.modules.get("torch", None)
+    if torch is not None and torch.cuda.is_available():
+        for device in range(torch.cuda.device_count()):
+            GPU_MEMORY.set(
+                torch.cuda.memory_allocated(device),
+                device=str(device),
+                kind="allocated",
+            )
+            GPU_MEMORY.set(
+                torch.cuda.memory_reserved(device), device=str(device), kind="reserved"
+            )
+
+
+@router.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    **CONFIG["api"]["metrics"]["docs"]["metrics"],
+)
+def get_metrics():
+    """
+    Reports latencies per stage, queue depths, and cache hit rates for Prometheus.
+    Each worker process keeps its own metrics, so with several workers a scrape
+    reports the worker that serves it.
+    """
+    collect()
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -7,22 +7,41 @@ import datetime
 import json
 import logging
 from logging import Logger
-from typing import Annotated, Tuple, Optional
+from typing import (
+    Annotated,
+    Tuple,
+    Optional,
+    Iterable,
+    Iterator,
+    Dict,
+    Any,
+    Callable,
+)
 
 from fastapi import APIRouter, Depends, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasicCredentials
 from starlette import status
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
+import metrics
 from api.auth_router import admin_auth
 from api.messages import UserUtteranceMessage, RunMetaMessage, AssistantResponseMessage
 from config import CONFIG
 from security.authenticator import authenticate
-from security.budget_tracker import check_budget
-from security.request_tracker import RequestTracker
-from shared_task.participant_run import RunManager
-from shared_task.sessions import SessionManager
+from security.budget_tracker import BudgetTracker, check_budget
+from security.request_tracker import RequestTracker, UnwrittenRequestsError
+from shared_task.participant_run import OpeningPrefetch, ParticipantRun, RunManager
+from shared_task.sessions import SessionManager, Session
 from shared_task.shared_task import SharedTaskManager
+from shared_task.state import StateConflictError
+from simulation.inference import (
+    InferenceService,
+    InferenceInProgressError,
+    InferenceQueueFullError,
+    InferenceTimeoutError,
+)
+from simulation.user import User, UserUtterance
 
 run_router = APIRouter(
     prefix=f"/{CONFIG['api']['run']['name']}",
@@ -48,7 +67,7 @@ debug_router = APIRouter(
     response_model=UserUtteranceMessage,
     **CONFIG["api"]["debug"]["docs"]["start"],
 )
-def start(
+async def start(
     request: Request,
     team_id: Annotated[str, Depends(authenticate)],
     run_meta: RunMetaMessage,
@@ -62,50 +81,22 @@ def start(
     :return: :class:`UserUtteranceMessage` object containing a user utterance.
     """
     debug_mode, logger = check_debug_mode(request)
-    api = "run"
-    if debug_mode:
-        api = "debug"
 
-    run_manager = RunManager(debug=debug_mode)
-    check_budget(
-        run_manager,
-        team_id,
-        CONFIG["api"][api]["name"],
-        CONFIG["api"][api]["limits"]["value"],
-        CONFIG["api"][api]["limits"]["unit"],
+    session = await run_in_threadpool(
+        prepare_run, team_id, run_meta, debug_mode, logger
     )
 
-    check_request(
-        team_id,
-        run_meta.run_id,
-        run_meta,
-        run_manager,
-        run_must_exists=False,
-        debug_mode=debug_mode,
-    )
-
-    run_meta.team_id = team_id
-
-    run = run_manager.create_run(run_meta)
-    logger.debug('Team "%s" starts run "%s".', team_id, run_meta.run_id)
-    task_manager = SharedTaskManager()
-    active_task = task_manager.active_task
-    assert active_task is not None
-
-    try:
-        session = active_task.init_session(run, debug_mode)
-    except AssertionError as e:
-        raise HTTPException(
-            status_code=status.HTTP_412_PRECONDITION_FAILED,
-            detail=f'Active run with the name "{run_meta.run_id}" already exists '
-            f"or a run with that name was already completed before.",
-        ) from e
-
-    assert session is not None
-
+    active_task = SharedTaskManager().active_task
     user = active_task.users_by_id[session.user_id]
-    utterance = user.initiate(session)
+    metrics.SIMULATOR.set(type(user).__name__)
+    try:
+        utterance = await simulate(user.initiate, session)
+    except Exception:
+        # allow the participant to start the run again, e.g., after Retry-After
+        await run_in_threadpool(abort_run, run_meta, debug_mode)
+        raise
     active_task.update_session(session, utterance=utterance)
+    await run_in_threadpool(save_session, session)
 
     return UserUtteranceMessage(
         datetime.datetime.now().isoformat(),
@@ -129,7 +120,7 @@ def start(
     response_model=UserUtteranceMessage,
     **CONFIG["api"]["debug"]["docs"]["continue"],
 )
-def continue_conversation(
+async def continue_conversation(
     request: Request,
     team_id: Annotated[str, Depends(authenticate)],
     assistant: AssistantResponseMessage,
@@ -144,79 +135,25 @@ def continue_conversation(
     :return: :class:`UserUtteranceMessage` object containing a user utterance.
     """
     debug_mode, logger = check_debug_mode(request)
-    api = "run"
-    if debug_mode:
-        api = "debug"
 
-    run_manager = RunManager(debug=debug_mode)
-    try:
-        if debug_mode:
-            check_budget(
-                run_manager,
-                team_id,
-                CONFIG["api"][api]["name"],
-                CONFIG["api"][api]["limits"]["value"],
-                CONFIG["api"][api]["limits"]["unit"],
-            )
-    except HTTPException as e:
-        # prevent running out of budget during last topic of the last allowed run/session
-        check_request(
-            team_id,
-            assistant.run_id,
-            None,
-            run_manager,
-            run_must_exists=True,
-            debug_mode=debug_mode,
-        )
-
-        session_manager = SessionManager()
-        session = session_manager.get_session(team_id, assistant.run_id)
-
-        if session is None:
-            raise e
-
-    check_request(
-        team_id,
-        assistant.run_id,
-        None,
-        run_manager,
-        run_must_exists=True,
-        debug_mode=debug_mode,
+    run, session = await run_in_threadpool(
+        prepare_turn, team_id, assistant, debug_mode, logger
     )
 
-    run = run_manager.get_active_run(assistant.run_id)
-
-    session_manager = SessionManager()
-    session = session_manager.get_session(team_id, assistant.run_id)
-
-    task_manager = SharedTaskManager()
-    active_task = task_manager.active_task
-
-    if session is None:
-        # session of prior topic ended
-        session = active_task.init_session(run, debug_mode)
-        if session is None:
-            # no new topics
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f'No more open topics for run "{run.run_meta.run_id}". Run was finished!',
-            )
-
-        logger.debug(
-            'Team "%s" starts new session on topic "%s".', team_id, session.topic_id
-        )
-    else:
-        logger.debug(
-            'Team "%s" continues session on topic "%s".', team_id, session.topic_id
-        )
-
+    active_task = SharedTaskManager().active_task
     user = active_task.users_by_id[session.user_id]
+    metrics.SIMULATOR.set(type(user).__name__)
 
     if len(session.history) == 0:
-        utterance = user.initiate(session)
+        utterance = await initiate(run, session, user, logger)
     else:
         active_task.update_session(session, response=assistant)
-        utterance = user.respond(session)
+        try:
+            utterance = await simulate(user.respond, session)
+        except Exception:
+            # allow the participant to resubmit the response
+            active_task.revert_response(session)
+            raise
 
     active_task.update_session(session, utterance=utterance)
     if len(session.history) >= 2:
@@ -225,37 +162,11 @@ def continue_conversation(
             and session.history[-2]["role"] == "assistant"
         )
 
-    if not len(session.history) == 1:
-        RequestTracker().register_request(
-            run.run_meta.run_id,
-            team_id,
-            session.id,
-            session.topic_id,
-            session.user_id,
-            api,
-            session.history[-3]["content"],
-            assistant.response,
-            assistant.citations,
-            session.user_meta[-2] if len(session.user_meta) > 1 else {},
-            assistant.meta,
-        )
-
-    if utterance.end_of_session:
-        session_manager.terminate_session(run.run_meta)
-
-        RequestTracker().register_request(
-            run.run_meta.run_id,
-            team_id,
-            session.id,
-            session.topic_id,
-            session.user_id,
-            api,
-            utterance.content,
-            None,
-            {},
-            utterance.meta,
-            {},
-        )
+    await run_in_threadpool(
+        track_turn, run, session, team_id, assistant, utterance, debug_mode
+    )
+    if utterance.end_of_session and run.has_next_topic():
+        prefetch_opening(run, debug_mode)
 
     return UserUtteranceMessage(
         datetime.datetime.now().isoformat(),
@@ -296,7 +207,7 @@ def get_session(
     run = run_manager.get_active_run(run_id)
 
     session_manager = SessionManager()
-    session = session_manager.get_session(team_id, run_id)
+    session = session_manager.get_session(team_id, run_id, debug_mode)
 
     return UserUtteranceMessage(
         datetime.datetime.now().isoformat(),
@@ -326,6 +237,7 @@ def run_status(_: Annotated[str, Depends(authenticate)], run_id: str):
     :return: JSONResponse object of the current status of the run.
     """
     run_manager = RunManager()
+    flush_requests()
 
     if not run_manager.run_exists(run_id):
         raise HTTPException(
@@ -345,24 +257,28 @@ def run_dump(team_id: Annotated[str, Depends(authenticate)], run_id: str) -> Res
     :return: TREC-style run file in line-delimited JSON format.
     """
     run_manager = RunManager()
+    flush_requests()
     if not run_manager.run_exists(run_id, team_id):
         raise HTTPException(
             status.HTTP_404_NOT_FOUND, detail=f'Run "{run_id}" does not exist.'
         )
 
-    response = "\n".join([json.dumps(s) for s in run_manager.dump(run_id)])
-    return Response(
-        response, status_code=status.HTTP_200_OK, media_type="application/x-ndjson"
+    return StreamingResponse(
+        to_ndjson(run_manager.dump(run_id)),
+        status_code=status.HTTP_200_OK,
+        media_type="application/x-ndjson",
     )
 
 
 @run_router.get("/dump-all", **CONFIG["api"]["run"]["docs"]["dump-all"])
 def run_dump_all(_: Annotated[HTTPBasicCredentials, Depends(admin_auth)]):
     run_manager = RunManager()
+    flush_requests()
 
-    response = "\n".join([json.dumps(s) for s in run_manager.dump_all()])
-    return Response(
-        response, status_code=status.HTTP_200_OK, media_type="application/x-ndjson"
+    return StreamingResponse(
+        to_ndjson(run_manager.dump_all()),
+        status_code=status.HTTP_200_OK,
+        media_type="application/x-ndjson",
     )
 
 
@@ -371,6 +287,396 @@ def run_dump_all(_: Annotated[HTTPBasicCredentials, Depends(admin_auth)]):
 # ===============
 
 
+def prepare_run(
+    team_id: str, run_meta: RunMetaMessage, debug_mode: bool, logger: Logger
+) -> Session:
+    """
+    Validates and registers a new run and initializes the session on its first topic.
+
+    :param team_id: ID of the team as a result of the authentication.
+    :param run_meta: Metadata object about the run to be registerred.
+    :param debug_mode: A flag indicating whether debug mode is enabled.
+    :param logger: Logger of the API.
+    :return: Session on the first topic of the run.
+    :raises HTTPException: If the run cannot be registered.
+    """
+    api = "run"
+    if debug_mode:
+        api = "debug"
+
+    run_manager = RunManager(debug=debug_mode)
+    check_budget(
+        team_id,
+        CONFIG["api"][api]["name"],
+        CONFIG["api"][api]["limits"]["value"],
+        CONFIG["api"][api]["limits"]["unit"],
+    )
+
+    check_request(
+        team_id,
+        run_meta.run_id,
+        run_meta,
+        run_manager,
+        run_must_exists=False,
+        debug_mode=debug_mode,
+    )
+
+    run_meta.team_id = team_id
+
+    try:
+        run = run_manager.create_run(run_meta)
+    except StateConflictError as e:
+        # counted towards the budget by the concurrent request only
+        raise run_conflict() from e
+    BudgetTracker().register_run(team_id, api)
+    logger.debug('Team "%s" starts run "%s".', team_id, run_meta.run_id)
+    task_manager = SharedTaskManager()
+    active_task = task_manager.active_task
+    assert active_task is not None
+
+    try:
+        session = active_task.init_session(run, debug_mode)
+        run_manager.save_run(run)
+    except AssertionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f'Active run with the name "{run_meta.run_id}" already exists '
+            f"or a run with that name was already completed before.",
+        ) from e
+
+    assert session is not None
+    return session
+
+
+def abort_run(run_meta: RunMetaMessage, debug_mode: bool):
+    """
+    Removes a run whose first utterance could not be produced, together with its
+    session and the run it counted towards the budget.
+
+    :param run_meta: Metadata object of the run.
+    :param debug_mode: A flag indicating whether debug mode is enabled.
+    :return: None
+    """
+    api = "run"
+    if debug_mode:
+        api = "debug"
+
+    SessionManager().terminate_session(run_meta, debug_mode)
+    RunManager(debug=debug_mode).remove_run(run_meta.run_id)
+    BudgetTracker().unregister_run(run_meta.team_id, api)
+
+
+def prepare_turn(
+    team_id: str,
+    assistant: AssistantResponseMessage,
+    debug_mode: bool,
+    logger: Logger,
+) -> Tuple[ParticipantRun, Session]:
+    """
+    Validates a submitted response and returns the session to continue.
+    Starts a session on the next topic if the session of the prior topic ended.
+
+    :param team_id: ID of the team as a result of the authentication.
+    :param assistant: :class:`AssistantResponseMessage` object containing a system response.
+    :param debug_mode: A flag indicating whether debug mode is enabled.
+    :param logger: Logger of the API.
+    :return: Tuple of the run and the session to continue.
+    :raises HTTPException: If the request is invalid or the run is finished.
+    """
+    api = "run"
+    if debug_mode:
+        api = "debug"
+
+    run_manager = RunManager(debug=debug_mode)
+    try:
+        if debug_mode:
+            check_budget(
+                team_id,
+                CONFIG["api"][api]["name"],
+                CONFIG["api"][api]["limits"]["value"],
+                CONFIG["api"][api]["limits"]["unit"],
+            )
+    except HTTPException as e:
+        # prevent running out of budget during last topic of the last allowed run/session
+        check_request(
+            team_id,
+            assistant.run_id,
+            None,
+            run_manager,
+            run_must_exists=True,
+            debug_mode=debug_mode,
+        )
+
+        session_manager = SessionManager()
+        session = session_manager.get_session(team_id, assistant.run_id, debug_mode)
+
+        if session is None:
+            raise e
+
+    check_request(
+        team_id,
+        assistant.run_id,
+        None,
+        run_manager,
+        run_must_exists=True,
+        debug_mode=debug_mode,
+    )
+
+    run = run_manager.get_active_run(assistant.run_id)
+
+    session_manager = SessionManager()
+    session = session_manager.get_session(team_id, assistant.run_id, debug_mode)
+
+    task_manager = SharedTaskManager()
+    active_task = task_manager.active_task
+
+    if session is None:
+        # session of prior topic ended
+        try:
+            session = active_task.init_session(run, debug_mode)
+            if session is None:
+                # no new topics
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f'No more open topics for run "{run.run_meta.run_id}". Run was finished!',
+                )
+            run_manager.save_run(run)
+        except StateConflictError as e:
+            raise run_conflict() from e
+
+        logger.debug(
+            'Team "%s" starts new session on topic "%s".', team_id, session.topic_id
+        )
+    else:
+        logger.debug(
+            'Team "%s" continues session on topic "%s".', team_id, session.topic_id
+        )
+
+    return run, session
+
+
+def track_turn(
+    run: ParticipantRun,
+    session: Session,
+    team_id: str,
+    assistant: AssistantResponseMessage,
+    utterance: UserUtterance,
+    debug_mode: bool,
+):
+    """
+    Records the requests of a completed turn and terminates the session if the
+    user ended it. Otherwise, the session is saved in the state backend.
+
+    :param run: The run of the turn.
+    :param session: The session of the turn.
+    :param team_id: ID of the team as a result of the authentication.
+    :param assistant: :class:`AssistantResponseMessage` object containing a system response.
+    :param utterance: The user utterance that answers the system response.
+    :param debug_mode: A flag indicating whether debug mode is enabled.
+    :return: None
+    """
+    api = "run"
+    if debug_mode:
+        api = "debug"
+
+    if not utterance.end_of_session:
+        save_session(session)
+
+    if not len(session.history) == 1:
+        if len(session.history) == 3:
+            # first tracked request of this session
+            BudgetTracker().register_session(team_id, api)
+
+        RequestTracker().register_request(
+            run.run_meta.run_id,
+            team_id,
+            session.id,
+            session.topic_id,
+            session.user_id,
+            api,
+            session.history[-3]["content"],
+            assistant.response,
+            assistant.citations,
+            session.user_meta[-2] if len(session.user_meta) > 1 else {},
+            assistant.meta,
+        )
+
+    if utterance.end_of_session:
+        SessionManager().terminate_session(run.run_meta, debug_mode)
+
+        RequestTracker().register_request(
+            run.run_meta.run_id,
+            team_id,
+            session.id,
+            session.topic_id,
+            session.user_id,
+            api,
+            utterance.content,
+            None,
+            {},
+            utterance.meta,
+            {},
+        )
+
+
+def flush_requests():
+    """
+    Writes all tracked requests before the requests table is read.
+
+    :return: None
+    :raises HTTPException: If some requests could not be written yet.
+    """
+    try:
+        RequestTracker().flush()
+    except UnwrittenRequestsError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Recent requests are not stored yet. Please retry later.",
+            headers={"Retry-After": "1"},
+        ) from e
+
+
+def run_conflict() -> HTTPException:
+    """
+    Returns the response to a request that lost a race for a run, e.g., to start
+    the run or a session on its next topic, against a request of another worker.
+
+    :return: Exception of the response.
+    """
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="The run was changed by a concurrent request.",
+    )
+
+
+def save_session(session: Session):
+    """
+    Stores the changes of a session in the state backend.
+
+    :param session: The session to save.
+    :return: None
+    :raises HTTPException: If a concurrent request changed the session.
+    """
+    try:
+        SessionManager().save_session(session)
+    except StateConflictError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The session was changed by a concurrent request of the run.",
+        ) from e
+
+
+async def simulate(
+    generate: Callable[[Session], UserUtterance], session: Session
+) -> UserUtterance:
+    """
+    Produces the next user utterance on the inference workers. The simulator gets
+    a snapshot of the session, since a call that timed out keeps running while
+    the request reverts the session.
+
+    :param generate: Method of the user simulator that produces the utterance.
+    :param session: The session to produce an utterance for.
+    :return: The produced user utterance.
+    :raises HTTPException: If the user simulator is overloaded, too slow, or
+        still busy with an earlier request of the session.
+    """
+    try:
+        return await InferenceService().run(
+            generate, session.snapshot(), key=session.id
+        )
+    except InferenceInProgressError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The user simulator is still busy with an earlier request of "
+            "the session. Please retry later.",
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
+    except InferenceQueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="The user simulator is busy. Please retry later.",
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
+    except InferenceTimeoutError as e:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="The user simulator did not respond in time. Please retry later.",
+        ) from e
+
+
+async def initiate(
+    run: ParticipantRun, session: Session, user: User, logger: Logger
+) -> UserUtterance:
+    """
+    Produces the first user utterance of a new session, which was usually
+    prefetched when the session on the prior topic ended.
+
+    :param run: The run of the session.
+    :param session: The new session.
+    :param user: The user simulator of the session.
+    :param logger: Logger of the API.
+    :return: The first user utterance.
+    :raises HTTPException: If the user simulator is overloaded or too slow.
+    """
+    prefetch = run.prefetch
+    run.prefetch = None
+    if prefetch is not None and prefetch.session_id == session.id:
+        try:
+            return await InferenceService().wait(prefetch.future)
+        except InferenceTimeoutError as e:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="The user simulator did not respond in time. Please retry later.",
+            ) from e
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Prefetching the first utterance failed.")
+
+    return await simulate(user.initiate, session)
+
+
+def prefetch_opening(run: ParticipantRun, debug_mode: bool):
+    """
+    Draws the user of the session on the next topic of a run and starts
+    generating its first utterance in the background, if a simulator worker is
+    idle. The next request of the run then usually finds the utterance ready.
+
+    Prefetching is skipped if the state is shared with other worker processes,
+    since the next request of the run may be served by another process.
+
+    :param run: The run whose session ended.
+    :param debug_mode: A flag indicating whether debug mode is enabled.
+    :return: None
+    """
+    if (
+        not CONFIG["simulation"]["inference"]["prefetch"]
+        or RunManager(debug=debug_mode).state.shared
+    ):
+        return
+
+    active_task = SharedTaskManager().active_task
+    topic_id = run.peek_topic().id
+    user = active_task.choose_user(topic_id, debug_mode)
+    session = Session(run.run_meta.team_id, user.id, topic_id)
+    token = metrics.SIMULATOR.set(type(user).__name__)
+    try:
+        future = InferenceService().prefetch(user.initiate, session)
+    finally:
+        metrics.SIMULATOR.reset(token)
+    if future is not None:
+        run.prefetch = OpeningPrefetch(topic_id, user.id, session.id, future)
+
+
+def to_ndjson(records: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """
+    Serializes records lazily to line-delimited JSON.
+
+    :param records: Iterable of JSON-serializable records.
+    :return: Iterator over the lines of the serialized records.
+    """
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
 def check_debug_mode(request: Request) -> Tuple[bool, Logger]:
     """
     Parses from the request url whether the request was submitted
@@ -392,6 +698,7 @@ def check_debug_mode(request: Request) -> Tuple[bool, Logger]:
     return debug_mode, logger
 
 
+@metrics.stage("check_request")
 def check_request(
     team_id: str,
     run_id: str,
@@ -416,11 +723,16 @@ def check_request(
 
     if run_must_exists:
         if run is None:
+            # recovery reads the progress of the run from the requests table
+            flush_requests()
             if (
                 run_manager.run_exists(run_id, team_id)
                 and run_manager.get_status(run_id)["status"] != "complete"
             ):
-                run = run_manager.recover_run(run_id)
+                try:
+                    run = run_manager.recover_run(run_id)
+                except StateConflictError as e:
+                    raise run_conflict() from e
             else:
                 raise HTTPException(
                     status_code=status.HTTP_428_PRECONDITION_REQUIRED,
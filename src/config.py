@@ -13,6 +13,9 @@ CONFIG_PATH = "config/api-conf.yml"
 DATABASE_DIR = "database"
 SCHEMA_PATH = "data/db-schema.sql"
 
+# number of worker processes of the API, set by serve for its workers
+WORKERS_ENV = "SIM_API_WORKERS"
+
 with open(CONFIG_PATH, "r", encoding="utf-8") as project_file:
     CONFIG = yaml.load(project_file, Loader=yaml.SafeLoader)
 
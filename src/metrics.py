@@ -0,0 +1,238 @@
+"""
+Module for lightweight metrics of the API, which are exposed in the Prometheus
+text format at /metrics.
+
+The API (run or debug) and the simulator class of a request are kept in context
+variables, so that stages measured deep inside a request, e.g., in a user
+simulator on an inference worker, are labeled without passing them around.
+"""
+
+import abc
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# labels of the request that is being served
+API: ContextVar[str] = ContextVar("api", default="")
+SIMULATOR: ContextVar[str] = ContextVar("simulator", default="")
+
+# seconds, from cache lookups to full beam search generations
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0, 300.0,
+)  # fmt: skip
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric(metaclass=abc.ABCMeta):
+    """
+    Base class of metrics with a fixed set of label names. Every metric is
+    registered in the ``REGISTRY`` on creation.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} has the labels {self.labelnames}, got {tuple(labels)}."
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """
+        Returns the samples of the metric.
+
+        :return: Iterator of sample names, labels, and values.
+        """
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing total per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set_total(self, value: float, **labels: str):
+        """
+        Set the total of a label set that another component counts, e.g., the
+        hits of a cache, on scrapes.
+
+        :param value: Total since the component was created.
+        :param labels: Labels of the total.
+        :return: None
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}_total", dict(zip(self.labelnames, key)), value
+
+
+class Gauge(Metric):
+    """Current value per label set, e.g., a queue depth that is set on scrapes."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets per label set."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (counts per bucket and +Inf, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe the seconds that the context takes.
+
+        :param labels: Labels of the observation.
+        :return: Context manager.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = {k: (list(v[0]), v[1]) for k, v in self._values.items()}
+
+        for key, (counts, total) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {
+                    **labels,
+                    "le": _format_value(bound),
+                }, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """
+    Returns all registered metrics in the Prometheus text format.
+
+    :return: Text of the metrics.
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "sim_api_request_seconds",
+    "Seconds to serve a request.",
+    ["api", "endpoint", "status"],
+)
+STAGE_SECONDS = Histogram(
+    "sim_api_stage_seconds",
+    "Seconds spent in a stage of serving a request.",
+    ["stage", "api", "simulator"],
+)
+GENERATED_TOKENS = Counter(
+    "sim_api_generated_tokens",
+    "Tokens generated by the simulator model.",
+    ["model"],
+)
+
+
+@contextmanager
+def stage(name: str, simulator: Optional[str] = None) -> Iterator[None]:
+    """
+    Measure a stage of the request that is being served. The stage is labeled
+    with the API and simulator class of the request.
+
+    :param name: Name of the stage.
+    :param simulator: Simulator class, defaults to the one of the request.
+    :return: Context manager.
+    """
+    with STAGE_SECONDS.time(
+        stage=name, api=API.get(), simulator=simulator or SIMULATOR.get()
+    ):
+        yield
@@ -1,73 +1,162 @@
 import base64
 import binascii
-import os
-import sqlite3
+import hashlib
+import time
+from collections import OrderedDict
 from secrets import token_hex
-from typing import Annotated
+from threading import Lock
+from typing import Annotated, Optional, Tuple
 
 from fastapi import Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2AuthorizationCodeBearer
 from passlib.context import CryptContext
 from starlette import status
 
-from config import DATABASE_DIR
-from shared_task.shared_task import SharedTaskManager
+import metrics
+from config import CONFIG
+from security.request_tracker import RequestTracker
+from storage.database import ConnectionPool
+
+
+class TokenCache:
+    """
+    Bounded LRU cache that maps digests of team tokens, whose bcrypt hash was
+    verified, to team ids for a limited time.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        # token digest -> (team id, expiry time)
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, team_id: str):
+        with self._lock:
+            self._entries[key] = (team_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, team_id: Optional[str] = None):
+        """
+        Drop cached tokens of the given team or all cached tokens if no team is given.
+
+        :param team_id: ID of the team whose tokens are revoked.
+        :return: None
+        """
+        with self._lock:
+            if team_id is None:
+                self._entries.clear()
+                return
+
+            for key in [k for k, v in self._entries.items() if v[0] == team_id]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+token_cache = TokenCache(
+    CONFIG["security"]["token_cache"]["max_size"],
+    CONFIG["security"]["token_cache"]["ttl"],
+)
+# digests of tokens that match no team, so that invalid tokens skip the bcrypt
+# scan of teams without a digest
+rejected_tokens = TokenCache(
+    CONFIG["security"]["token_cache"]["max_size"],
+    CONFIG["security"]["token_cache"]["ttl"],
+)
 
 
 class Authenticator:
+    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # at most one scan of the teams without a digest runs at a time
+    _legacy_lock = Lock()
 
     def __init__(self):
-        db_path = os.path.join(
-            DATABASE_DIR, f"{SharedTaskManager().active_task.name}.db"
-        )
-        self.db_connection = sqlite3.connect(db_path, check_same_thread=False)
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        self.pool = ConnectionPool()
 
     def add_team(self, _id: str):
-        cursor = self.db_connection.execute("SELECT * FROM teams WHERE id = ?;", (_id,))
-        res = cursor.fetchone()
+        token = token_hex(16)
+        with self.pool.connection() as conn:
+            cursor = conn.execute("SELECT * FROM teams WHERE id = ?;", (_id,))
+            res = cursor.fetchone()
 
-        if res is not None:
-            raise RuntimeError(f"Team {_id} already exists")
+            if res is not None:
+                raise RuntimeError(f"Team {_id} already exists")
 
-        token = token_hex(16)
-        _ = self.db_connection.execute(
-            "INSERT INTO teams (id, token) VALUES (?, ?)",
-            (_id, self.pwd_context.hash(token)),
-        )
-        self.db_connection.commit()
+            _ = conn.execute(
+                "INSERT INTO teams (id, token, token_digest) VALUES (?, ?, ?)",
+                (_id, self.pwd_context.hash(token), self.token_digest(token)),
+            )
+        token_cache.invalidate(_id)
 
         return base64.b64encode(token.encode()).decode()
 
     def rm_team(self, _id: str):
-        _ = self.db_connection.execute(
-            "DELETE FROM requests WHERE team_id = ?;", (_id,)
-        )
+        RequestTracker().flush()
+        with self.pool.connection() as conn:
+            _ = conn.execute("DELETE FROM requests WHERE team_id = ?;", (_id,))
+
+            _ = conn.execute("DELETE FROM runs WHERE team_id = ?;", (_id,))
+
+            _ = conn.execute(
+                "DELETE FROM session_entries WHERE session_id IN "
+                "(SELECT id FROM sessions WHERE team_id = ?);",
+                (_id,),
+            )
+            _ = conn.execute("DELETE FROM sessions WHERE team_id = ?;", (_id,))
+
+            _ = conn.execute("DELETE FROM active_runs WHERE team_id = ?;", (_id,))
 
-        _ = self.db_connection.execute("DELETE FROM runs WHERE team_id = ?;", (_id,))
+            _ = conn.execute("DELETE FROM budgets WHERE team_id = ?;", (_id,))
 
-        _ = self.db_connection.execute("DELETE FROM teams WHERE id = ?;", (_id,))
+            _ = conn.execute("DELETE FROM teams WHERE id = ?;", (_id,))
 
-        self.db_connection.commit()
+        token_cache.invalidate(_id)
 
     def add_admin(self, name: str, password: str):
-        _ = self.db_connection.execute(
-            "INSERT OR IGNORE INTO admins VALUES (?, ?);",
-            (name, self.pwd_context.hash(password)),
-        )
-        self.db_connection.commit()
+        with self.pool.connection() as conn:
+            _ = conn.execute(
+                "INSERT OR IGNORE INTO admins VALUES (?, ?);",
+                (name, self.pwd_context.hash(password)),
+            )
 
     def rm_admin(self, name: str):
-        _ = self.db_connection.execute("DELETE FROM admins WHERE name = ?;", (name,))
-        self.db_connection.commit()
+        with self.pool.connection() as conn:
+            _ = conn.execute("DELETE FROM admins WHERE name = ?;", (name,))
 
     def authenticate_admin(self, name: str, password: str):
-        cursor = self.db_connection.execute(
-            "SELECT password FROM admins WHERE name = ?;",
-            (name,),
-        )
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT password FROM admins WHERE name = ?;",
+                (name,),
+            )
+            result = cursor.fetchone()
 
-        result = cursor.fetchone()
         if result is None:
             return False
 
@@ -79,16 +168,68 @@ class Authenticator:
         except (binascii.Error, UnicodeDecodeError) as exc:
             raise RuntimeError("Token is not base64 encoded.") from exc
 
-        cursor = self.db_connection.execute(
-            "SELECT id, token FROM teams;",
-        )
-        res = cursor.fetchall()
+        digest = self.token_digest(decoded_token)
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT id, token FROM teams WHERE token_digest = ?;", (digest,)
+            )
+            res = cursor.fetchone()
+
+        if res is None:
+            return self._authenticate_legacy_team(decoded_token)
+
+        # the team is looked up on every request, so that teams removed by another
+        # process are rejected right away, only the slow bcrypt check is cached
+        if token_cache.get(digest) == res[0]:
+            return res[0]
+
+        if not self.pwd_context.verify(decoded_token, res[1]):
+            return None
+
+        token_cache.put(digest, res[0])
+        return res[0]
 
-        for tup in res:
-            if self.pwd_context.verify(decoded_token, tup[1]):
-                return tup[0]
+    def _authenticate_legacy_team(self, decoded_token: str):
+        """
+        Fallback for teams registered before token digests were stored. Matching
+        teams get their digest backfilled so that the next lookup is indexed.
+        Tokens that match no team are rejected without a scan for a while.
+        """
+        digest = self.token_digest(decoded_token)
+        if rejected_tokens.get(digest) is not None:
+            return None
 
-        return None
+        with self._legacy_lock:
+            # another request may have scanned for the same token meanwhile
+            if rejected_tokens.get(digest) is not None:
+                return None
+
+            with self.pool.connection() as conn:
+                cursor = conn.execute(
+                    "SELECT id, token FROM teams WHERE token_digest IS NULL;",
+                )
+                res = cursor.fetchall()
+
+            for tup in res:
+                if self.pwd_context.verify(decoded_token, tup[1]):
+                    with self.pool.connection() as conn:
+                        _ = conn.execute(
+                            "UPDATE teams SET token_digest = ? WHERE id = ?;",
+                            (digest, tup[0]),
+                        )
+                    return tup[0]
+
+            # new teams always get a digest, so the token stays invalid
+            rejected_tokens.put(digest, "")
+            return None
+
+    @staticmethod
+    def token_digest(token: str) -> str:
+        """
+        Fast digest of a team token used as indexed lookup key. Tokens are random
+        128-bit values, so an unsalted SHA-256 does not make them guessable.
+        """
+        return hashlib.sha256(token.encode()).hexdigest()
 
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
@@ -97,17 +238,19 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
 
 
 async def authenticate(token: Annotated[str, Depends(oauth2_scheme)]):
-    authenticator = Authenticator()
-    try:
-        team_id = authenticator.authenticate_team(token)
-    except RuntimeError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
-        ) from e
-
-    if team_id is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid."
-        )
-
-    return team_id
+    with metrics.stage("authenticate"):
+        authenticator = Authenticator()
+        try:
+            # bcrypt verification is slow and must not block the event loop
+            team_id = await run_in_threadpool(authenticator.authenticate_team, token)
+        except RuntimeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
+            ) from e
+
+        if team_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="Token is invalid."
+            )
+
+        return team_id
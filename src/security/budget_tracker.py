@@ -1,57 +1,154 @@
-import os
 import sqlite3
+from typing import Tuple
 
 from fastapi import HTTPException
 from starlette import status
 from typing_extensions import Literal
 
-from config import DATABASE_DIR
-from shared_task.participant_run import RunManager
-from shared_task.shared_task import SharedTaskManager
+import metrics
+from security.request_tracker import RequestTracker
+from storage.database import ConnectionPool
 
 
 class BudgetTracker:
+    """
+    Keeps track of the number of sessions and runs that count towards the budget
+    of a team. The counters are materialized in the budgets table and updated
+    whenever a session or run is registered, so checking the budget does not
+    depend on the number of past requests of a team.
+    """
 
     def __init__(self):
-        db_path = os.path.join(
-            DATABASE_DIR, f"{SharedTaskManager().active_task.name}.db"
-        )
-        self.db_connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.pool = ConnectionPool()
 
     def get_number_of_sessions(self, team_id: str, api: Literal["debug", "run"]):
-        cursor = self.db_connection.execute(
+        return self.get_usage(team_id, api)[0]
+
+    def get_number_of_runs(self, team_id: str, api: Literal["debug", "run"]):
+        return self.get_usage(team_id, api)[1]
+
+    def get_usage(self, team_id: str, api: Literal["debug", "run"]) -> Tuple[int, int]:
+        """
+        Returns the number of sessions and runs that count towards the budget.
+
+        :param team_id: ID of a team.
+        :param api: API for which the budget is tracked.
+        :return: Tuple of the number of sessions and the number of runs.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT sessions, runs FROM budgets WHERE team_id=? AND api=?;",
+                (team_id, api),
+            )
+            res = cursor.fetchone()
+
+        if res is None:
+            return self.recompute(team_id, api)
+
+        return res[0], res[1]
+
+    def register_session(self, team_id: str, api: Literal["debug", "run"]):
+        self._increment(team_id, api, "sessions")
+
+    def register_run(self, team_id: str, api: Literal["debug", "run"]):
+        self._increment(team_id, api, "runs")
+
+    def unregister_run(self, team_id: str, api: Literal["debug", "run"]):
+        self._increment(team_id, api, "runs", -1)
+
+    def _increment(
+        self,
+        team_id: str,
+        api: Literal["debug", "run"],
+        column: Literal["sessions", "runs"],
+        amount: int = 1,
+    ):
+        # initialize counters of teams without row from their request history first
+        self.get_usage(team_id, api)
+        with self.pool.connection() as conn:
+            _ = conn.execute(
+                f"UPDATE budgets SET {column} = {column} + ? WHERE team_id=? AND api=?;",
+                (amount, team_id, api),
+            )
+
+    def recompute(self, team_id: str, api: Literal["debug", "run"]) -> Tuple[int, int]:
+        """
+        Recompute the budget counters of a team from its requests and runs.
+
+        :param team_id: ID of a team.
+        :param api: API for which the budget is tracked.
+        :return: Tuple of the number of sessions and the number of runs.
+        """
+        RequestTracker().flush()
+        with self.pool.connection() as conn:
+            num_sessions = self._count_sessions(conn, team_id, api)
+            num_runs = self._count_runs(conn, team_id, api)
+            _ = conn.execute(
+                "INSERT OR REPLACE INTO budgets(team_id, api, sessions, runs) "
+                "VALUES (?,?,?,?);",
+                (team_id, api, num_sessions, num_runs),
+            )
+
+        return num_sessions, num_runs
+
+    @staticmethod
+    def _count_sessions(conn: sqlite3.Connection, team_id: str, api: str) -> int:
+        cursor = conn.execute(
             "SELECT COUNT(DISTINCT session_id) FROM requests WHERE requests.team_id=? AND api=? AND requests.count_towards_credits=true;",
             (team_id, api),
         )
         return cursor.fetchone()[0]
 
+    @staticmethod
+    def _count_runs(conn: sqlite3.Connection, team_id: str, api: str) -> int:
+        if api == "run":
+            cursor = conn.execute(
+                """
+                SELECT COUNT(*)
+                FROM runs
+                WHERE runs.team_id=?
+                    AND
+                    NOT EXISTS(
+                        SELECT *
+                        FROM requests
+                        WHERE requests.run_id = runs.id
+                            AND requests.api='run'
+                            AND requests.count_towards_credits=false
+                    );""",
+                (team_id,),
+            )
+        else:
+            # debug runs are not stored in the runs table
+            cursor = conn.execute(
+                "SELECT COUNT(DISTINCT run_id) FROM requests WHERE requests.team_id=? AND api=? AND requests.count_towards_credits=true;",
+                (team_id, api),
+            )
+        return cursor.fetchone()[0]
+
     def reset_credits(self, team_id: str, api: Literal["debug", "run"]):
-        _ = self.db_connection.execute(
-            """
-            UPDATE requests 
-            SET count_towards_credits = false 
-            WHERE api=? 
-                AND 
-                EXISTS(
-                    SELECT * 
-                    FROM runs 
-                    WHERE runs.id = requests.run_id 
-                        AND runs.team_id=?
-                );""",
-            (api, team_id),
-        )
-        self.db_connection.commit()
+        RequestTracker().flush()
+        with self.pool.connection() as conn:
+            _ = conn.execute(
+                """
+                UPDATE requests
+                SET count_towards_credits = false
+                WHERE api=?
+                    AND
+                    requests.team_id=?;""",
+                (api, team_id),
+            )
+        self.recompute(team_id, api)
 
 
+@metrics.stage("check_budget")
 def check_budget(
-    run_manager: RunManager,
     team_id: str,
     api: Literal["debug", "run"],
     limit: int,
     unit: Literal["sessions", "runs"] = "sessions",
 ):
+    budget_tracker = BudgetTracker()
     if unit == "sessions":
-        budget_tracker = BudgetTracker()
         number_of_requests = budget_tracker.get_number_of_sessions(team_id, api)
 
         if number_of_requests >= limit:
@@ -63,15 +160,7 @@ def check_budget(
         return max(0, limit - number_of_requests)
 
     if unit == "runs":
-        run_ids = run_manager.get_runs(team_id)
-
-        num_runs = len(run_ids)
-        completed_runs = 0
-        for run_id in run_ids:
-            run_status = run_manager.get_status(run_id)
-
-            if run_status["status"] == "complete":
-                completed_runs += 1
+        num_runs = budget_tracker.get_number_of_runs(team_id, api)
 
         if num_runs >= limit:
             raise HTTPException(
@@ -1,21 +1,63 @@
+import atexit
 import datetime
 import json
+import logging
 import os
-import sqlite3
-from typing import Literal, Optional, Dict, Any
+import queue
+import time
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Literal, Dict, Any, List, Tuple
 
-from config import DATABASE_DIR
-from shared_task.shared_task import SharedTaskManager
+import metrics
+from config import CONFIG, WORKERS_ENV
+from storage.database import ConnectionPool
+
+INSERT_REQUEST = """
+    INSERT INTO requests(
+        timestamp, run_id, team_id, session_id, topic_id, user_id,
+        api, user_utterance, user_meta, assistant_response, assistant_meta, assistant_citations)
+    VALUES
+        (?,?,?,?,?,?,?,?,?,?,?,?);
+    """
+
+_STOP = object()
+
+
+class UnwrittenRequestsError(RuntimeError):
+    """Raised by a flush while requests wait for a retry of their write."""
 
 
 class RequestTracker:
+    """
+    Records requests in the database. Rows are queued and written by a background
+    thread that groups them into a single transaction per batch, so the request
+    path does not wait for the disk. Call :meth:`flush` before reading the requests
+    table to see all rows registered so far. Rows whose write failed stay queued
+    and are retried with a growing delay.
 
-    def __init__(self):
-        db_path = os.path.join(
-            DATABASE_DIR, f"{SharedTaskManager().active_task.name}.db"
-        )
-        self.db_connection = sqlite3.connect(db_path, check_same_thread=False)
+    If the API runs with several worker processes, a flush cannot reach the
+    queues of the other workers, so requests are written synchronously instead.
+    """
+
+    _instance = None
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with RequestTracker._lock:
+            if cls._instance is None:
+                cls._instance = super(RequestTracker, cls).__new__(cls, *args, **kwargs)
+                cls._instance.logger = logging.getLogger(cls.__name__)
+                cls._instance.pool = ConnectionPool()
+                cls._instance._queue = queue.Queue()
+                cls._instance._writer = None
+                cls._instance._num_unwritten = 0
+                cls._instance.synchronous = int(os.environ.get(WORKERS_ENV, "1")) > 1
+                atexit.register(cls._instance.close)
+
+            return cls._instance
 
+    @metrics.stage("register_request")
     def register_request(
         self,
         run_id: str,
@@ -32,27 +74,176 @@ class RequestTracker:
     ) -> None:
         timestamp = datetime.datetime.now().isoformat()
 
-        _ = self.db_connection.execute(
-            """
-            INSERT INTO requests(
-                timestamp, run_id, team_id, session_id, topic_id, user_id,
-                api, user_utterance, user_meta, assistant_response, assistant_meta, assistant_citations)
-            VALUES 
-                (?,?,?,?,?,?,?,?,?,?,?,?);
-            """,
-            (
-                timestamp,
-                run_id,
-                team_id,
-                session_id,
-                topic_id,
-                user_id,
-                api,
-                user_utterance,
-                json.dumps(user_meta),
-                response,
-                json.dumps(assistant_meta),
-                json.dumps(citations),
-            ),
+        row = (
+            timestamp,
+            run_id,
+            team_id,
+            session_id,
+            topic_id,
+            user_id,
+            api,
+            user_utterance,
+            json.dumps(user_meta),
+            response,
+            json.dumps(assistant_meta),
+            json.dumps(citations),
         )
-        self.db_connection.commit()
+        if self.synchronous:
+            # failures reach the request, like before requests were queued
+            self._insert([row])
+        else:
+            self._enqueue(row)
+
+    def queue_size(self) -> int:
+        """
+        Returns the number of requests that are not written yet.
+
+        :return: Approximate size of the write queue, including failed rows.
+        """
+        return self._queue.qsize() + self._num_unwritten
+
+    def flush(self) -> None:
+        """
+        Block until all requests registered so far are committed to the database.
+
+        :return: None
+        :raises UnwrittenRequestsError: If writing some requests failed, they are
+            retried later.
+        """
+        done = Future()
+        with RequestTracker._lock:
+            if self._writer is None:
+                return
+            # queued under the lock, so that it precedes the stop signal of a close
+            self._queue.put(done)
+        done.result()
+
+    def close(self) -> None:
+        """
+        Write all pending requests and stop the background writer.
+
+        :return: None
+        """
+        with RequestTracker._lock:
+            writer = self._writer
+            if writer is None:
+                return
+
+            # a writer started later gets a queue of its own, so that only this
+            # writer sees the stop signal
+            self._queue.put(_STOP)
+            self._queue = queue.Queue()
+            self._writer = None
+
+        writer.join()
+
+    def _enqueue(self, row: Tuple):
+        # queued under the lock, so that rows are never put behind the stop
+        # signal of a writer that is closing
+        with RequestTracker._lock:
+            if self._writer is None:
+                self._writer = Thread(
+                    target=self._write_loop,
+                    args=(self._queue,),
+                    name="request-writer",
+                    daemon=True,
+                )
+                self._writer.start()
+            self._queue.put(row)
+
+    def _write_loop(self, requests: queue.Queue):
+        conf = CONFIG["storage"]["write_behind"]
+        # rows whose write failed, they are written before newer rows
+        unwritten: List[Tuple] = []
+        retry_delay = 0.0
+        while True:
+            rows: List[Tuple] = []
+            waiters: List[Future] = []
+            stop = False
+
+            try:
+                item = requests.get(timeout=retry_delay if unwritten else None)
+            except queue.Empty:
+                item = None
+            deadline = time.monotonic() + conf["max_wait"] / 1000
+            while item is not None:
+                if item is _STOP:
+                    stop = True
+                    break
+                if isinstance(item, Future):
+                    waiters.append(item)
+                    break
+
+                rows.append(item)
+                if len(rows) >= conf["batch_size"]:
+                    break
+
+                try:
+                    item = requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            unwritten = self._write(unwritten + rows)
+            self._num_unwritten = len(unwritten)
+            if len(unwritten) > 0:
+                retry_delay = min(
+                    max(2 * retry_delay, conf["min_retry_delay"] / 1000),
+                    conf["max_retry_delay"] / 1000,
+                )
+            else:
+                retry_delay = 0.0
+
+            for waiter in waiters:
+                if len(unwritten) > 0:
+                    waiter.set_exception(
+                        UnwrittenRequestsError(
+                            f"{len(unwritten)} requests are not written yet."
+                        )
+                    )
+                else:
+                    waiter.set_result(None)
+
+            if stop:
+                if len(unwritten) > 0:
+                    self.logger.error(
+                        "Dropped %d requests that could not be written: %s",
+                        len(unwritten),
+                        unwritten,
+                    )
+                return
+
+    def _insert(self, rows: List[Tuple]):
+        with metrics.stage("track_commit", simulator=""):
+            with self.pool.connection() as conn:
+                _ = conn.executemany(INSERT_REQUEST, rows)
+
+    def _write(self, rows: List[Tuple]) -> List[Tuple]:
+        """
+        Write rows in one transaction, or one by one if the transaction fails.
+
+        :param rows: Rows of the requests table.
+        :return: Rows that could not be written.
+        """
+        if len(rows) == 0:
+            return []
+
+        try:
+            self._insert(rows)
+            return []
+        except Exception:  # pylint: disable=broad-except
+            self.logger.exception(
+                "Failed to write batch of %d requests. Retrying one by one.", len(rows)
+            )
+
+        failed = []
+        for row in rows:
+            try:
+                self._insert([row])
+            except Exception:  # pylint: disable=broad-except
+                failed.append(row)
+
+        if len(failed) > 0:
+            self.logger.error(
+                "Failed to write %d requests. Keeping them for a retry.", len(failed)
+            )
+        return failed
@@ -4,17 +4,42 @@ Main module to execute Sim.API.
 
 import logging
 import os.path
-import sqlite3
+from contextlib import asynccontextmanager
 
 import click
 import uvicorn
 from fastapi import FastAPI
+from starlette.middleware.gzip import GZipMiddleware
 from starlette.responses import RedirectResponse
 
-from api import auth_router, budget_router, run_router
-from config import CONFIG, DATABASE_DIR, SCHEMA_PATH
+from api import auth_router, budget_router, health_router, metrics_router, run_router
+from api.metrics_router import MetricsMiddleware
+from config import CONFIG, DATABASE_DIR, SCHEMA_PATH, WORKERS_ENV
 from shared_task.shared_task import SharedTaskManager
+from shared_task.warm_up import WarmUp
 from security.authenticator import Authenticator
+from security.request_tracker import RequestTracker
+from simulation.inference import InferenceService
+from storage.database import ConnectionPool
+from storage.migrations import SCHEMA_VERSION, migrate
+
+# configuration of the worker processes, which are started by uvicorn
+SHARED_TASK_ENV = "SIM_API_SHARED_TASK"
+FAST_START_ENV = "SIM_API_FAST_START"
+LOG_FORMAT = "%(asctime)s - %(name)-20s - %(levelname)-7s - %(message)s"
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """
+    Release resources of the app on shutdown.
+
+    :return: None
+    """
+    yield
+    InferenceService().shutdown()
+    RequestTracker().close()
+    ConnectionPool().close()
 
 
 def setup_app() -> FastAPI:
@@ -24,16 +49,21 @@ def setup_app() -> FastAPI:
     :return: FastAPI app.
     """
     app = FastAPI(
+        lifespan=lifespan,
         version=CONFIG["api"]["version"],
         title=CONFIG["api"]["title"],
         description=CONFIG["api"]["description"],
         root_path=CONFIG["api"]["root_path"],
         contact=CONFIG["api"]["contact"],
     )
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+    app.add_middleware(MetricsMiddleware)
     app.include_router(auth_router.router)
     app.include_router(run_router.debug_router)
     app.include_router(run_router.run_router)
     app.include_router(budget_router.router)
+    app.include_router(health_router.router)
+    app.include_router(metrics_router.router)
 
     @app.get("/", include_in_schema=False, response_class=RedirectResponse)
     def root():
@@ -52,9 +82,44 @@ def setup_storage(shared_task: str):
     os.makedirs(DATABASE_DIR, exist_ok=True)
     with open(SCHEMA_PATH, "r", encoding="utf-8") as in_file:
         db_path = os.path.join(DATABASE_DIR, f"{shared_task}.db")
-        with sqlite3.connect(db_path) as conn:
-            _ = conn.executescript(in_file.read())
-            conn.commit()
+        with ConnectionPool(db_path).connection() as conn:
+            num_migrations = migrate(conn, in_file.read())
+
+    if num_migrations > 0:
+        logging.getLogger("main").info(
+            "Upgraded database schema to version %d", SCHEMA_VERSION
+        )
+
+
+def setup_task(shared_task: str, fast_start: bool):
+    """
+    Activate and initialize a shared task and start loading its user simulators.
+
+    :param shared_task: Name of the configured shared task.
+    :param fast_start: Whether to skip the warm-up of the user simulators.
+    :return: None
+    """
+    task_manager = SharedTaskManager()
+    task_manager.set_active_task(shared_task)
+    task_manager.active_task.initialize()
+
+    # the port is opened while the models load, see /health/ready
+    if fast_start:
+        WarmUp().skip()
+    else:
+        WarmUp().start(task_manager.active_task)
+
+
+def create_worker_app() -> FastAPI:
+    """
+    Create the app of a worker process if Sim.API runs with several workers.
+    The workers share the state of runs and sessions through the database.
+
+    :return: FastAPI app.
+    """
+    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
+    setup_task(os.environ[SHARED_TASK_ENV], os.environ[FAST_START_ENV] == "1")
+    return setup_app()
 
 
 @click.command()
@@ -74,37 +139,67 @@ def setup_storage(shared_task: str):
 )
 @click.option(
     "--shared-task",
-    type=click.Choice(SharedTaskManager().shared_tasks.keys()),
+    type=click.Choice(SharedTaskManager().task_classes.keys()),
     default="dummy",
     required=True,
     help="Select one of the preconfigured shared tasks.",
 )
-def main(admin_name: str, admin_password: str, shared_task: str):
+@click.option(
+    "--fast-start",
+    is_flag=True,
+    default=False,
+    help="Skip the warm-up and load user simulators on first use.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes. Requires the sqlite state backend and the "
+    "openai-compatible model backend.",
+)
+def main(
+    admin_name: str,
+    admin_password: str,
+    shared_task: str,
+    fast_start: bool,
+    workers: int,
+):
     """
     Main function to set up and execute Sim.API.
 
     :param admin_name: Username for the admin account.
     :param admin_password: Password for the admin account.
     :param shared_task: Name of the configured shared task.
+    :param fast_start: Whether to skip the warm-up of the user simulators.
+    :param workers: Number of worker processes.
     :return: None
     """
-    format_string = "%(asctime)s - %(name)-20s - %(levelname)-7s - %(message)s"
     log_config = uvicorn.config.LOGGING_CONFIG
-    log_config["formatters"]["access"]["fmt"] = format_string
-    log_config["formatters"]["default"]["fmt"] = format_string
+    log_config["formatters"]["access"]["fmt"] = LOG_FORMAT
+    log_config["formatters"]["default"]["fmt"] = LOG_FORMAT
 
-    logging.basicConfig(level=logging.DEBUG, format=format_string)
+    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
     logger = logging.getLogger("main")
 
+    if workers > 1 and CONFIG["storage"]["state"] != "sqlite":
+        raise click.BadParameter(
+            "Several workers require the sqlite state backend.", param_hint="--workers"
+        )
+    # every worker loads its own user simulators, so the model has to run in a
+    # dedicated inference server that all workers share
+    if workers > 1 and CONFIG["simulation"]["llm"]["backend"] != "openai-compatible":
+        raise click.BadParameter(
+            "Several workers require the openai-compatible model backend.",
+            param_hint="--workers",
+        )
+
     if admin_name == "":
         admin_name = None
     if admin_password == "":
         admin_password = None
 
     setup_storage(shared_task)
-    task_manager = SharedTaskManager()
-    task_manager.set_active_task(shared_task)
-    task_manager.active_task.initialize()
+    SharedTaskManager().set_active_task(shared_task)
 
     if admin_name is not None and admin_password is not None:
         authenticator = Authenticator()
@@ -113,10 +208,24 @@ def main(admin_name: str, admin_password: str, shared_task: str):
     else:
         logger.warning("No admin credentials provided")
 
-    app = setup_app()
+    if workers > 1:
+        os.environ[SHARED_TASK_ENV] = shared_task
+        os.environ[FAST_START_ENV] = "1" if fast_start else "0"
+        os.environ[WORKERS_ENV] = str(workers)
+        app = "serve:create_worker_app"
+    else:
+        setup_task(shared_task, fast_start)
+        app = setup_app()
+
     try:
         uvicorn.run(
-            app, host="0.0.0.0", port=8888, log_config=log_config, log_level="debug"
+            app,
+            factory=workers > 1,
+            workers=workers,
+            host="0.0.0.0",
+            port=8888,
+            log_config=log_config,
+            log_level="debug",
         )
     except KeyboardInterrupt:
         pass
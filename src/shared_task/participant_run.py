@@ -1,16 +1,33 @@
 import copy
 import json
-import os
-import sqlite3
+from concurrent.futures import Future
 from dataclasses import dataclass, field
 from threading import RLock
-from typing import Dict, Optional, OrderedDict, Any, List
+from typing import TYPE_CHECKING, Dict, Optional, OrderedDict, Any, List, Iterator
 
 from api.messages import RunMetaMessage
-from config import DATABASE_DIR
-from shared_task.sessions import Session
+from config import CONFIG
+from shared_task.sessions import Session, SessionManager
 from shared_task.topic import Topic
 from shared_task.shared_task import SharedTaskManager
+from storage.database import ConnectionPool
+
+if TYPE_CHECKING:
+    from shared_task.state import StateBackend
+
+
+@dataclass
+class OpeningPrefetch:
+    """
+    First utterance of the session on the next topic of a run that is generated
+    in the background while the participant works on the previous response.
+    """
+
+    topic_id: str
+    user_id: str
+    session_id: str
+    # future of the UserUtterance
+    future: Future
 
 
 @dataclass
@@ -22,10 +39,17 @@ class ParticipantRun:
     _open_topics: OrderedDict[str, Topic] = field(
         default_factory=lambda: copy.deepcopy(SharedTaskManager().active_task.topics)
     )
+    # kept in memory only, a lost prefetch is generated again
+    prefetch: Optional[OpeningPrefetch] = field(default=None, compare=False)
+    # version of the run in the state backend, None if it was not stored yet
+    version: Optional[int] = field(default=None, compare=False)
 
     def next_topic(self) -> Topic:
         return self._open_topics.popitem(last=False)[1]
 
+    def peek_topic(self) -> Topic:
+        return next(iter(self._open_topics.values()))
+
     def has_next_topic(self) -> bool:
         return len(self._open_topics) > 0
 
@@ -40,6 +64,12 @@ class ParticipantRun:
 
 
 class RunManager:
+    """
+    Keeps the active runs of the run or the debug API. Runs are stored in the
+    state backend and, unless the state is shared with other processes, also
+    kept in memory.
+    """
+
     _instance = None
     _debug_instance = None
     _lock = RLock()
@@ -52,36 +82,59 @@ class RunManager:
                         cls, *args, **kwargs
                     )
                     cls._debug_instance.runs = {}
-                    db_path = os.path.join(
-                        DATABASE_DIR, f"{SharedTaskManager().active_task.name}.db"
-                    )
-                    cls._debug_instance.db_connection = sqlite3.connect(
-                        db_path, check_same_thread=False
-                    )
+                    cls._debug_instance.api = "debug"
+                    cls._debug_instance.pool = ConnectionPool()
                 instance = cls._debug_instance
             else:
                 if cls._instance is None:
                     cls._instance = super(RunManager, cls).__new__(cls, *args, **kwargs)
                     cls._instance.runs = {}
-                    db_path = os.path.join(
-                        DATABASE_DIR, f"{SharedTaskManager().active_task.name}.db"
-                    )
-                    cls._instance.db_connection = sqlite3.connect(
-                        db_path, check_same_thread=False
-                    )
+                    cls._instance.api = "run"
+                    cls._instance.pool = ConnectionPool()
                 instance = cls._instance
 
             return instance
 
+    @property
+    def state(self) -> "StateBackend":
+        # imported here since the state backend depends on this module
+        from shared_task.state import get_state_backend
+
+        return get_state_backend()
+
     def get_active_run(self, run_id: str) -> ParticipantRun | None:
-        with RunManager._lock:
-            return self.runs.get(run_id, None)
+        """
+        Returns an active run, which is loaded from the state backend if it is
+        not in memory, e.g., after a restart.
+
+        :param run_id: ID of the run.
+        :return: The run or None if there is no active run with this ID.
+        """
+        if not self.state.shared:
+            with RunManager._lock:
+                run = self.runs.get(run_id, None)
+            if run is not None:
+                return run
+
+        run = self.state.get_run(self.api, run_id)
+        if run is not None and not self.state.shared:
+            with RunManager._lock:
+                run = self.runs.setdefault(run_id, run)
+        return run
+
+    def save_run(self, run: ParticipantRun) -> None:
+        """
+        Store the open topics of a run in the state backend, e.g., after a
+        session on the next topic was started.
+
+        :param run: The run to save.
+        :return: None
+        """
+        self.state.put_run(self.api, run)
 
     def get_runs(self, team_id: str) -> List[str]:
-        with RunManager._lock:
-            cursor = self.db_connection.execute(
-                f"SELECT id FROM runs WHERE team_id=?;", (team_id,)
-            )
+        with self.pool.connection() as conn:
+            cursor = conn.execute("SELECT id FROM runs WHERE team_id=?;", (team_id,))
             run_ids = cursor.fetchall()
         run_ids = [r[0] for r in run_ids]
         return run_ids
@@ -92,12 +145,16 @@ class RunManager:
         progress = {}
         if active_run is None:
             progress["status"] = "inactive"
-            with RunManager._lock:
-                cursor = self.db_connection.execute(
-                    f"SELECT DISTINCT topic_id FROM requests WHERE run_id=? AND api='run'",
+            with self.pool.connection() as conn:
+                cursor = conn.execute(
+                    "SELECT DISTINCT topic_id FROM requests WHERE run_id=? AND api='run'",
                     (run_id,),
                 )
                 topic_ids = [t[0] for t in cursor.fetchall()]
+            # the topic of an interrupted session is still open
+            session = self.state.get_session(self.api, run_id)
+            if session is not None:
+                topic_ids = [t for t in topic_ids if t != session.topic_id]
             progress["done_topics"] = topic_ids
             progress["open_topics"] = [
                 t.id for t in active_task.topics.values() if t.id not in topic_ids
@@ -113,20 +170,23 @@ class RunManager:
 
     def run_exists(self, run_id: str, team_id: str = None) -> bool:
         active_run = self.get_active_run(run_id)
-        with RunManager._lock:
-            cursor = self.db_connection.cursor()
+        with self.pool.connection() as conn:
             if team_id is None:
-                cursor.execute(
-                    "SELECT * FROM runs WHERE id=? AND "
+                cursor = conn.execute(
+                    "SELECT * FROM runs WHERE id=? AND ("
                     "EXISTS(SELECT * FROM requests "
-                    "WHERE requests.run_id = runs.id AND requests.api = 'run')",
+                    "WHERE requests.run_id = runs.id AND requests.api = 'run') OR "
+                    "EXISTS(SELECT * FROM sessions "
+                    "WHERE sessions.api = 'run' AND sessions.run_id = runs.id))",
                     (run_id,),
                 )
             else:
-                cursor.execute(
-                    "SELECT * FROM runs WHERE id=? AND runs.team_id=? AND "
+                cursor = conn.execute(
+                    "SELECT * FROM runs WHERE id=? AND runs.team_id=? AND ("
                     "EXISTS(SELECT * FROM requests "
-                    "WHERE requests.run_id = runs.id AND requests.api = 'run')",
+                    "WHERE requests.run_id = runs.id AND requests.api = 'run') OR "
+                    "EXISTS(SELECT * FROM sessions "
+                    "WHERE sessions.api = 'run' AND sessions.run_id = runs.id))",
                     (run_id, team_id),
                 )
             res = cursor.fetchone()
@@ -134,12 +194,14 @@ class RunManager:
 
     def create_run(self, run_meta: RunMetaMessage) -> ParticipantRun:
         run = ParticipantRun(run_meta)
-        with RunManager._lock:
-            self.runs[run_meta.run_id] = run
+        self.state.put_run(self.api, run)
+        if not self.state.shared:
+            with RunManager._lock:
+                self.runs[run_meta.run_id] = run
 
         if self is self._instance:
-            with RunManager._lock:
-                _ = self.db_connection.execute(
+            with self.pool.connection() as conn:
+                _ = conn.execute(
                     "INSERT INTO runs VALUES (?,?,?,?);",
                     (
                         run.run_meta.run_id,
@@ -148,113 +210,148 @@ class RunManager:
                         json.dumps(run.run_meta.extra),
                     ),
                 )
-                self.db_connection.commit()
         return run
 
+    def remove_run(self, run_id: str) -> None:
+        """
+        Remove a run that failed to start, so that it can be started again.
+
+        :param run_id: ID of the run.
+        :return: None
+        """
+        self.state.remove_run(self.api, run_id)
+        with RunManager._lock:
+            self.runs.pop(run_id, None)
+
+        if self is self._instance:
+            with self.pool.connection() as conn:
+                _ = conn.execute("DELETE FROM runs WHERE id=?;", (run_id,))
+
     def recover_run(self, run_id: str) -> ParticipantRun:
+        """
+        Reactivate a run that is not active anymore, e.g., because it was
+        started before its state was stored. Topics with recorded requests are
+        done, and the stored session of the run, if any, is continued.
+
+        :param run_id: ID of the run.
+        :return: The active run.
+        """
         run = self.get_active_run(run_id)
         if run is not None:
             return run
 
-        with RunManager._lock:
-            cursor = self.db_connection.execute(
-                f"SELECT DISTINCT topic_id FROM requests WHERE run_id=? AND api='run'",
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT DISTINCT topic_id FROM requests WHERE run_id=? AND api='run'",
                 (run_id,),
             )
-            topic_ids = cursor.fetchall()[0]
-            cursor.execute(f"SELECT * FROM runs WHERE id=?;", (run_id,))
+            done_topic_ids = {row[0] for row in cursor.fetchall()}
+            cursor.execute("SELECT * FROM runs WHERE id=?;", (run_id,))
             res = cursor.fetchone()
 
-        run = ParticipantRun(RunMetaMessage(res[0], res[2], res[3], res[1]))
-        while True:
-            topic = run._open_topics.popitem(last=False)
-            if topic[0] not in topic_ids:
-                run._open_topics.update({topic[0]: topic[1]})
-                run._open_topics.move_to_end(topic[0], last=False)
-                break
-
-        with RunManager._lock:
-            self.runs[run_id] = run
-        return run
-
-    def dump_all(self):
-        with RunManager._lock:
-            cursor = self.db_connection.execute("SELECT runs.id FROM runs;")
-
-            run_ids = [x[0] for x in cursor.fetchall()]
+        run = ParticipantRun(RunMetaMessage(res[0], res[2], json.loads(res[3]), res[1]))
+        session = SessionManager().get_session(run.run_meta.team_id, run_id)
+        if session is not None:
+            run.sessions[session.topic_id] = session
+            done_topic_ids.add(session.topic_id)
 
-        data = []
+        for topic_id in done_topic_ids:
+            run._open_topics.pop(topic_id, None)
 
-        for run_id in run_ids:
-            data.extend(self.dump(run_id))
+        self.state.put_run(self.api, run)
+        if not self.state.shared:
+            with RunManager._lock:
+                run = self.runs.setdefault(run_id, run)
+        return run
 
-        return data
+    def dump_all(self) -> Iterator[Dict[str, Any]]:
+        """
+        Export the run files of all runs.
 
-    def dump(self, run_id: str) -> Optional[List[Dict[str, Any]]]:
-        db_data = []
-        with RunManager._lock:
-            cursor = self.db_connection.execute(
-                "SELECT "
-                "runs.team_id AS team_id, "
-                "description, "
-                "extra, "
-                "topic_id, "
-                "user_utterance,"
-                "user_meta,"
-                "assistant_response, "
-                "assistant_meta, "
-                "assistant_citations "
-                "FROM runs "
-                "JOIN requests ON runs.id = requests.run_id "
-                "WHERE runs.id=? AND requests.api='run' "
-                "ORDER BY requests.timestamp;",
-                (run_id,),
-            )
-
-            requests = cursor.fetchall()
+        :return: Iterator over the entries of all run files.
+        """
+        return self._dump()
 
-            column_names = [t[0] for t in cursor.description]
-            for r in requests:
-                db_data.append({k: v for k, v in zip(column_names, r)})
+    def dump(self, run_id: str) -> Iterator[Dict[str, Any]]:
+        """
+        Export the run file of a run.
 
-        if len(db_data) == 0:
-            return None
-
-        metadata = {
-            "team_id": db_data[0]["team_id"],
-            "run_id": run_id,
-            "description": db_data[0]["description"],
-            "extra": json.loads(db_data[0]["extra"]),
-        }
+        :param run_id: ID of the run.
+        :return: Iterator over the entries of the run file.
+        """
+        return self._dump(run_id)
 
+    def _dump(self, run_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
         responses_per_topic = {}
-        for request in db_data:
-            if request["topic_id"] not in responses_per_topic:
-                responses_per_topic[request["topic_id"]] = []
-
-            responses_per_topic[request["topic_id"]].append(request)
-
-        out_data = []
-        for topic_id, responses in responses_per_topic.items():
-            for i, response in enumerate(responses):
-                out_data.append(
+        metadata = {}
+        for request in self._dump_requests(run_id):
+            if request["run_id"] != metadata.get("run_id", None):
+                metadata = {
+                    "team_id": request["team_id"],
+                    "run_id": request["run_id"],
+                    "description": request["description"],
+                    "extra": json.loads(request["extra"]),
+                }
+                responses_per_topic = {}
+
+            topic_id = request["topic_id"]
+            responses_per_topic[topic_id] = responses_per_topic.get(topic_id, 0) + 1
+
+            yield {
+                "metadata": {
+                    **metadata,
+                    "topic_id": f"{topic_id}_{responses_per_topic[topic_id]}",
+                },
+                "responses": [
                     {
-                        "metadata": {**metadata, "topic_id": f"{topic_id}_{i + 1}"},
-                        "responses": [
-                            {
-                                "rank": 1,
-                                "user_utterance": response["user_utterance"],
-                                "user_meta": json.loads(response["user_meta"]),
-                                "assistant_text": response["assistant_response"],
-                                "assistant_citations": json.loads(
-                                    response["assistant_citations"]
-                                ),
-                                "assistant_meta": json.loads(
-                                    response["assistant_meta"]
-                                ),
-                            }
-                        ],
+                        "rank": 1,
+                        "user_utterance": request["user_utterance"],
+                        "user_meta": json.loads(request["user_meta"]),
+                        "assistant_text": request["assistant_response"],
+                        "assistant_citations": json.loads(
+                            request["assistant_citations"]
+                        ),
+                        "assistant_meta": json.loads(request["assistant_meta"]),
                     }
-                )
+                ],
+            }
+
+    def _dump_requests(self, run_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        # one ordered read of the runs and their requests, paged by the key of the
+        # last row, so that slow clients of a stream do not hold a pooled
+        # connection and a read snapshot. The (run_id, api, timestamp) index
+        # yields the rows in order, since api is fixed.
+        query = (
+            "SELECT requests.run_id, requests.timestamp, requests.id, "
+            "runs.team_id, runs.description, runs.extra, requests.topic_id, "
+            "requests.user_utterance, requests.user_meta, "
+            "requests.assistant_response, requests.assistant_meta, "
+            "requests.assistant_citations "
+            "FROM requests INDEXED BY requests_run_api_timestamp "
+            "JOIN runs ON runs.id = requests.run_id "
+            "WHERE requests.api='run' AND (requests.run_id, requests.api, "
+            "requests.timestamp, requests.id) > (?, 'run', ?, ?) "
+        )
+        params = ()
+        if run_id is not None:
+            query += "AND requests.run_id=? "
+            params = (run_id,)
+        query += (
+            "ORDER BY requests.run_id, requests.api, requests.timestamp, requests.id "
+            "LIMIT ?;"
+        )
+
+        page_size = CONFIG["storage"]["page_size"]
+        key = ("", "", 0)
+        while True:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(query, (*key, *params, page_size))
+                column_names = [t[0] for t in cursor.description]
+                rows = cursor.fetchall()
+
+            for row in rows:
+                yield dict(zip(column_names, row))
 
-        return out_data
+            if len(rows) < page_size:
+                return
+            key = rows[-1][:3]
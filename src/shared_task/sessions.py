@@ -1,9 +1,13 @@
+import dataclasses
 import uuid
 from dataclasses import dataclass, field
-from typing import Dict, Any, List
+from typing import TYPE_CHECKING, Dict, Any, List, Callable, Optional, Tuple
 
 from api.messages import RunMetaMessage
 
+if TYPE_CHECKING:
+    from shared_task.state import StateBackend
+
 
 @dataclass
 class Session:
@@ -13,15 +17,41 @@ class Session:
     history: list[Dict[str, str]] = field(default_factory=list)
     user_meta: List[Dict[str, Any]] = field(default_factory=list)
     assistant_meta: List[Dict[str, Any]] = field(default_factory=list)
+    # history as seen by the user simulator, i.e., with swapped roles, kept in
+    # sync with the history so it is not rebuilt on every turn
+    simulator_history: List[Dict[str, str]] = field(default_factory=list)
     id: str = field(default_factory=lambda: uuid.uuid4().hex)
 
+    def snapshot(self) -> "Session":
+        """
+        Returns a copy of the session whose lists do not change with the session,
+        e.g., for a user simulator that may outlive the request.
+
+        :return: Copy of the session.
+        """
+        return dataclasses.replace(
+            self,
+            history=list(self.history),
+            user_meta=list(self.user_meta),
+            assistant_meta=list(self.assistant_meta),
+            simulator_history=list(self.simulator_history),
+        )
+
 
 class SessionManager(object):
+    """
+    Keeps the active session of every run. Sessions are stored in the state
+    backend and, unless the state is shared with other processes, also kept in
+    memory.
+    """
+
     _instance = None
 
     def __init__(self):
         if not hasattr(self, "sessions"):
-            self.sessions: dict[str, dict[str, Session]] = {}
+            # (api, run_id) -> session
+            self.sessions: Dict[Tuple[str, str], Session] = {}
+            self.termination_callbacks: List[Callable[[Session], None]] = []
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -29,26 +59,92 @@ class SessionManager(object):
 
         return cls._instance
 
-    def get_session(self, teamname: str, run_id: str) -> Session | None:
-        runs = self.sessions.get(teamname, None)
-        if runs is None:
+    @property
+    def state(self) -> "StateBackend":
+        # imported here since the state backend depends on this module
+        from shared_task.state import get_state_backend
+
+        return get_state_backend()
+
+    def get_session(
+        self, teamname: str, run_id: str, debug: bool = False
+    ) -> Session | None:
+        """
+        Returns the active session of a run, which is loaded from the state
+        backend if it is not in memory, e.g., after a restart.
+
+        :param teamname: ID of the team of the run.
+        :param run_id: ID of the run.
+        :param debug: Whether the run is a debugging run.
+        :return: The session or None if the run has no active session.
+        """
+        key = ("debug" if debug else "run", run_id)
+        session = self.sessions.get(key, None)
+        if session is None or self.state.shared:
+            session = self.state.get_session(*key)
+            if session is not None and not self.state.shared:
+                session = self.sessions.setdefault(key, session)
+
+        if session is None or session.team_id != teamname:
             return None
 
-        return runs.get(run_id, None)
+        return session
 
     def create_session(
-        self, run: RunMetaMessage, user_id: str, topic_id: str
+        self,
+        run: RunMetaMessage,
+        user_id: str,
+        topic_id: str,
+        debug: bool = False,
+        session_id: Optional[str] = None,
     ) -> Session:
+        """
+        Create a new session for a run.
+
+        :param run: Metadata of the run.
+        :param user_id: ID of the simulated user.
+        :param topic_id: ID of the topic of the session.
+        :param debug: Whether the run is a debugging run.
+        :param session_id: ID of the session, e.g., if its first utterance was
+            prefetched. Defaults to a random ID.
+        :return: The new session.
+        """
         assert run.team_id is not None
-        if run.team_id in self.sessions:
-            assert run.run_id not in self.sessions[run.team_id]
-        else:
-            self.sessions[run.team_id] = {}
+        key = ("debug" if debug else "run", run.run_id)
+        assert key not in self.sessions
         new_session = Session(run.team_id, user_id, topic_id)
-        self.sessions[run.team_id][run.run_id] = new_session
+        if session_id is not None:
+            new_session.id = session_id
+        self.state.add_session(*key, new_session)
+        if not self.state.shared:
+            self.sessions[key] = new_session
         return new_session
 
-    def terminate_session(self, run: RunMetaMessage) -> None:
+    def save_session(self, session: Session) -> None:
+        """
+        Store the changes of a session in the state backend.
+
+        :param session: The session to save.
+        :return: None
+        :raises StateConflictError: If another request saved the session since.
+        """
+        self.state.save_session(session)
+
+    def add_termination_callback(self, callback: Callable[[Session], None]) -> None:
+        """
+        Register a function that is called with every session that terminates.
+
+        :param callback: Function that receives the terminated session.
+        :return: None
+        """
+        self.termination_callbacks.append(callback)
+
+    def terminate_session(self, run: RunMetaMessage, debug: bool = False) -> None:
         assert run.team_id is not None
-        assert run.team_id in self.sessions and run.run_id in self.sessions[run.team_id]
-        del self.sessions[run.team_id][run.run_id]
+        session = self.sessions.pop(("debug" if debug else "run", run.run_id), None)
+        if session is None:
+            session = self.get_session(run.team_id, run.run_id, debug)
+        assert session is not None
+        self.state.remove_session(session)
+        for callback in self.termination_callbacks:
+            callback(session)
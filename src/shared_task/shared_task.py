@@ -4,12 +4,18 @@ import importlib
 import json
 import random
 from abc import ABCMeta, abstractmethod
-from typing import OrderedDict, Dict, List, Optional
+from typing import Callable, OrderedDict, Dict, List, Optional
 
 from api.messages import AssistantResponseMessage
 from shared_task.sessions import Session, SessionManager
 from shared_task.topic import Topic
-from simulation.user import User, UserUtterance, DummyUser, UnrestrictedUserSimulator
+from simulation.user import (
+    User,
+    UserUtterance,
+    DummyUser,
+    Persona,
+    UnrestrictedUserSimulator,
+)
 
 
 class SharedTask(metaclass=ABCMeta):
@@ -22,8 +28,9 @@ class SharedTask(metaclass=ABCMeta):
 
     users_by_id: Dict[str, User]
 
-    def __init__(self, name):
-        self.name = name
+    def __init__(self, name: Optional[str] = None):
+        if name is not None:
+            self.name = name
 
         self.topics = OrderedDict()
         self.users_per_topic = {}
@@ -52,6 +59,65 @@ class SharedTask(metaclass=ABCMeta):
     def initialize(self):
         pass
 
+    def warm_up(self, progress: Optional[Callable[[int, int], None]] = None):
+        """
+        Load the models of all users of the initialized task, so that the first
+        sessions do not have to wait for them.
+
+        :param progress: Called with the number of warmed up users and the total.
+        :return: None
+        """
+        users = list(self.users_by_id.values())
+        for i, user in enumerate(users):
+            user.warm_up()
+            if progress is not None:
+                progress(i + 1, len(users))
+
+    def precompute_openings(
+        self,
+        batch_size: int,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Generate the first utterances of all users on their topics that do not
+        depend on the session, so that new sessions do not wait for them.
+
+        :param batch_size: Number of prompts generated per batch.
+        :param progress: Called with the number of precomputed utterances and the
+            total.
+        :return: None
+        """
+        users_per_class = {}
+        for user in self.users_by_id.values():
+            users_per_class.setdefault(type(user), []).append(user)
+
+        total = sum(len(user.opening_prompts()) for user in self.users_by_id.values())
+        done = 0
+
+        def count(num_openings: int):
+            nonlocal done
+            done += num_openings
+            if progress is not None:
+                progress(done, total)
+
+        for user_class, users in users_per_class.items():
+            user_class.precompute_openings(users, batch_size, count)
+
+    @classmethod
+    def choose_user(cls, topic_id: str, debug: bool) -> User:
+        """
+        Draw the simulated user of a new session on a topic.
+
+        :param topic_id: ID of the topic.
+        :param debug: Whether the session belongs to a debugging run.
+        :return: A user of the pool of the topic.
+        """
+        active_task = SharedTaskManager().active_task
+        if debug:
+            return random.choice(active_task.debug_users_per_topic[topic_id])
+
+        return random.choice(active_task.users_per_topic[topic_id])
+
     @classmethod
     def init_session(cls, run, debug: bool) -> Optional[Session]:
         """
@@ -64,19 +130,21 @@ class SharedTask(metaclass=ABCMeta):
         if not run.has_next_topic():
             return None
 
-        task_manager = SharedTaskManager()
         topic = run.next_topic()
         topic_id = topic.id
 
-        if debug:
-            user = random.choice(
-                task_manager.active_task.debug_users_per_topic[topic_id]
-            )
+        # the user of a prefetched first utterance is kept
+        prefetch = run.prefetch
+        if prefetch is not None and prefetch.topic_id == topic_id:
+            user_id, session_id = prefetch.user_id, prefetch.session_id
         else:
-            user = random.choice(task_manager.active_task.users_per_topic[topic_id])
+            run.prefetch = None
+            user_id, session_id = cls.choose_user(topic_id, debug).id, None
 
         session_manager = SessionManager()
-        session = session_manager.create_session(run.run_meta, user.id, topic_id)
+        session = session_manager.create_session(
+            run.run_meta, user_id, topic_id, debug=debug, session_id=session_id
+        )
 
         run.sessions[topic_id] = session
 
@@ -91,13 +159,33 @@ class SharedTask(metaclass=ABCMeta):
     ):
         if utterance is not None:
             session.history.append({"role": "user", "content": utterance.content})
+            session.simulator_history.append(
+                {"role": "assistant", "content": utterance.content}
+            )
             session.user_meta.append(copy.deepcopy(utterance.meta))
 
         if response is not None:
             session.history.append({"role": "assistant", "content": response.response})
+            session.simulator_history.append(
+                {"role": "user", "content": response.response}
+            )
 
             session.assistant_meta.append(copy.deepcopy(response.meta))
 
+    @classmethod
+    def revert_response(cls, session: Session):
+        """
+        Remove the last assistant response from a session, e.g., if the user
+        simulator failed to answer it.
+
+        :param session: The session to revert.
+        :return: None
+        """
+        assert session.history[-1]["role"] == "assistant"
+        session.history.pop()
+        session.simulator_history.pop()
+        session.assistant_meta.pop()
+
 
 # ==========================
 # REPOSITORY OF SHARED TASKS
@@ -107,25 +195,23 @@ class SharedTask(metaclass=ABCMeta):
 class DummySharedTask(SharedTask):
     """Dummy shared task for testing purposes."""
 
-    def __init__(self):
-        super().__init__("dummy")
+    name = "dummy"
 
     def initialize(self):
         self._add_topic(Topic("dummy1", "Why is the sky blue?"))
         self._add_topic(Topic("dummy2", "Why is the sky not green?"))
 
+        # stable IDs, so that persisted sessions find their user after a restart
         for _id in self.topics:
-            self._add_user(_id, DummyUser(self.topics))
-            self._add_debug_user(_id, DummyUser(self.topics))
+            self._add_user(_id, DummyUser(self.topics, f"dummy-user-{_id}"))
+            self._add_debug_user(_id, DummyUser(self.topics, f"dummy-debug-user-{_id}"))
 
 
 class TREC_iKAT25(SharedTask):
+    name = "trec-ikat25"
     topics_path = "data/trec-ikat25/2025_test_topics.json"
     users_path = "data/trec-ikat25/simulation-data.csv"
 
-    def __init__(self):
-        super().__init__("trec-ikat25")
-
     def initialize(self):
         self._load_topics()
         self._load_users()
@@ -140,10 +226,11 @@ class TREC_iKAT25(SharedTask):
         super().update_session(session, utterance, response)
 
         if utterance is not None:
+            # unrestricted simulators do not follow rubrics
             session.user_meta.append(
                 {
-                    "rubric": utterance.meta["rubric"],
-                    "rubric_score": utterance.meta["rubric_score"],
+                    "rubric": utterance.meta.get("rubric"),
+                    "rubric_score": utterance.meta.get("rubric_score"),
                 }
             )
 
@@ -167,12 +254,18 @@ class TREC_iKAT25(SharedTask):
                     ]
                 }
 
-                user = UnrestrictedUserSimulator(row[0], self.topics, rubrics, ptkb)
+                persona = Persona.create(
+                    row[0],
+                    self.topics,
+                    rubrics,
+                    ptkb,
+                    UnrestrictedUserSimulator.base_prompt,
+                )
+                # simulators hold no state of their own, so debug and regular runs
+                # share the user of a persona
+                user = UnrestrictedUserSimulator(persona, self.topics)
 
                 self._add_debug_user(topic_id, user)
-
-                user = UnrestrictedUserSimulator(row[0], self.topics, rubrics, ptkb)
-
                 self._add_user(topic_id, user)
 
 
@@ -183,15 +276,13 @@ class SharedTaskManager:
 
     def __init__(self):
         if not hasattr(self, "shared_tasks"):
-            self.shared_tasks = {}
-
             modname, _, clsname = "shared_task.shared_task.SharedTask".rpartition(".")
             mod = importlib.import_module(modname)
             cls = getattr(mod, clsname)
 
-            for task in cls.__subclasses__():
-                task_instance = task()
-                self.shared_tasks[task_instance.name] = task_instance
+            # shared tasks are instantiated when they are activated
+            self.task_classes = {task.name: task for task in cls.__subclasses__()}
+            self.shared_tasks = {}
 
             self.active_task = None
 
@@ -202,4 +293,6 @@ class SharedTaskManager:
         return cls._instance
 
     def set_active_task(self, task_name: str):
+        if task_name not in self.shared_tasks:
+            self.shared_tasks[task_name] = self.task_classes[task_name]()
         self.active_task = self.shared_tasks[task_name]
@@ -0,0 +1,381 @@
+"""
+Module for the state of active runs and their sessions, so that in-flight
+conversations survive restarts and can be shared by several worker processes.
+"""
+
+import json
+import os
+import sqlite3
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, Optional
+
+from api.messages import RunMetaMessage
+from config import CONFIG, WORKERS_ENV
+from shared_task.participant_run import ParticipantRun
+from shared_task.sessions import Session
+from shared_task.shared_task import SharedTaskManager
+from storage.database import ConnectionPool
+
+# lists of a session that are stored entry by entry
+_ENTRY_KINDS = ("history", "user_meta", "assistant_meta")
+
+
+class StateConflictError(Exception):
+    """Raised if a run or session was changed by another request since it was loaded."""
+
+
+class StateBackend(metaclass=ABCMeta):
+    """
+    Abstract class of storages for active runs, their open topics, and their
+    sessions. Runs and sessions are identified by the API, "run" or "debug", and
+    the run ID.
+
+    If the state is shared, other processes may change it at any time, so runs
+    and sessions must be loaded from the backend for every request instead of
+    being kept in memory.
+    """
+
+    shared: bool = False
+
+    @abstractmethod
+    def get_run(self, api: str, run_id: str) -> Optional[ParticipantRun]:
+        """
+        Load an active run.
+
+        :param api: API of the run.
+        :param run_id: ID of the run.
+        :return: The run or None if there is no active run with this ID.
+        """
+
+    @abstractmethod
+    def put_run(self, api: str, run: ParticipantRun) -> None:
+        """
+        Store a new run or the open topics of an existing run.
+
+        :param api: API of the run.
+        :param run: The run to store.
+        :return: None
+        :raises StateConflictError: If a new run already exists, or if another
+            request stored the run since it was loaded.
+        """
+
+    @abstractmethod
+    def remove_run(self, api: str, run_id: str) -> None:
+        """
+        Remove an active run, e.g., because it failed to start.
+
+        :param api: API of the run.
+        :param run_id: ID of the run.
+        :return: None
+        """
+
+    @abstractmethod
+    def get_session(self, api: str, run_id: str) -> Optional[Session]:
+        """
+        Load the active session of a run.
+
+        :param api: API of the run.
+        :param run_id: ID of the run.
+        :return: The session or None if the run has no active session.
+        """
+
+    @abstractmethod
+    def add_session(self, api: str, run_id: str, session: Session) -> None:
+        """
+        Store a new session of a run.
+
+        :param api: API of the run.
+        :param run_id: ID of the run.
+        :param session: The new session.
+        :return: None
+        :raises StateConflictError: If the run already has an active session.
+        """
+
+    @abstractmethod
+    def save_session(self, session: Session) -> None:
+        """
+        Store the entries that were appended to a session since it was added or
+        loaded.
+
+        :param session: The session to save.
+        :return: None
+        :raises StateConflictError: If another request saved the session since.
+        """
+
+    @abstractmethod
+    def remove_session(self, session: Session) -> None:
+        """
+        Remove a terminated session.
+
+        :param session: The terminated session.
+        :return: None
+        """
+
+
+class MemoryStateBackend(StateBackend):
+    """
+    Stores nothing, i.e., runs and sessions are only kept in the memory of the
+    process and are lost on restarts.
+    """
+
+    def get_run(self, api: str, run_id: str) -> Optional[ParticipantRun]:
+        return None
+
+    def put_run(self, api: str, run: ParticipantRun) -> None:
+        pass
+
+    def remove_run(self, api: str, run_id: str) -> None:
+        pass
+
+    def get_session(self, api: str, run_id: str) -> Optional[Session]:
+        return None
+
+    def add_session(self, api: str, run_id: str, session: Session) -> None:
+        pass
+
+    def save_session(self, session: Session) -> None:
+        pass
+
+    def remove_session(self, session: Session) -> None:
+        pass
+
+
+class SqliteStateBackend(StateBackend):
+    """
+    Stores runs and sessions in the database of the shared task, which can be
+    shared by several processes on one host.
+
+    The history and the meta lists of a session are stored entry by entry, so a
+    save only writes what was appended since the last load or save, and a
+    terminated session is deleted. Every save increments the version of the
+    session, and a save of an outdated session fails, so concurrent requests on
+    the same run in different processes cannot overwrite each other's turns.
+    Runs are versioned the same way, so that only one request starts a run or a
+    session on its next topic.
+    """
+
+    def __init__(self, shared: bool = False, pool: Optional[ConnectionPool] = None):
+        self.shared = shared
+        self._pool = pool
+        self._lock = Lock()
+        # number of stored entries per kind and version of the loaded sessions
+        self._saved: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def pool(self) -> ConnectionPool:
+        if self._pool is None:
+            self._pool = ConnectionPool()
+
+        return self._pool
+
+    def get_run(self, api: str, run_id: str) -> Optional[ParticipantRun]:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT team_id, description, extra, open_topics, version "
+                "FROM active_runs WHERE api=? AND run_id=?;",
+                (api, run_id),
+            )
+            res = cursor.fetchone()
+
+        if res is None:
+            return None
+
+        topics = SharedTaskManager().active_task.topics
+        return ParticipantRun(
+            RunMetaMessage(run_id, res[1], json.loads(res[2]), res[0]),
+            _open_topics=OrderedDict(
+                (topic_id, topics[topic_id])
+                for topic_id in json.loads(res[3])
+                if topic_id in topics
+            ),
+            version=res[4],
+        )
+
+    def put_run(self, api: str, run: ParticipantRun) -> None:
+        open_topics = json.dumps(list(run._open_topics))
+        with self.pool.connection() as conn:
+            if run.version is None:
+                try:
+                    _ = conn.execute(
+                        "INSERT INTO active_runs(api, run_id, team_id, description, "
+                        "extra, open_topics, version) VALUES (?,?,?,?,?,?,0);",
+                        (
+                            api,
+                            run.run_meta.run_id,
+                            run.run_meta.team_id,
+                            run.run_meta.description,
+                            json.dumps(run.run_meta.extra),
+                            open_topics,
+                        ),
+                    )
+                except sqlite3.IntegrityError as e:
+                    raise StateConflictError(
+                        f'Run "{run.run_meta.run_id}" was started by another request.'
+                    ) from e
+            else:
+                cursor = conn.execute(
+                    "UPDATE active_runs SET open_topics=?, version=version + 1 "
+                    "WHERE api=? AND run_id=? AND version=?;",
+                    (open_topics, api, run.run_meta.run_id, run.version),
+                )
+                if cursor.rowcount == 0:
+                    raise StateConflictError(
+                        f'Run "{run.run_meta.run_id}" was changed by another request.'
+                    )
+
+        run.version = 0 if run.version is None else run.version + 1
+
+    def remove_run(self, api: str, run_id: str) -> None:
+        with self.pool.connection() as conn:
+            _ = conn.execute(
+                "DELETE FROM active_runs WHERE api=? AND run_id=?;", (api, run_id)
+            )
+
+    def get_session(self, api: str, run_id: str) -> Optional[Session]:
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "SELECT id, team_id, user_id, topic_id, version FROM sessions "
+                "WHERE api=? AND run_id=?;",
+                (api, run_id),
+            )
+            res = cursor.fetchone()
+            if res is None:
+                return None
+
+            session = Session(res[1], res[2], res[3], id=res[0])
+            cursor = conn.execute(
+                "SELECT kind, content FROM session_entries "
+                "WHERE session_id=? ORDER BY kind, position;",
+                (session.id,),
+            )
+            for kind, content in cursor:
+                getattr(session, kind).append(json.loads(content))
+
+        for message in session.history:
+            role = "assistant" if message["role"] == "user" else "user"
+            session.simulator_history.append(
+                {"role": role, "content": message["content"]}
+            )
+
+        with self._lock:
+            self._saved[session.id] = {
+                **{kind: len(getattr(session, kind)) for kind in _ENTRY_KINDS},
+                "version": res[4],
+            }
+
+        return session
+
+    def add_session(self, api: str, run_id: str, session: Session) -> None:
+        try:
+            with self.pool.connection() as conn:
+                _ = conn.execute(
+                    "INSERT INTO sessions VALUES (?,?,?,?,?,?,?);",
+                    (
+                        session.id,
+                        api,
+                        run_id,
+                        session.team_id,
+                        session.user_id,
+                        session.topic_id,
+                        0,
+                    ),
+                )
+        except sqlite3.IntegrityError as e:
+            # another request started a session on the next topic of the run
+            raise StateConflictError(
+                f'Run "{run_id}" already has an active session.'
+            ) from e
+
+        with self._lock:
+            self._saved[session.id] = {
+                **{kind: 0 for kind in _ENTRY_KINDS},
+                "version": 0,
+            }
+
+        self.save_session(session)
+
+    def save_session(self, session: Session) -> None:
+        with self._lock:
+            saved = self._saved.get(session.id, None)
+            if saved is None:
+                return
+            saved = dict(saved)
+
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE sessions SET version=version + 1 WHERE id=? AND version=?;",
+                (session.id, saved["version"]),
+            )
+            if cursor.rowcount == 0:
+                # rolls back the transaction
+                raise StateConflictError(
+                    f'Session "{session.id}" was changed by another request.'
+                )
+            saved["version"] += 1
+
+            for kind in _ENTRY_KINDS:
+                entries = getattr(session, kind)
+                if len(entries) < saved[kind]:
+                    # entries were reverted
+                    _ = conn.execute(
+                        "DELETE FROM session_entries "
+                        "WHERE session_id=? AND kind=? AND position>=?;",
+                        (session.id, kind, len(entries)),
+                    )
+                else:
+                    _ = conn.executemany(
+                        "INSERT OR REPLACE INTO session_entries VALUES (?,?,?,?);",
+                        [
+                            (session.id, kind, i, json.dumps(entries[i]))
+                            for i in range(saved[kind], len(entries))
+                        ],
+                    )
+                saved[kind] = len(entries)
+
+        with self._lock:
+            if session.id in self._saved:
+                self._saved[session.id] = saved
+
+    def remove_session(self, session: Session) -> None:
+        with self._lock:
+            self._saved.pop(session.id, None)
+
+        with self.pool.connection() as conn:
+            _ = conn.execute(
+                "DELETE FROM session_entries WHERE session_id=?;", (session.id,)
+            )
+            _ = conn.execute("DELETE FROM sessions WHERE id=?;", (session.id,))
+
+
+STATE_BACKENDS = {"memory": MemoryStateBackend, "sqlite": SqliteStateBackend}
+
+
+@lru_cache(maxsize=1)
+def get_state_backend() -> StateBackend:
+    """
+    Returns the state backend that is configured as ``storage.state``. The
+    state is shared if the API runs with several worker processes.
+
+    :return: State backend of the process.
+    :raises ValueError: If the configured backend does not exist or cannot be
+        shared by several worker processes.
+    """
+    name = CONFIG["storage"]["state"]
+    if name not in STATE_BACKENDS:
+        raise ValueError(
+            f'Unknown state backend "{name}". '
+            f"Available backends: {', '.join(STATE_BACKENDS)}"
+        )
+
+    if int(os.environ.get(WORKERS_ENV, "1")) <= 1:
+        return STATE_BACKENDS[name]()
+
+    if name == "memory":
+        raise ValueError(
+            "The memory state backend cannot be used with several workers."
+        )
+
+    return SqliteStateBackend(shared=True)
@@ -0,0 +1,122 @@
+"""
+Module for loading the models of the active shared task in the background, so
+that the API accepts connections while the models are loading.
+"""
+
+import logging
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, Optional
+
+from config import CONFIG
+from shared_task.shared_task import SharedTask
+
+
+class WarmUp:
+    """
+    Loads the response tokenizer and the models of all users of a shared task
+    and keeps track of the progress for the readiness endpoint.
+
+    Stages are "pending", "tokenizer", "users", "openings" if the first utterances
+    are precomputed, and finally "ready" or "failed".
+    If the warm-up is skipped, the stage is "skipped" and models are loaded on
+    first use.
+    """
+
+    _instance = None
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with WarmUp._lock:
+            if cls._instance is None:
+                cls._instance = super(WarmUp, cls).__new__(cls, *args, **kwargs)
+                cls._instance.logger = logging.getLogger(cls.__name__)
+                cls._instance.stage = "pending"
+                cls._instance.done = 0
+                cls._instance.total = 0
+                cls._instance.error = None
+                cls._instance.started = None
+                cls._instance.finished = None
+                cls._instance.thread = None
+
+            return cls._instance
+
+    @property
+    def ready(self) -> bool:
+        return self.stage in ("ready", "skipped")
+
+    def start(self, task: SharedTask, background: bool = True):
+        """
+        Start warming up an initialized shared task.
+
+        :param task: The active shared task.
+        :param background: Whether to warm up in a background thread.
+        :return: None
+        """
+        self.started = time.monotonic()
+        if background:
+            self.thread = Thread(
+                target=self._run, args=(task,), name="warm-up", daemon=True
+            )
+            self.thread.start()
+        else:
+            self._run(task)
+
+    def skip(self):
+        """
+        Skip the warm-up, models are loaded on first use.
+
+        :return: None
+        """
+        self.stage = "skipped"
+
+    def _run(self, task: SharedTask):
+        # imported here to keep the import of this module cheap
+        from api.messages import get_tokenizer
+
+        try:
+            self.stage = "tokenizer"
+            get_tokenizer()
+
+            self.stage = "users"
+            task.warm_up(self._progress)
+
+            if CONFIG["simulation"]["precompute_openings"]:
+                self.stage = "openings"
+                self._progress(0, 0)
+                task.precompute_openings(
+                    CONFIG["simulation"]["batching"]["max_batch_size"], self._progress
+                )
+
+            self.stage = "ready"
+            self.logger.info(
+                "Warm-up finished in %.1fs", time.monotonic() - self.started
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            self.stage = "failed"
+            self.error = str(e)
+            self.logger.exception("Warm-up failed")
+        finally:
+            self.finished = time.monotonic()
+
+    def _progress(self, done: int, total: int):
+        self.done = done
+        self.total = total
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Returns the progress of the warm-up.
+
+        :return: Dictionary with readiness, stage, progress, and elapsed seconds.
+        """
+        elapsed: Optional[float] = None
+        if self.started is not None:
+            elapsed = (self.finished or time.monotonic()) - self.started
+
+        return {
+            "ready": self.ready,
+            "stage": self.stage,
+            "progress": {"done": self.done, "total": self.total},
+            "elapsed": elapsed,
+            "error": self.error,
+        }
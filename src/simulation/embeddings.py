@@ -0,0 +1,120 @@
+"""
+Module for caching sentence embeddings of texts that do not change while the
+API is running, e.g., the rubrics of the simulated users.
+"""
+
+import hashlib
+import logging
+import os
+import zlib
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+
+class EmbeddingCache:
+    """
+    Keeps the sentence embeddings of fixed texts in memory.
+
+    If a cache directory is given, embeddings are also stored as .npy files keyed
+    by the model name and the hash of the text, so they survive restarts.
+    """
+
+    def __init__(
+        self,
+        model: "SentenceTransformer | FakeSentenceEncoder",
+        model_name: str,
+        cache_dir: Optional[str] = None,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.model = model
+        self.model_name = model_name
+        self.cache_dir = None
+        if cache_dir:
+            self.cache_dir = os.path.join(cache_dir, model_name.replace("/", "_"))
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.embeddings: Dict[str, np.ndarray] = {}
+
+    def _path(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.npy")
+
+    def precompute(self, texts: List[str]):
+        """
+        Load or encode the embeddings of texts that are not cached yet.
+
+        :param texts: Texts to embed.
+        :return: None
+        """
+        missing = []
+        for text in dict.fromkeys(texts):
+            if text in self.embeddings:
+                continue
+
+            if self.cache_dir is not None and os.path.exists(self._path(text)):
+                self.embeddings[text] = np.load(self._path(text))
+            else:
+                missing.append(text)
+
+        if len(missing) == 0:
+            return
+
+        self.logger.debug("Encode %d texts", len(missing))
+        encodings = self.model.encode(missing, show_progress_bar=False)
+        for text, encoding in zip(missing, encodings):
+            self.embeddings[text] = encoding
+            if self.cache_dir is not None:
+                np.save(self._path(text), encoding)
+
+    def get(self, text: str) -> np.ndarray:
+        """
+        Returns the embedding of a text and encodes it if it is not cached yet.
+
+        :param text: Text to embed.
+        :return: Embedding of the text.
+        """
+        if text not in self.embeddings:
+            self.precompute([text])
+
+        return self.embeddings[text]
+
+
+class FakeSentenceEncoder:
+    """
+    Deterministic stand-in for a sentence transformer that needs no model
+    download. Texts are embedded as normalized counts of hashed words.
+    """
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False) -> np.ndarray:
+        encodings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                encodings[i, zlib.crc32(word.encode("utf-8")) % self.dimensions] += 1
+        norms = np.linalg.norm(encodings, axis=1, keepdims=True)
+        return encodings / np.maximum(norms, 1e-12)
+
+    def similarity(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return a @ b.T
+
+
+def create_sentence_encoder(name: str) -> "SentenceTransformer | FakeSentenceEncoder":
+    """
+    Create the sentence encoder with the given name.
+
+    :param name: Name of a sentence transformer model or "fake".
+    :return: Sentence encoder.
+    """
+    if name == "fake":
+        return FakeSentenceEncoder()
+
+    # imported here since importing it takes seconds
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name)
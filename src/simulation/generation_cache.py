@@ -0,0 +1,301 @@
+"""
+Module for caching the outputs of deterministic model calls, e.g., the opening
+question of a persona for a topic that every team is asked, or the rubric scores
+of identical responses.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
+from simulation.llm import LLM
+from storage.database import ConnectionPool
+
+
+class GenerationCache:
+    """
+    Content-addressed cache of model outputs with an LRU tier in memory of
+    ``max_size`` entries and an optional Sqlite3 tier at ``db_path`` that
+    survives restarts and is shared by worker processes. The Sqlite3 tier keeps
+    the ``max_rows`` most recently computed outputs.
+
+    Concurrent misses of the same key are computed only once.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        db_path: Optional[str] = None,
+        max_rows: Optional[int] = None,
+    ):
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # key -> outputs
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+        # key -> future of the outputs that are being computed
+        self._pending: Dict[str, Future] = {}
+        self._lock = Lock()
+
+        self.pool = None
+        if db_path:
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+            self.pool = ConnectionPool(db_path)
+            with self.pool.connection() as conn:
+                _ = conn.execute(
+                    "CREATE TABLE IF NOT EXISTS generations "
+                    "(key TEXT PRIMARY KEY, model TEXT, outputs TEXT, "
+                    "created REAL NOT NULL DEFAULT 0) WITHOUT ROWID;"
+                )
+                columns = [
+                    row[1] for row in conn.execute("PRAGMA table_info(generations);")
+                ]
+                if "created" not in columns:
+                    # files of earlier versions are evicted first
+                    _ = conn.execute(
+                        "ALTER TABLE generations "
+                        "ADD COLUMN created REAL NOT NULL DEFAULT 0;"
+                    )
+                _ = conn.execute(
+                    "CREATE INDEX IF NOT EXISTS generations_created "
+                    "ON generations(created);"
+                )
+
+    @staticmethod
+    def key(model: str, method: str, messages: List[Dict[str, str]], **kwargs) -> str:
+        """
+        Returns the key of a model call.
+
+        :param model: Name of the model, including its precision.
+        :param method: Called method of the model.
+        :param messages: Conversation of the call. Only roles and contents count.
+        :param kwargs: Arguments of the call.
+        :return: Hex digest of the normalized call.
+        """
+        call = json.dumps(
+            [
+                model,
+                method,
+                [[m["role"], m["content"]] for m in messages],
+                kwargs,
+            ],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(call.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the cached outputs of a call.
+
+        :param key: Key of the call, see :meth:`key`.
+        :return: The outputs or None if the call is not cached.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+
+        res = None
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                cursor = conn.execute(
+                    "SELECT outputs FROM generations WHERE key=?;", (key,)
+                )
+                res = cursor.fetchone()
+
+        with self._lock:
+            if res is None:
+                self.misses += 1
+                return None
+
+            outputs = json.loads(res[0])
+            self.disk_hits += 1
+            self._remember(key, outputs)
+            return outputs
+
+    def put(self, key: str, model: str, outputs: Any):
+        """
+        Cache the outputs of a call.
+
+        :param key: Key of the call, see :meth:`key`.
+        :param model: Name of the model that computed the outputs.
+        :param outputs: JSON-serializable outputs.
+        :return: None
+        """
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                _ = conn.execute(
+                    "INSERT OR REPLACE INTO generations VALUES (?,?,?,?);",
+                    (key, model, json.dumps(outputs), time.time()),
+                )
+                if self.max_rows is not None:
+                    _ = conn.execute(
+                        "DELETE FROM generations WHERE key IN "
+                        "(SELECT key FROM generations "
+                        "ORDER BY created DESC LIMIT -1 OFFSET ?);",
+                        (self.max_rows,),
+                    )
+
+        with self._lock:
+            self._remember(key, outputs)
+
+    def _remember(self, key: str, outputs: Any):
+        self._entries[key] = outputs
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: str, model: str, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the cached outputs of a call or computes and caches them. Callers
+        that miss the same key while it is computed wait for its outputs.
+
+        :param key: Key of the call, see :meth:`key`.
+        :param model: Name of the model that computes the outputs.
+        :param compute: Function that computes the outputs.
+        :return: Outputs of the call.
+        """
+        outputs = self.get(key)
+        if outputs is not None:
+            return outputs
+
+        with self._lock:
+            if key in self._entries:
+                # computed since the lookup
+                return self._entries[key]
+
+            future = self._pending.get(key, None)
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = Future()
+                self._pending[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            outputs = compute()
+            self.put(key, model, outputs)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(outputs)
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+        return outputs
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns the size of the memory tier and how many lookups were answered
+        from memory, from disk, or had to be computed.
+
+        :return: Dictionary of counters and the hit rate.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (
+                    (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+                ),
+            }
+
+
+class CachedLLM(LLM):
+    """
+    Wraps a model and answers deterministic calls, i.e., greedy or beam search
+    generations and choice scores, from a :class:`GenerationCache`. Sampled
+    generations always reach the model.
+    """
+
+    def __init__(self, llm: LLM, cache: GenerationCache):
+        super().__init__()
+        self.llm = llm
+        self.cache = cache
+
+    def __getattr__(self, name):
+        # delegate everything else, e.g., the model name, to the wrapped model
+        llm = self.__dict__.get("llm", None)
+        if llm is None:
+            raise AttributeError(name)
+        return getattr(llm, name)
+
+    def __str__(self) -> str:
+        return str(self.llm)
+
+    @staticmethod
+    def is_deterministic(kwargs: Dict) -> bool:
+        # backends may sample by default, so greedy decoding has to be explicit
+        return kwargs.get("do_sample", None) is False
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        if not self.is_deterministic(kwargs):
+            return self.llm.generate(messages, session_id, **kwargs)
+
+        model = str(self.llm)
+        return list(
+            self.cache.get_or_compute(
+                GenerationCache.key(model, "generate", messages, **kwargs),
+                model,
+                lambda: self.llm.generate(messages, session_id, **kwargs),
+            )
+        )
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        if not self.is_deterministic(kwargs):
+            return self.llm.batch_generate(messages, **kwargs)
+
+        model = str(self.llm)
+        keys = [GenerationCache.key(model, "generate", m, **kwargs) for m in messages]
+        outputs = [self.cache.get(key) for key in keys]
+        missing = [i for i, o in enumerate(outputs) if o is None]
+        if len(missing) > 0:
+            texts = self.llm.batch_generate([messages[i] for i in missing], **kwargs)
+            n = len(texts) // len(missing)
+            for j, i in enumerate(missing):
+                outputs[i] = texts[j * n : (j + 1) * n]
+                self.cache.put(keys[i], model, outputs[i])
+
+        # outputs of each conversation are consecutive, like the wrapped model's
+        return [text for o in outputs for text in o]
+
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        model = str(self.llm)
+        return list(
+            self.cache.get_or_compute(
+                GenerationCache.key(model, "score_choices", messages, choices=choices),
+                model,
+                lambda: self.llm.score_choices(messages, choices),
+            )
+        )
+
+    def release_session(self, session_id: str):
+        self.llm.release_session(session_id)
@@ -0,0 +1,187 @@
+"""
+Module for running user simulators outside of the event loop and the request
+thread pool, so that slow model inference cannot starve cheap API routes.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, TypeVar, Optional, Set
+
+import config
+import metrics
+
+T = TypeVar("T")
+
+
+class InferenceQueueFullError(RuntimeError):
+    """Raised if the inference queue is full and a request has to be retried later."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Inference queue is full.")
+        self.retry_after = retry_after
+
+
+class InferenceTimeoutError(TimeoutError):
+    """Raised if an inference request did not finish in time."""
+
+
+class InferenceInProgressError(RuntimeError):
+    """Raised if a call with the same key is still running, e.g., after it timed out."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("An earlier inference call is still running.")
+        self.retry_after = retry_after
+
+
+class InferenceService:
+    """
+    Runs user simulator calls on a dedicated pool of worker threads.
+
+    The number of calls that are queued or running is bounded. Calls beyond that
+    bound are rejected immediately instead of piling up, and callers stop waiting
+    for a call after a timeout. A call that timed out keeps its worker busy until
+    it finishes, and it still counts towards the bound until then. Calls with the
+    same key, e.g., of the same session, do not run concurrently.
+    """
+
+    _instance = None
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with InferenceService._lock:
+            if cls._instance is None:
+                conf = config.CONFIG["simulation"]["inference"]
+                cls._instance = super(InferenceService, cls).__new__(
+                    cls, *args, **kwargs
+                )
+                cls._instance.logger = logging.getLogger(cls.__name__)
+                cls._instance.executor = ThreadPoolExecutor(
+                    max_workers=conf["workers"], thread_name_prefix="inference"
+                )
+                cls._instance.workers = conf["workers"]
+                cls._instance.max_pending = conf["workers"] + conf["queue_size"]
+                cls._instance.pending = 0
+                # keys of the calls that are queued or running
+                cls._instance.running: Set[str] = set()
+
+            return cls._instance
+
+    async def run(
+        self,
+        fn: Callable[..., T],
+        *args,
+        timeout: Optional[float] = None,
+        key: Optional[str] = None,
+    ) -> T:
+        """
+        Run a blocking function on the inference workers and wait for its result.
+
+        :param fn: Function to run.
+        :param args: Positional arguments of the function.
+        :param timeout: Seconds to wait for the result. Defaults to the configured timeout.
+        :param key: Key of calls that must not run concurrently, e.g., a session ID.
+        :return: Return value of the function.
+        :raises InferenceInProgressError: If a call with the same key is still running.
+        :raises InferenceQueueFullError: If too many calls are queued or running.
+        :raises InferenceTimeoutError: If the function did not return in time.
+        """
+        conf = config.CONFIG["simulation"]["inference"]
+        if timeout is None:
+            timeout = conf["timeout"]
+
+        with InferenceService._lock:
+            if key is not None and key in self.running:
+                raise InferenceInProgressError(conf["retry_after"])
+            if self.pending >= self.max_pending:
+                raise InferenceQueueFullError(conf["retry_after"])
+            self.pending += 1
+            if key is not None:
+                self.running.add(key)
+
+        future = self._submit(fn, *args)
+        if key is not None:
+            # also outlives a timeout, until the worker finished the call
+            future.add_done_callback(lambda _: self._forget(key))
+        return await self.wait(future, timeout)
+
+    def prefetch(self, fn: Callable[..., T], *args) -> Optional[Future]:
+        """
+        Run a blocking function speculatively, i.e., only if a worker is idle, so
+        that it never delays or rejects calls that requests wait for.
+
+        :param fn: Function to run.
+        :param args: Positional arguments of the function.
+        :return: Future of the return value or None if all workers are busy.
+        """
+        with InferenceService._lock:
+            if self.pending >= self.workers:
+                return None
+            self.pending += 1
+
+        return self._submit(fn, *args)
+
+    def _submit(self, fn: Callable[..., T], *args) -> Future:
+        # the labels of the request are context variables, which do not pass to
+        # the worker threads by themselves
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+
+        def call():
+            metrics.STAGE_SECONDS.observe(
+                time.perf_counter() - submitted,
+                stage="inference_queue",
+                api=metrics.API.get(),
+                simulator=metrics.SIMULATOR.get(),
+            )
+            with metrics.stage(getattr(fn, "__name__", "inference")):
+                return fn(*args)
+
+        future = self.executor.submit(context.run, call)
+        future.add_done_callback(self._release)
+        return future
+
+    async def wait(self, future: Future, timeout: Optional[float] = None) -> T:
+        """
+        Wait for the result of a call on the inference workers.
+
+        :param future: Future of the call.
+        :param timeout: Seconds to wait for the result. Defaults to the configured timeout.
+        :return: Return value of the call.
+        :raises InferenceTimeoutError: If the call did not return in time.
+        """
+        if timeout is None:
+            timeout = config.CONFIG["simulation"]["inference"]["timeout"]
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), timeout
+            )
+        except asyncio.TimeoutError as e:
+            self.logger.warning("Inference call did not finish in %ss", timeout)
+            raise InferenceTimeoutError(
+                f"Inference did not finish within {timeout} seconds."
+            ) from e
+
+    def _release(self, _):
+        with InferenceService._lock:
+            self.pending -= 1
+
+    def _forget(self, key: str):
+        with InferenceService._lock:
+            self.running.discard(key)
+
+    def shutdown(self):
+        """
+        Cancel queued calls and release the workers. The next instantiation
+        creates a fresh service.
+
+        :return: None
+        """
+        with InferenceService._lock:
+            if InferenceService._instance is self:
+                InferenceService._instance = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
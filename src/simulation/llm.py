@@ -1,12 +1,32 @@
 import abc
+import asyncio
+import copy
+import hashlib
+import json
 import logging
 import os
+import queue
+import time
+import uuid
+from concurrent.futures import Future
 from enum import Enum
-from typing import List, Dict, Optional
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Any, Callable, List, Dict, Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from openai import OpenAI
-from transformers import BitsAndBytesConfig, AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    BitsAndBytesConfig,
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    DynamicCache,
+    PreTrainedModel,
+)
+
+import config
+import metrics
 
 
 class Precision(Enum):
@@ -51,7 +71,12 @@ class LLM(metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def generate(self, messages: List[Dict[str, str]], **kwargs) -> List[str]:
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
         pass
 
     @abc.abstractmethod
@@ -60,6 +85,388 @@ class LLM(metaclass=abc.ABCMeta):
     ) -> List[str]:
         pass
 
+    def batch_generate_sessions(
+        self,
+        messages: List[List[Dict[str, str]]],
+        session_ids: List[Optional[str]],
+        **kwargs,
+    ) -> List[str]:
+        """
+        Like :meth:`batch_generate`, but for calls of known sessions, so that
+        models with a prefix cache can reuse the cached prompt of each session.
+
+        :param messages: Conversation of each call.
+        :param session_ids: ID of the session of each call, or None.
+        :return: Outputs of the calls, the outputs of each call are consecutive.
+        """
+        return self.batch_generate(messages, **kwargs)
+
+    def release_session(self, session_id: str):
+        """
+        Drop state that was kept for a session, e.g., because it terminated.
+
+        :param session_id: ID of the session.
+        :return: None
+        """
+
+
+class _RadixNode:
+    """Node of a :class:`SharedPrefixCache` with the keys and values of its edge."""
+
+    __slots__ = ("tokens", "keys", "values", "children", "parent", "size", "used")
+
+    def __init__(
+        self,
+        tokens: Tuple[int, ...],
+        keys: List[torch.Tensor],
+        values: List[torch.Tensor],
+        parent: Optional["_RadixNode"],
+    ):
+        self.tokens = tokens
+        # per layer with shape (1, heads, len(tokens), head dim)
+        self.keys = keys
+        self.values = values
+        # first token of the edge -> child
+        self.children: Dict[int, _RadixNode] = {}
+        self.parent = parent
+        self.size = sum(t.numel() * t.element_size() for t in [*keys, *values])
+        self.used = time.monotonic()
+
+
+class SharedPrefixCache:
+    """
+    Radix tree of the key-value cache of prompt prefixes that many sessions
+    share, e.g., the system prompt of a persona and the opening turn.
+
+    Each edge holds the keys and values of its own tokens only, so prefixes with a
+    common beginning, like the base prompt of all personas, share memory. The
+    stored tensors are never changed, a lookup copies them into a new cache, so
+    the tree is shared read-only by all sessions and teams. Least recently used
+    leaves are evicted once the total size exceeds ``max_memory`` bytes.
+    """
+
+    def __init__(self, max_memory: int):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self._root = _RadixNode((), [], [], None)
+        self._lock = Lock()
+
+    @staticmethod
+    def _common_length(a: Tuple[int, ...], b: List[int]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def match(self, ids: torch.Tensor) -> Tuple[int, Optional[DynamicCache]]:
+        """
+        Look up the longest cached prefix of a prompt.
+
+        :param ids: Token IDs of the prompt with shape (length,).
+        :return: Length of the prefix and a new cache of it, or 0 and None.
+        """
+        tokens = ids.tolist()
+        segments = []
+        length = 0
+        with self._lock:
+            node = self._root
+            while length < len(tokens) and tokens[length] in node.children:
+                node = node.children[tokens[length]]
+                n = self._common_length(node.tokens, tokens[length:])
+                node.used = time.monotonic()
+                segments.append((node, n))
+                length += n
+                if n < len(node.tokens):
+                    break
+
+            if length == 0:
+                self.misses += 1
+                return 0, None
+            self.hits += 1
+
+        # evicted nodes keep their tensors, so the copy needs no lock
+        cache = DynamicCache()
+        for layer in range(len(segments[0][0].keys)):
+            cache.update(
+                torch.cat([node.keys[layer][:, :, :n] for node, n in segments], dim=-2),
+                torch.cat(
+                    [node.values[layer][:, :, :n] for node, n in segments], dim=-2
+                ),
+                layer,
+            )
+        return length, cache
+
+    def insert(self, ids: torch.Tensor, cache: DynamicCache):
+        """
+        Store the keys and values of a prompt prefix.
+
+        :param ids: Token IDs of the prefix with shape (length,).
+        :param cache: Cache that holds at least the prefix.
+        :return: None
+        """
+        tokens = ids.tolist()
+        length = 0
+        with self._lock:
+            node = self._root
+            while length < len(tokens):
+                child = node.children.get(tokens[length], None)
+                if child is None:
+                    leaf = _RadixNode(
+                        tuple(tokens[length:]),
+                        [
+                            k[:, :, length : len(tokens)].clone()
+                            for k in cache.key_cache
+                        ],
+                        [
+                            v[:, :, length : len(tokens)].clone()
+                            for v in cache.value_cache
+                        ],
+                        node,
+                    )
+                    node.children[leaf.tokens[0]] = leaf
+                    self.memory += leaf.size
+                    break
+
+                n = self._common_length(child.tokens, tokens[length:])
+                if n < len(child.tokens):
+                    child = self._split(child, n)
+                child.used = time.monotonic()
+                node = child
+                length += n
+
+            self._evict()
+
+    def _split(self, node: _RadixNode, n: int) -> _RadixNode:
+        # the new parent holds the first n tokens of the edge
+        parent = _RadixNode(
+            node.tokens[:n],
+            [k[:, :, :n].clone() for k in node.keys],
+            [v[:, :, :n].clone() for v in node.values],
+            node.parent,
+        )
+        size = node.size
+        node.tokens = node.tokens[n:]
+        node.keys = [k[:, :, n:].clone() for k in node.keys]
+        node.values = [v[:, :, n:].clone() for v in node.values]
+        node.size = sum(
+            t.numel() * t.element_size() for t in [*node.keys, *node.values]
+        )
+        node.parent.children[parent.tokens[0]] = parent
+        node.parent = parent
+        parent.children[node.tokens[0]] = node
+        self.memory += parent.size + node.size - size
+        return parent
+
+    def _evict(self):
+        while self.memory > self.max_memory:
+            leaves = []
+            nodes = [self._root]
+            while len(nodes) > 0:
+                node = nodes.pop()
+                nodes.extend(node.children.values())
+                if len(node.children) == 0 and node is not self._root:
+                    leaves.append(node)
+            if len(leaves) == 0:
+                break
+
+            leaf = min(leaves, key=lambda x: x.used)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.memory -= leaf.size
+
+    def __len__(self) -> int:
+        nodes = [self._root]
+        count = 0
+        with self._lock:
+            while len(nodes) > 0:
+                node = nodes.pop()
+                nodes.extend(node.children.values())
+                count += 1
+        return count - 1
+
+
+class PrefixCache:
+    """
+    LRU cache of the key-value cache of the last prompt of each session.
+
+    A session's prompt grows by a few messages per turn. The cached keys and
+    values of the longest common token prefix are reused, so only the new tokens
+    have to be prefilled. Entries are evicted by LRU once their total size
+    exceeds ``max_memory`` bytes.
+
+    Prompts of sessions that have no cached prompt yet start from the longest
+    prefix in the ``shared`` cache, if one is given.
+    """
+
+    def __init__(self, max_memory: int, shared: Optional[SharedPrefixCache] = None):
+        self.max_memory = max_memory
+        self.shared = shared
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        # session id -> (prompt ids, cache of the prompt ids, size in bytes)
+        self._entries: OrderedDict[str, Tuple[torch.Tensor, DynamicCache, int]] = (
+            OrderedDict()
+        )
+        self._lock = Lock()
+
+    def prepare(
+        self,
+        model: PreTrainedModel,
+        session_id: Optional[str],
+        input_ids: torch.Tensor,
+        num_beams: int = 1,
+        shared_length: int = 0,
+    ) -> DynamicCache:
+        """
+        Prefill the prompt of a session up to its last token, reusing the cached
+        prefix of the session's previous prompt or a shared prefix.
+
+        :param model: Model that generates the response.
+        :param session_id: ID of the session, or None if the prompt belongs to no
+            session and only shared prefixes are reused.
+        :param input_ids: Token IDs of the prompt with shape (1, length).
+        :param num_beams: Number of beams used for generation.
+        :param shared_length: Number of leading prompt tokens that other sessions
+            share and that are stored in the shared cache.
+        :return: Cache to pass to ``generate`` as ``past_key_values``.
+        """
+        ids = input_ids[0, :-1]
+        shared_length = min(shared_length, len(ids))
+        entry = None
+        with self._lock:
+            if session_id is not None:
+                entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.memory -= entry[2]
+
+        cache = DynamicCache()
+        start = 0
+        if entry is not None:
+            cached_ids, cached_cache, _ = entry
+            n = min(len(cached_ids), len(ids))
+            mismatch = (cached_ids[:n] != ids[:n]).nonzero()
+            start = n if len(mismatch) == 0 else int(mismatch[0])
+            if start > 0:
+                cache = cached_cache
+                cache.crop(start)
+
+        if start > 0:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        shared_start = 0
+        if self.shared is not None and start < shared_length:
+            shared_start, shared_cache = self.shared.match(ids[:shared_length])
+            if shared_start > start:
+                cache, start = shared_cache, shared_start
+
+        if start < len(ids):
+            with torch.no_grad():
+                model(
+                    input_ids=ids[None, start:],
+                    past_key_values=cache,
+                    use_cache=True,
+                    cache_position=torch.arange(start, len(ids), device=ids.device),
+                )
+
+        if self.shared is not None and shared_start < shared_length:
+            self.shared.insert(ids[:shared_length], cache)
+        if session_id is not None:
+            self._put(session_id, ids.clone(), cache)
+
+        # generate extends the cache, so the cached prompt has to stay untouched
+        generation_cache = copy.deepcopy(cache)
+        if num_beams > 1:
+            generation_cache.batch_repeat_interleave(num_beams)
+        return generation_cache
+
+    def prepare_batch(
+        self,
+        model: PreTrainedModel,
+        session_ids: List[Optional[str]],
+        prompts: List[torch.Tensor],
+        pad_token_id: int,
+        num_beams: int = 1,
+        shared_lengths: Optional[List[int]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, DynamicCache]:
+        """
+        Prefill the prompts of several sessions like :meth:`prepare` and merge them
+        into one left-padded batch, so that batched calls reuse cached prefixes too.
+
+        :param model: Model that generates the responses.
+        :param session_ids: ID of the session of each prompt, or None.
+        :param prompts: Token IDs of each prompt with shape (1, length).
+        :param pad_token_id: Token ID of the left padding.
+        :param num_beams: Number of beams used for generation.
+        :param shared_lengths: Number of shared leading tokens of each prompt.
+        :return: Padded input IDs, attention mask, and the cache to pass to
+            ``generate`` as ``past_key_values``.
+        """
+        if shared_lengths is None:
+            shared_lengths = [0] * len(prompts)
+        caches = [
+            self.prepare(model, session_id, ids, 1, shared_length)
+            for session_id, ids, shared_length in zip(
+                session_ids, prompts, shared_lengths
+            )
+        ]
+
+        length = max(ids.shape[1] for ids in prompts)
+        input_ids = torch.full(
+            (len(prompts), length), pad_token_id, device=prompts[0].device
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        for i, ids in enumerate(prompts):
+            input_ids[i, length - ids.shape[1] :] = ids[0]
+            attention_mask[i, length - ids.shape[1] :] = 1
+
+        # the padded positions are masked, so their keys and values are zeros
+        cache = DynamicCache()
+        for layer in range(len(caches[0].key_cache)):
+            cache.update(
+                torch.cat(
+                    [
+                        F.pad(c.key_cache[layer], (0, 0, length - ids.shape[1], 0))
+                        for c, ids in zip(caches, prompts)
+                    ]
+                ),
+                torch.cat(
+                    [
+                        F.pad(c.value_cache[layer], (0, 0, length - ids.shape[1], 0))
+                        for c, ids in zip(caches, prompts)
+                    ]
+                ),
+                layer,
+            )
+        if num_beams > 1:
+            cache.batch_repeat_interleave(num_beams)
+        return input_ids, attention_mask, cache
+
+    def _put(self, session_id: str, ids: torch.Tensor, cache: DynamicCache):
+        size = sum(
+            t.numel() * t.element_size() for t in [*cache.key_cache, *cache.value_cache]
+        )
+        with self._lock:
+            self._entries[session_id] = (ids, cache, size)
+            self.memory += size
+            while self.memory > self.max_memory and len(self._entries) > 0:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.memory -= evicted_size
+
+    def evict(self, session_id: str):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self.memory -= entry[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
 
 class OpenAIModel(LLM):
     def __init__(self, model: OpenAIModelVersion):
@@ -74,12 +481,21 @@ class OpenAIModel(LLM):
         logging.getLogger("httpcore.http11").setLevel(logging.INFO)
         self.client = OpenAI(api_key=key)
 
-    def generate(self, messages: List[Dict[str, str]], **kwargs) -> List[str]:
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
         response = self.client.chat.completions.create(
             model=self.model_name, messages=messages, modalities=["text"], **kwargs
         )
 
         outputs = [x.message.content for x in response.choices]
+        if response.usage is not None:
+            metrics.GENERATED_TOKENS.inc(
+                response.usage.completion_tokens, model=self.model_name
+            )
 
         return outputs
 
@@ -115,7 +531,13 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
         )
         self.tokenizer.pad_token_id = self.tokenizer.bos_token_id
 
-        cuda_device_name = torch.cuda.get_device_name(torch.cuda.current_device())
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        cuda_device_name = ""
+        if self.device == "cuda":
+            cuda_device_name = torch.cuda.get_device_name(torch.cuda.current_device())
+        else:
+            self.logger.warning("CUDA unavailable, running on CPU")
+
         if ("A100" in cuda_device_name) or ("H100" in cuda_device_name):
             self.logger.info("Using FlashAttention2")
             self.model = AutoModelForCausalLM.from_pretrained(
@@ -136,13 +558,23 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
                 **kwargs,
             )
 
-        if not next(self.model.parameters()).is_cuda:
+        if self.device == "cuda" and not next(self.model.parameters()).is_cuda:
             try:
                 self.model.to("cuda")
             except ValueError as e:
                 self.logger.warning("Can't move model to cuda!")
                 self.logger.warning(e)
 
+        self.prefix_cache = None
+        cache_conf = config.CONFIG["simulation"]["prefix_cache"]
+        shared = None
+        if cache_conf.get("shared_memory", 0) > 0:
+            shared = SharedPrefixCache(cache_conf["shared_memory"] * 1024 * 1024)
+        if cache_conf["max_memory"] > 0 or shared is not None:
+            self.prefix_cache = PrefixCache(
+                cache_conf["max_memory"] * 1024 * 1024, shared
+            )
+
     def tokenize_messages(self, messages: List[Dict[str, str] | List[Dict[str, str]]]):
         if isinstance(messages[0], list):
             return self.tokenizer.apply_chat_template(
@@ -152,7 +584,7 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
                 add_generation_prompt=True,
                 return_dict=True,
                 enable_thinking=False,
-            ).to("cuda")
+            ).to(self.device)
 
         return self.tokenizer.apply_chat_template(
             messages,
@@ -160,10 +592,52 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
             add_generation_prompt=True,
             return_dict=True,
             enable_thinking=False,
-        ).to("cuda")
+        ).to(self.device)
+
+    def shared_length(
+        self, messages: List[Dict[str, str]], input_ids: torch.Tensor
+    ) -> int:
+        """
+        Number of prompt tokens that sessions share: the leading system messages and
+        the message that opens the conversation, i.e., for the simulators the system
+        prompt of the persona and the fixed opening turn.
+
+        :param messages: Conversation of the prompt.
+        :param input_ids: Token IDs of the prompt with shape (1, length).
+        :return: Number of shared tokens, 0 if they are not a prefix of the prompt.
+        """
+        n = 0
+        while n < len(messages) and messages[n]["role"] == "system":
+            n += 1
+
+        head_ids = self.tokenizer.apply_chat_template(
+            messages[: n + 1], add_generation_prompt=False, enable_thinking=False
+        )
+        if input_ids[0, : len(head_ids)].tolist() != head_ids:
+            return 0
+        return len(head_ids)
 
-    def generate(self, messages: List[Dict[str, str]], **kwargs) -> List[str]:
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
         inputs = self.tokenize_messages(messages)
+        if self.prefix_cache is not None and (
+            session_id is not None or self.prefix_cache.shared is not None
+        ):
+            shared_length = 0
+            if self.prefix_cache.shared is not None:
+                shared_length = self.shared_length(messages, inputs.input_ids)
+            kwargs["past_key_values"] = self.prefix_cache.prepare(
+                self.model,
+                session_id,
+                inputs.input_ids,
+                kwargs.get("num_beams", 1),
+                shared_length,
+            )
+
         outputs = self.model.generate(
             **inputs,
             pad_token_id=self.tokenizer.bos_token_id,
@@ -172,9 +646,34 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
         )
 
         out_ids = outputs.sequences[:, len(inputs.input_ids[0]) :]
+        self._count_tokens(out_ids)
         out_texts = self.tokenizer.batch_decode(out_ids, skip_special_tokens=True)
         return out_texts
 
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        """
+        Score the choices for the next token of the response with a single forward
+        pass instead of a generation loop.
+
+        :param messages: Conversation to which the model responds.
+        :param choices: Candidate answers. Each has to be encoded as a single token.
+        :return: Probability of each choice, normalized over the choices.
+        """
+        choice_ids = []
+        for choice in choices:
+            ids = self.tokenizer.encode(choice, add_special_tokens=False)
+            if len(ids) != 1:
+                raise ValueError(f"Choice {choice!r} is not a single token.")
+            choice_ids.append(ids[0])
+
+        inputs = self.tokenize_messages(messages)
+        with torch.inference_mode():
+            logits = self.model(**inputs).logits[0, -1, choice_ids]
+
+        return torch.softmax(logits.float(), dim=-1).tolist()
+
     def batch_generate(
         self, messages: List[List[Dict[str, str]]], **kwargs
     ) -> List[str]:
@@ -183,9 +682,55 @@ class HFModel(LLM, metaclass=abc.ABCMeta):
             **inputs, pad_token_id=self.tokenizer.bos_token_id, **kwargs
         )
         gen_ids = gen_ids[:, inputs.input_ids.shape[1] :]
+        self._count_tokens(gen_ids)
         outputs = self.tokenizer.batch_decode(gen_ids, skip_special_tokens=True)
         return outputs
 
+    def batch_generate_sessions(
+        self,
+        messages: List[List[Dict[str, str]]],
+        session_ids: List[Optional[str]],
+        **kwargs,
+    ) -> List[str]:
+        if self.prefix_cache is None:
+            return self.batch_generate(messages, **kwargs)
+
+        prompts = [self.tokenize_messages(m).input_ids for m in messages]
+        shared_lengths = None
+        if self.prefix_cache.shared is not None:
+            shared_lengths = [
+                self.shared_length(m, ids) for m, ids in zip(messages, prompts)
+            ]
+        input_ids, attention_mask, kwargs["past_key_values"] = (
+            self.prefix_cache.prepare_batch(
+                self.model,
+                session_ids,
+                prompts,
+                self.tokenizer.bos_token_id,
+                kwargs.get("num_beams", 1),
+                shared_lengths,
+            )
+        )
+
+        gen_ids = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            pad_token_id=self.tokenizer.bos_token_id,
+            **kwargs,
+        )
+        gen_ids = gen_ids[:, input_ids.shape[1] :]
+        self._count_tokens(gen_ids)
+        return self.tokenizer.batch_decode(gen_ids, skip_special_tokens=True)
+
+    def _count_tokens(self, out_ids: torch.Tensor):
+        # finished sequences are padded up to the longest one
+        num_tokens = out_ids.ne(self.tokenizer.bos_token_id).sum().item()
+        metrics.GENERATED_TOKENS.inc(num_tokens, model=str(self))
+
+    def release_session(self, session_id: str):
+        if self.prefix_cache is not None:
+            self.prefix_cache.evict(session_id)
+
 
 class HFModelQuantized(HFModel):
     def __init__(
@@ -218,3 +763,591 @@ class HFModelQuantized(HFModel):
 
     def __str__(self) -> str:
         return str(self.name)
+
+
+class BatchedLLM(LLM):
+    """
+    Wraps a model and merges :meth:`generate` calls of concurrent sessions into
+    padded :meth:`batch_generate_sessions` calls.
+
+    Calls are grouped by their generation arguments. A group is run as soon as it
+    holds ``max_batch_size`` calls or its oldest call waited ``max_wait`` seconds.
+    """
+
+    def __init__(self, llm: LLM, max_batch_size: int, max_wait: float):
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.num_batches = 0
+        self.num_batched_calls = 0
+        # calls that are queued or grouped but not run yet
+        self._waiting = 0
+
+        self._queue = queue.Queue()
+        self._scheduler = None
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        # delegate everything else, e.g., the model name, to the wrapped model
+        llm = self.__dict__.get("llm", None)
+        if llm is None:
+            raise AttributeError(name)
+        return getattr(llm, name)
+
+    def __str__(self) -> str:
+        return str(self.llm)
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        if self.max_batch_size <= 1:
+            return self.llm.generate(messages, session_id, **kwargs)
+
+        self._ensure_scheduler()
+        future = Future()
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+        with self._lock:
+            self._waiting += 1
+        self._queue.put((key, time.monotonic(), messages, kwargs, future, session_id))
+        return future.result()
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        return self.llm.batch_generate(messages, **kwargs)
+
+    def batch_generate_sessions(
+        self,
+        messages: List[List[Dict[str, str]]],
+        session_ids: List[Optional[str]],
+        **kwargs,
+    ) -> List[str]:
+        return self.llm.batch_generate_sessions(messages, session_ids, **kwargs)
+
+    def release_session(self, session_id: str):
+        self.llm.release_session(session_id)
+
+    def queue_size(self) -> int:
+        """
+        Returns the number of calls that wait to be batched.
+
+        :return: Number of waiting calls.
+        """
+        with self._lock:
+            return self._waiting
+
+    def _ensure_scheduler(self):
+        with self._lock:
+            if self._scheduler is None:
+                self._scheduler = Thread(
+                    target=self._schedule, name="batch-scheduler", daemon=True
+                )
+                self._scheduler.start()
+
+    def _schedule(self):
+        # generation arguments -> calls in order of arrival
+        pending: Dict[str, List[Tuple]] = {}
+        while True:
+            if len(pending) == 0:
+                call = self._queue.get()
+                pending[call[0]] = [call]
+
+            # serve the group with the oldest call first
+            key = min(pending, key=lambda k: pending[k][0][1])
+            deadline = pending[key][0][1] + self.max_wait
+            while len(pending[key]) < self.max_batch_size:
+                try:
+                    call = self._queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                pending.setdefault(call[0], []).append(call)
+
+            batch = pending[key][: self.max_batch_size]
+            pending[key] = pending[key][self.max_batch_size :]
+            if len(pending[key]) == 0:
+                del pending[key]
+
+            self._run(batch)
+
+    def _run(self, batch: List[Tuple]):
+        with self._lock:
+            self._waiting -= len(batch)
+
+        kwargs = batch[0][3]
+        futures = [call[4] for call in batch]
+        try:
+            if len(batch) == 1:
+                outputs = [self.llm.generate(batch[0][2], batch[0][5], **kwargs)]
+            else:
+                texts = self.llm.batch_generate_sessions(
+                    [call[2] for call in batch], [call[5] for call in batch], **kwargs
+                )
+                # outputs of each conversation are consecutive
+                n = len(texts) // len(batch)
+                outputs = [texts[i * n : (i + 1) * n] for i in range(len(batch))]
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.exception("Batch of %d calls failed", len(batch))
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        self.num_batches += 1
+        self.num_batched_calls += len(batch)
+        for future, output in zip(futures, outputs):
+            future.set_result(output)
+
+
+def to_sampling_kwargs(kwargs: Dict) -> Dict:
+    """
+    Translate the transformers generation arguments that the simulators use into
+    the sampling arguments of OpenAI-compatible engines.
+
+    :param kwargs: Generation arguments for ``transformers`` ``generate``.
+    :return: Sampling arguments with ``n``, ``max_tokens``, ``temperature``, and
+        ``num_beams`` (1 if beam search is not used).
+    """
+    sampling = {
+        "n": kwargs.get("num_return_sequences", 1),
+        "max_tokens": kwargs.get("max_new_tokens", 128),
+        "num_beams": kwargs.get("num_beams", 1),
+    }
+    if not kwargs.get("do_sample", False):
+        sampling["temperature"] = 0.0
+    elif "temperature" in kwargs:
+        sampling["temperature"] = kwargs["temperature"]
+
+    for key in ["top_k", "top_p"]:
+        if kwargs.get(key, None) is not None:
+            sampling[key] = kwargs[key]
+
+    # arguments like diversity_penalty of group beam search have no counterpart
+    return sampling
+
+
+class VLLMModel(LLM):
+    """
+    Runs the model in-process on a vLLM engine. The engine schedules the requests
+    of all sessions with continuous batching on paged attention and reuses shared
+    prompt prefixes automatically.
+
+    Requires vLLM, which is not installed by default.
+    """
+
+    def __init__(self, model_repo: str, **engine_args):
+        super().__init__()
+        # optional dependency, only needed by this backend
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info(f"Initialize vLLM engine for {model_repo}")
+        self.name = f"{model_repo.split('/')[-1]}@vllm"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_repo)
+
+        # the engine lives on its own event loop, generate is called from threads
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, name="vllm-engine", daemon=True).start()
+        self.engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(model=model_repo, enable_prefix_caching=True, **engine_args)
+        )
+
+    def __str__(self) -> str:
+        return self.name
+
+    def _prompt(self, messages: List[Dict[str, str]]) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _final_output(self, outputs):
+        final = None
+        async for output in outputs:
+            final = output
+        return final
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        from vllm import SamplingParams
+        from vllm.sampling_params import BeamSearchParams
+
+        sampling = to_sampling_kwargs(kwargs)
+        num_beams = sampling.pop("num_beams")
+        prompt = self._prompt(messages)
+        request_id = uuid.uuid4().hex
+
+        if num_beams > 1:
+            params = BeamSearchParams(
+                beam_width=num_beams, max_tokens=sampling["max_tokens"]
+            )
+            output = self._run(
+                self._final_output(
+                    self.engine.beam_search({"prompt": prompt}, request_id, params)
+                )
+            )
+            outputs = output.outputs[: sampling["n"]]
+        else:
+            output = self._run(
+                self._final_output(
+                    self.engine.generate(prompt, SamplingParams(**sampling), request_id)
+                )
+            )
+            outputs = output.outputs
+
+        metrics.GENERATED_TOKENS.inc(
+            sum(len(o.token_ids) for o in outputs), model=str(self)
+        )
+        return [o.text for o in outputs]
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        # concurrent calls are batched by the engine
+        return [text for m in messages for text in self.generate(m, **kwargs)]
+
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        from vllm import SamplingParams
+
+        choice_ids = [
+            self.tokenizer.encode(c, add_special_tokens=False)[0] for c in choices
+        ]
+        params = SamplingParams(
+            max_tokens=1,
+            temperature=0.0,
+            logprobs=len(choices),
+            allowed_token_ids=choice_ids,
+        )
+        output = self._run(
+            self._final_output(
+                self.engine.generate(self._prompt(messages), params, uuid.uuid4().hex)
+            )
+        )
+        logprobs = output.outputs[0].logprobs[0]
+        scores = torch.tensor(
+            [
+                logprobs[i].logprob if i in logprobs else float("-inf")
+                for i in choice_ids
+            ]
+        )
+        return torch.softmax(scores, dim=-1).tolist()
+
+
+class OpenAICompatibleModel(LLM):
+    """
+    Sends requests to a local OpenAI-compatible server, e.g., ``vllm serve``, that
+    runs next to the API and batches requests of all sessions itself.
+    """
+
+    def __init__(self, base_url: str, model_name: str, api_key: str = "EMPTY"):
+        super().__init__()
+        self.model_name = model_name
+        self.name = f"{model_name.split('/')[-1]}@{base_url}"
+        logging.getLogger("httpcore.connection").setLevel(logging.INFO)
+        logging.getLogger("httpcore.http11").setLevel(logging.INFO)
+        self.client = OpenAI(base_url=base_url, api_key=api_key)
+
+    def __str__(self) -> str:
+        return self.name
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        sampling = to_sampling_kwargs(kwargs)
+        extra_body = {}
+        if sampling.pop("num_beams") > 1:
+            extra_body["use_beam_search"] = True
+        if "top_k" in sampling:
+            extra_body["top_k"] = sampling.pop("top_k")
+
+        response = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            extra_body=extra_body,
+            **sampling,
+        )
+        if response.usage is not None:
+            metrics.GENERATED_TOKENS.inc(
+                response.usage.completion_tokens, model=str(self)
+            )
+        return [x.message.content for x in response.choices]
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        # concurrent calls are batched by the server
+        return [text for m in messages for text in self.generate(m, **kwargs)]
+
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        response = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=1,
+            temperature=0.0,
+            logprobs=True,
+            top_logprobs=20,
+        )
+        top_logprobs = {
+            t.token.strip(): t.logprob
+            for t in response.choices[0].logprobs.content[0].top_logprobs
+        }
+        scores = torch.tensor([top_logprobs.get(c, float("-inf")) for c in choices])
+        if torch.isinf(scores).all():
+            raise ValueError("None of the choices is among the most likely tokens.")
+        return torch.softmax(scores, dim=-1).tolist()
+
+
+class FakeLLM(LLM):
+    """
+    Deterministic stand-in for the simulator model that needs neither a GPU nor
+    a model download. Calls take as long as a profile of a real model predicts,
+    and return text and rubric scores derived from a hash of the prompt.
+
+    Whitespace-separated words count as tokens. With a session ID, the prefix
+    that was prefilled in the previous call of the session is not counted again,
+    like with a prefix cache. Neither is the system prompt and opening message
+    that an earlier call already prefilled, like with a shared prefix cache.
+
+    :param prefill_ms: Milliseconds per prompt token.
+    :param decode_ms: Milliseconds per decoding step of a single sequence.
+    :param batch_scaling: Additional fraction of a decoding step per additional
+        sequence (beam or conversation) decoded in parallel.
+    :param output_tokens: Number of tokens of each output.
+    """
+
+    vocabulary = [
+        "what", "about", "the", "options", "could", "you", "explain", "more",
+        "how", "does", "this", "work", "for", "me", "and", "my", "family",
+        "which", "is", "better", "thanks", "why", "should", "i", "consider",
+    ]  # fmt: skip
+
+    def __init__(
+        self,
+        prefill_ms: float = 0.2,
+        decode_ms: float = 20.0,
+        batch_scaling: float = 0.05,
+        output_tokens: int = 24,
+    ):
+        super().__init__()
+        self.name = "fake"
+        self.prefill_ms = prefill_ms
+        self.decode_ms = decode_ms
+        self.batch_scaling = batch_scaling
+        self.output_tokens = output_tokens
+
+        # session id -> tokens of the last prompt
+        self._prompts: Dict[str, List[str]] = {}
+        # tokens of system prompts and opening messages that were prefilled
+        self._heads = set()
+        self._lock = Lock()
+
+    def __str__(self) -> str:
+        return self.name
+
+    @staticmethod
+    def _tokenize(messages: List[Dict[str, str]]) -> List[str]:
+        return [t for m in messages for t in (m["role"], *m["content"].split())]
+
+    def _prefill(
+        self, messages: List[Dict[str, str]], session_id: Optional[str] = None
+    ) -> int:
+        tokens = self._tokenize(messages)
+        n = 0
+        while n < len(messages) and messages[n]["role"] == "system":
+            n += 1
+        head = tuple(self._tokenize(messages[: n + 1]))
+
+        previous = []
+        with self._lock:
+            if session_id is not None:
+                previous = self._prompts.get(session_id, [])
+                self._prompts[session_id] = tokens
+            common = len(head) if head in self._heads else 0
+            self._heads.add(head)
+
+        for i, (a, b) in enumerate(zip(previous, tokens)):
+            if a != b:
+                break
+            common = max(common, i + 1)
+        return len(tokens) - common
+
+    def _decode_ms(self, num_tokens: int, width: int) -> float:
+        return num_tokens * self.decode_ms * (1 + self.batch_scaling * (width - 1))
+
+    def _texts(self, tokens: List[str], n: int, num_tokens: int) -> List[str]:
+        texts = []
+        for i in range(n):
+            digest = hashlib.sha256(f"{i} {' '.join(tokens)}".encode("utf-8"))
+            words = [
+                self.vocabulary[b % len(self.vocabulary)]
+                for b in digest.digest()[:num_tokens]
+            ]
+            texts.append(" ".join(words).capitalize() + "?")
+        return texts
+
+    def _sampling(self, kwargs: Dict) -> Tuple[int, int, int]:
+        n = kwargs.get("num_return_sequences", kwargs.get("n", 1))
+        max_tokens = kwargs.get("max_new_tokens", kwargs.get("max_completion_tokens"))
+        num_tokens = min(max_tokens or self.output_tokens, self.output_tokens)
+        return n, num_tokens, max(n, kwargs.get("num_beams", 1))
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        tokens = self._tokenize(messages)
+        n, num_tokens, width = self._sampling(kwargs)
+        time.sleep(
+            (
+                self._prefill(messages, session_id) * self.prefill_ms
+                + self._decode_ms(num_tokens, width)
+            )
+            / 1000
+        )
+        metrics.GENERATED_TOKENS.inc(n * num_tokens, model=str(self))
+        return self._texts(tokens, n, num_tokens)
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        prompts = [self._tokenize(m) for m in messages]
+        prefill = sum(len(tokens) for tokens in prompts)
+        return self._batch(prompts, prefill, kwargs)
+
+    def batch_generate_sessions(
+        self,
+        messages: List[List[Dict[str, str]]],
+        session_ids: List[Optional[str]],
+        **kwargs,
+    ) -> List[str]:
+        prompts = [self._tokenize(m) for m in messages]
+        prefill = sum(self._prefill(m, s) for m, s in zip(messages, session_ids))
+        return self._batch(prompts, prefill, kwargs)
+
+    def _batch(self, prompts: List[List[str]], prefill: int, kwargs: Dict) -> List[str]:
+        n, num_tokens, width = self._sampling(kwargs)
+        time.sleep(
+            (
+                prefill * self.prefill_ms
+                + self._decode_ms(num_tokens, width * len(prompts))
+            )
+            / 1000
+        )
+        metrics.GENERATED_TOKENS.inc(len(prompts) * n * num_tokens, model=str(self))
+        return [
+            text for tokens in prompts for text in self._texts(tokens, n, num_tokens)
+        ]
+
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        tokens = self._tokenize(messages)
+        time.sleep(len(tokens) * self.prefill_ms / 1000)
+        digest = hashlib.sha256(" ".join(tokens).encode("utf-8")).digest()
+        best = digest[0] % len(choices)
+        return [1.0 if i == best else 0.0 for i in range(len(choices))]
+
+    def release_session(self, session_id: str):
+        with self._lock:
+            self._prompts.pop(session_id, None)
+
+
+# backend name -> function that creates the model from the llm configuration
+LLM_BACKENDS: Dict[str, Callable[[Dict[str, Any]], LLM]] = {}
+
+
+def register_backend(name: str):
+    """
+    Register a function that creates a model for the given backend name.
+
+    :param name: Name of the backend in the configuration.
+    :return: Decorator of the factory function.
+    """
+
+    def decorator(factory: Callable[[Dict[str, Any]], LLM]):
+        LLM_BACKENDS[name] = factory
+        return factory
+
+    return decorator
+
+
+def create_llm(conf: Dict[str, Any]) -> LLM:
+    """
+    Create the simulator model with the backend selected in the configuration.
+    Deterministic calls are cached if ``simulation.generation_cache`` is enabled.
+
+    :param conf: The ``simulation.llm`` configuration.
+    :return: Model of the backend.
+    """
+    backend = conf["backend"]
+    if backend not in LLM_BACKENDS:
+        raise ValueError(
+            f"Unknown LLM backend '{backend}'. Choose one of {list(LLM_BACKENDS)}."
+        )
+    llm = LLM_BACKENDS[backend](conf)
+
+    cache_conf = config.CONFIG["simulation"].get("generation_cache", {})
+    if cache_conf.get("max_size", 0) > 0:
+        # imported here since the cache module depends on this one
+        from simulation.generation_cache import CachedLLM, GenerationCache
+
+        llm = CachedLLM(
+            llm,
+            GenerationCache(
+                cache_conf["max_size"],
+                cache_conf.get("path", None),
+                cache_conf.get("max_rows", None),
+            ),
+        )
+    return llm
+
+
+@register_backend("transformers")
+def _create_transformers_model(conf: Dict[str, Any]) -> LLM:
+    return BatchedLLM(
+        HFModelQuantized(LLMVersion(conf["model"]), Precision(conf["quantization"])),
+        config.CONFIG["simulation"]["batching"]["max_batch_size"],
+        config.CONFIG["simulation"]["batching"]["max_wait"] / 1000,
+    )
+
+
+@register_backend("vllm")
+def _create_vllm_model(conf: Dict[str, Any]) -> LLM:
+    return VLLMModel(conf["model"], **conf.get("engine_args", {}))
+
+
+@register_backend("openai-compatible")
+def _create_openai_compatible_model(conf: Dict[str, Any]) -> LLM:
+    return OpenAICompatibleModel(
+        conf["base_url"], conf["model"], os.getenv("LLM_API_KEY", "EMPTY")
+    )
+
+
+@register_backend("fake")
+def _create_fake_model(conf: Dict[str, Any]) -> LLM:
+    return BatchedLLM(
+        FakeLLM(**conf.get("fake_profile", {})),
+        config.CONFIG["simulation"]["batching"]["max_batch_size"],
+        config.CONFIG["simulation"]["batching"]["max_wait"] / 1000,
+    )
@@ -1,25 +1,95 @@
 import abc
 import copy
+import dataclasses
 import json
 import logging
+import threading
 import uuid
 from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional
-
-import torch
-from sentence_transformers import SentenceTransformer
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 import config
-from shared_task.sessions import Session
+import metrics
+from shared_task.sessions import Session, SessionManager
 from shared_task.topic import Topic
 
-from simulation.llm import (
-    HFModelQuantized,
-    LLMVersion,
-    Precision,
-    OpenAIModelVersion,
-    OpenAIModel,
-)
+# opening of the assistant that each simulated conversation starts with
+_OPENING = {"role": "user", "content": "How can I help you?"}
+
+
+def _conversation(
+    system_prompt: str,
+    history: List[Dict[str, str]],
+    instruction: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Build the prompt of a simulator from the role-swapped history of a session.
+
+    The history is not copied, only the last message if an instruction is
+    appended to it, so the messages must not be modified.
+
+    :param system_prompt: System prompt of the persona for the session's topic.
+    :param history: Role-swapped history of the session, empty before the first
+        utterance.
+    :param instruction: Instruction appended to the last message.
+    :return: Messages for the model.
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        _OPENING,
+        *history,
+    ]
+    if instruction is not None:
+        messages[-1] = {
+            "role": messages[-1]["role"],
+            "content": messages[-1]["content"] + instruction,
+        }
+
+    return messages
+
+
+# Models are loaded on first use or warm-up. The ML stack is imported there as
+# well, since importing it takes seconds and the dummy task does not need it.
+_models_lock = threading.Lock()
+
+
+def _load_llm():
+    with _models_lock:
+        if PlanningBasedUserSimulator.llm is None:
+            from simulation.llm import create_llm
+
+            llm = create_llm(config.CONFIG["simulation"]["llm"])
+            SessionManager().add_termination_callback(
+                lambda session: llm.release_session(session.id)
+            )
+            # both simulators share the model
+            PlanningBasedUserSimulator.llm = llm
+            UnrestrictedUserSimulator.llm = llm
+
+
+def _load_openai_llm():
+    with _models_lock:
+        if OpenAIPlanningBasedUserSimulator.llm is None:
+            from simulation.llm import OpenAIModel, OpenAIModelVersion
+
+            llm = OpenAIModel(OpenAIModelVersion.GPT_4_1)
+            OpenAIPlanningBasedUserSimulator.llm = llm
+            OpenAIUnrestrictedUserSimulator.llm = llm
+
+
+def _load_sentence_encoder():
+    with _models_lock:
+        if PlanningBasedUserSimulator.st_model is None:
+            from simulation.embeddings import EmbeddingCache, create_sentence_encoder
+
+            name = config.CONFIG["simulation"]["sentence_encoder"]
+            PlanningBasedUserSimulator.st_model = create_sentence_encoder(name)
+            PlanningBasedUserSimulator.rubric_embeddings = EmbeddingCache(
+                PlanningBasedUserSimulator.st_model,
+                name,
+                config.CONFIG["simulation"]["embedding_cache_dir"],
+            )
 
 
 @dataclass
@@ -31,13 +101,93 @@ class UserUtterance:
     meta: Dict[str, Any] = field(default_factory=dict)
 
 
+class Persona:
+    """
+    Immutable profile of a simulated user with its PTKB, rubrics per topic, and
+    the system prompts per topic formatted once at creation.
+
+    A persona is shared by all user pools of a shared task, so that memory scales
+    with the number of personas and not with the number of pools.
+    """
+
+    __slots__ = ("id", "ptkb", "rubrics", "system_prompts")
+
+    id: str
+    ptkb: Tuple[str, ...]
+    rubrics: Mapping[str, Tuple[str, ...]]
+    system_prompts: Mapping[str, str]
+
+    def __init__(
+        self,
+        _id: str,
+        ptkb: List[str],
+        rubrics: Dict[str, List[str]],
+        system_prompts: Dict[str, str],
+    ):
+        object.__setattr__(self, "id", _id)
+        object.__setattr__(self, "ptkb", tuple(ptkb))
+        object.__setattr__(
+            self,
+            "rubrics",
+            MappingProxyType({k: tuple(v) for k, v in rubrics.items()}),
+        )
+        object.__setattr__(self, "system_prompts", MappingProxyType(system_prompts))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(id={self.id!r})"
+
+    @classmethod
+    def create(
+        cls,
+        _id: str,
+        topics: Dict[str, Topic],
+        rubrics: Dict[str, List[str]],
+        ptkb: List[str],
+        base_prompt: str,
+    ) -> "Persona":
+        """
+        Create a persona and format its system prompts.
+
+        :param _id: ID of the persona.
+        :param topics: Topics of the shared task.
+        :param rubrics: Rubric questions per topic ID.
+        :param ptkb: Personal text knowledge base, i.e., properties of the persona.
+        :param base_prompt: System prompt template of the simulator with the
+            placeholders "topic" and "property_list".
+        :return: New persona.
+        """
+        property_list = "\n- ".join(ptkb)
+        system_prompts = {
+            topic_id: base_prompt.format(
+                topic=topics[topic_id].title.lower(), property_list=property_list
+            )
+            for topic_id in rubrics
+            if topic_id in topics
+        }
+        return cls(_id, ptkb, rubrics, system_prompts)
+
+
 class User(metaclass=abc.ABCMeta):
+    __slots__ = ("id", "topics", "openings")
+
+    logger: logging.Logger
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # one logger per simulator class instead of one per user
+        cls.logger = logging.getLogger(cls.__name__)
 
     def __init__(self, _id, topics: Dict[str, Topic]):
-        self.logger = logging.getLogger(self.__class__.__name__)
-        self.logger.setLevel(logging.DEBUG)
         self.id = _id
         self.topics = topics
+        # topic id -> precomputed first utterance
+        self.openings: Dict[str, UserUtterance] = {}
 
     @abc.abstractmethod
     def initiate(self, session: Session) -> UserUtterance:
@@ -47,15 +197,108 @@ class User(metaclass=abc.ABCMeta):
     def respond(self, session: Session) -> UserUtterance:
         pass
 
+    def generate(
+        self, messages: List[Dict[str, Any]], session_id: Optional[str] = None, **kwargs
+    ) -> List[str]:
+        """
+        Generate with the model of the user simulator and measure how long it takes.
+
+        :param messages: Conversation to continue.
+        :param session_id: ID of the session, to reuse its cached prompt.
+        :param kwargs: Arguments of the generation.
+        :return: Generated texts.
+        """
+        with metrics.stage("generate"):
+            return self.llm.generate(messages, session_id, **kwargs)
+
+    def warm_up(self):
+        """
+        Load what the user needs to respond, e.g., models. Otherwise, it is loaded
+        on first use.
+
+        :return: None
+        """
+
+    def opening_prompts(self) -> Dict[str, List[Dict[str, str]]]:
+        """
+        Prompts of the first utterance on each topic of the user that do not depend
+        on the session, so that the utterances can be precomputed.
+
+        :return: Messages for the model per topic ID.
+        """
+        return {}
+
+    @abc.abstractmethod
+    def select_opening(self, topic_id: str, responses: List[str]) -> UserUtterance:
+        """
+        Pick the first utterance on a topic from the generated candidates.
+
+        :param topic_id: ID of the topic.
+        :param responses: Generated candidates for the opening prompt of the topic.
+        :return: The first utterance.
+        """
+
+    def precomputed_opening(self, session: Session) -> Optional[UserUtterance]:
+        """
+        Returns the precomputed first utterance of a new session.
+
+        :param session: Session without utterances.
+        :return: The utterance or None if it was not precomputed.
+        """
+        opening = self.openings.get(session.topic_id, None)
+        if opening is None or len(session.history) > 0:
+            return None
+
+        return dataclasses.replace(opening, meta=copy.deepcopy(opening.meta))
+
+    @classmethod
+    def precompute_openings(
+        cls,
+        users: List["User"],
+        batch_size: int,
+        progress: Optional[Callable[[int], None]] = None,
+    ):
+        """
+        Generate the first utterances of users of this class in batches, so that
+        sessions start with a lookup instead of a generation.
+
+        :param users: Users of this class.
+        :param batch_size: Number of prompts per batch.
+        :param progress: Called with the number of utterances of each batch.
+        :return: None
+        """
+        prompts = [
+            (user, topic_id, messages)
+            for user in users
+            for topic_id, messages in user.opening_prompts().items()
+        ]
+        for i in range(0, len(prompts), batch_size):
+            batch = prompts[i : i + batch_size]
+            # only simulators have opening prompts, and with them a model
+            texts = cls.llm.batch_generate([b[2] for b in batch], **cls.gen_kwargs)
+            n = len(texts) // len(batch)
+            for j, (user, topic_id, _) in enumerate(batch):
+                user.openings[topic_id] = user.select_opening(
+                    topic_id, texts[j * n : (j + 1) * n]
+                )
+
+            if progress is not None:
+                progress(len(batch))
+
 
 class DummyUser(User):
+    __slots__ = ()
 
-    def __init__(self, topics: Dict[str, Topic]):
-        super().__init__(uuid.uuid4().hex, topics)
+    def __init__(self, topics: Dict[str, Topic], _id: Optional[str] = None):
+        super().__init__(_id if _id is not None else uuid.uuid4().hex, topics)
 
     def initiate(self, session: Session) -> UserUtterance:
+        return self.select_opening(session.topic_id, [])
+
+    def select_opening(self, topic_id: str, responses: List[str]) -> UserUtterance:
+        # there are no opening prompts, the topic title is the first utterance
         return UserUtterance(
-            content=self.topics[session.topic_id].title,
+            content=self.topics[topic_id].title,
             end_of_session=False,
         )
 
@@ -68,8 +311,11 @@ class DummyUser(User):
 
 
 class PlanningBasedUserSimulator(User):
+    __slots__ = ("persona",)
+
     llm = None
     st_model = None
+    rubric_embeddings = None
 
     base_prompt = (
         'You are a user of a search system and are interested in "{topic}". '
@@ -103,84 +349,81 @@ class PlanningBasedUserSimulator(User):
         "Context: {answer}"
     )
 
-    rubric_score_gen_kwargs = {
-        "do_sample": False,
-        "max_new_tokens": 1,
-        "top_p": None,
-        "top_k": None,
-    }
-
-    def __init__(
-        self,
-        _id,
-        topics: Dict[str, Topic],
-        rubrics: Dict[str, List[str]],
-        ptkb: List[str],
-    ):
-        super().__init__(_id, topics)
-        self.rubrics = rubrics
-        self.ptkb = ptkb
+    rubric_scores = ["0", "1", "2", "3", "4", "5"]
 
-        if PlanningBasedUserSimulator.llm is None:
-            PlanningBasedUserSimulator.llm = HFModelQuantized(
-                LLMVersion.Gemma_3_4B_IT, quantization=Precision.NF4
-            )
+    def __init__(self, persona: Persona, topics: Dict[str, Topic]):
+        super().__init__(persona.id, topics)
+        self.persona = persona
 
-        if PlanningBasedUserSimulator.st_model is None:
-            PlanningBasedUserSimulator.st_model = SentenceTransformer(
-                "all-mpnet-base-v2"
-            )
+    @property
+    def rubrics(self) -> Mapping[str, Tuple[str, ...]]:
+        return self.persona.rubrics
 
-    def initiate(self, session: Session) -> UserUtterance:
-        topic = self.topics[session.topic_id]
-        rubrics = self.rubrics[session.topic_id]
-        next_rubric = rubrics[0]
-        self.logger.debug(f"Next rubric question: {next_rubric}.")
+    @property
+    def ptkb(self) -> Tuple[str, ...]:
+        return self.persona.ptkb
 
-        init_system_prompt = self.base_prompt.format(
-            topic=topic.title.lower(), property_list="\n- ".join(self.ptkb)
+    def warm_up(self):
+        _load_llm()
+        _load_sentence_encoder()
+        # rubrics are fixed, so only the response candidates are encoded per turn
+        self.rubric_embeddings.precompute(
+            [rubric for rubrics in self.rubrics.values() for rubric in rubrics]
         )
 
-        messages = [
-            {
-                "role": "system",
-                "content": init_system_prompt
-                + f'\n\nExplore the following question:\n"{next_rubric}"',
-            },
-            {"role": "user", "content": f"How may I help you?"},
-        ]
+    def opening_prompts(self) -> Dict[str, List[Dict[str, str]]]:
+        if self.gen_kwargs.get("do_sample", None) is not False:
+            # sampled utterances differ between sessions
+            return {}
+
+        return {
+            topic_id: self._opening_prompt(topic_id)
+            for topic_id in self.persona.system_prompts
+        }
+
+    def _opening_prompt(self, topic_id: str) -> List[Dict[str, str]]:
+        # instructions are appended to the last message to keep the prompt prefix
+        # of the session stable across turns
+        return _conversation(
+            self.persona.system_prompts[topic_id],
+            [],
+            f'\n\nExplore the following question:\n"{self.rubrics[topic_id][0]}"',
+        )
 
-        best_response = self.conditional_response_generation(messages, next_rubric)
+    def select_opening(self, topic_id: str, responses: List[str]) -> UserUtterance:
+        next_rubric = self.rubrics[topic_id][0]
         return UserUtterance(
-            best_response,
+            self.best_response(responses, next_rubric),
             False,
             {"rubric": next_rubric},
         )
 
+    def initiate(self, session: Session) -> UserUtterance:
+        opening = self.precomputed_opening(session)
+        if opening is not None:
+            return opening
+
+        self.warm_up()
+        self.logger.debug(
+            "Next rubric question: %s.", self.rubrics[session.topic_id][0]
+        )
+        messages = self._opening_prompt(session.topic_id)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Generate: %s", json.dumps(messages))
+        responses = self.generate(messages, session.id, **self.gen_kwargs)
+        return self.select_opening(session.topic_id, responses)
+
     def respond(self, session: Session) -> UserUtterance:
-        topic = self.topics[session.topic_id]
+        self.warm_up()
+        system_prompt = self.persona.system_prompts[session.topic_id]
 
         assistant_response = session.history[-1]["content"]
-        self.logger.debug(f"Assistant response: {assistant_response}")
-        init_system_prompt = self.base_prompt.format(
-            topic=topic.title.lower(), property_list="\n- ".join(self.ptkb)
-        )
+        self.logger.debug("Assistant response: %s", assistant_response)
 
-        new_messages = copy.deepcopy(session.history)
-        for m in new_messages:
-            if m["role"] == "user":
-                m["role"] = "assistant"
-            elif m["role"] == "assistant":
-                m["role"] = "user"
-
-        new_messages = [
-            {"role": "system", "content": init_system_prompt},
-            {"role": "user", "content": "How can I help you?"},
-            *new_messages,
-        ]
-        rubric_score = self.get_rubric_score(
-            session.user_meta[-1]["rubric"], assistant_response
-        )
+        with metrics.stage("rubric_score"):
+            rubric_score = self.get_rubric_score(
+                session.user_meta[-1]["rubric"], assistant_response
+            )
         rubric_history = [m["rubric"] for m in session.user_meta]
         if (
             rubric_score is not None
@@ -190,16 +433,16 @@ class PlanningBasedUserSimulator(User):
             next_rubric = self.select_next_rubric(session.topic_id, rubric_history)
 
             if next_rubric is None:
-                new_messages[0][
-                    "content"
-                ] = f"You gathered all necessary information. Say thank you and farewell."
-                response = self.llm.generate(new_messages)[0]
+                messages = _conversation(
+                    system_prompt,
+                    session.simulator_history,
+                    "\n\nYou gathered all necessary information. Say thank you and farewell.",
+                )
+                response = self.generate(messages, session.id)[0]
 
                 return UserUtterance(response, True, {"rubric_score": rubric_score})
 
-            new_messages[0][
-                "content"
-            ] += f'\n\nYou are satisfied with the last given answer. Now, explore the following question "{next_rubric}".'
+            instruction = f'\n\nYou are satisfied with the last given answer. Now, explore the following question "{next_rubric}".'
         else:
             # Answer was not satisfactory or grading failed
             if (
@@ -209,38 +452,38 @@ class PlanningBasedUserSimulator(User):
                 next_rubric = self.select_next_rubric(session.topic_id, rubric_history)
 
                 if next_rubric is None:
-                    new_messages[0][
-                        "content"
-                    ] = "You gathered all necessary information. Say thank you and farewell."
-                    response = self.llm.generate(new_messages)[0]
+                    messages = _conversation(
+                        system_prompt,
+                        session.simulator_history,
+                        "\n\nYou gathered all necessary information. Say thank you and farewell.",
+                    )
+                    response = self.generate(messages, session.id)[0]
 
                     return UserUtterance(response, True, {"rubric_score": rubric_score})
 
-                new_messages[0][
-                    "content"
-                ] += f'\n\nThe last given answer was not helpful but you continue anyway. Now explore the following question "{next_rubric}".'
+                instruction = f'\n\nThe last given answer was not helpful but you continue anyway. Now explore the following question "{next_rubric}".'
 
             else:
                 if rubric_score is None:
                     # Grading failed
-                    new_messages[0][
-                        "content"
-                    ] += f"\n\nYou did not fully understand the answer. Ask for clarification on the last response."
+                    instruction = "\n\nYou did not fully understand the answer. Ask for clarification on the last response."
                 else:
                     # Answer was not satisfactory and maximum attempts is not reached
-                    new_messages[0][
-                        "content"
-                    ] += f'\n\nThe last given answer was not helpful. Inform the system about that. Ask more specifically about the following question "{rubric_history[-1]}".'
+                    instruction = f'\n\nThe last given answer was not helpful. Inform the system about that. Ask more specifically about the following question "{rubric_history[-1]}".'
 
                 next_rubric = rubric_history[-1]
 
-        best_response = self.conditional_response_generation(new_messages, next_rubric)
+        best_response = self.conditional_response_generation(
+            _conversation(system_prompt, session.simulator_history, instruction),
+            next_rubric,
+            session.id,
+        )
         return UserUtterance(
             best_response, False, {"rubric_score": rubric_score, "rubric": next_rubric}
         )
 
     def get_rubric_score(self, rubric: str, response: str) -> Optional[int]:
-        rating = self.llm.generate(
+        probabilities = self.llm.score_choices(
             [
                 {
                     "role": "user",
@@ -249,16 +492,12 @@ class PlanningBasedUserSimulator(User):
                     ),
                 }
             ],
-            **self.rubric_score_gen_kwargs,
-        )[0]
-
-        self.logger.debug(f"Answer rating: {rating}")
-        try:
-            rating = int(rating)
-        except ValueError:
-            return None
+            self.rubric_scores,
+        )
 
-        return rating
+        self.logger.debug("Answer rating probabilities: %s", probabilities)
+        best = max(range(len(probabilities)), key=lambda i: probabilities[i])
+        return int(self.rubric_scores[best])
 
     def select_next_rubric(
         self, topic_id: str, rubric_history: List[str]
@@ -270,27 +509,44 @@ class PlanningBasedUserSimulator(User):
 
         # choice = random.choice(open_subtopics)
         choice = open_subtopics[0]
-        self.logger.debug(f"Next subtopic: {choice}")
+        self.logger.debug("Next subtopic: %s", choice)
         return choice
 
     def conditional_response_generation(
-        self, messages: List[Dict[str, Any]], subtopic: str
+        self,
+        messages: List[Dict[str, Any]],
+        subtopic: str,
+        session_id: Optional[str] = None,
     ) -> str:
-        self.logger.debug(f"Generate: {json.dumps(messages)}")
-        responses = self.llm.generate(messages, **self.gen_kwargs)
-        self.logger.debug(f"Response candidates: {responses}")
-
-        texts = [subtopic, *responses]
-        encodings = self.st_model.encode(texts, show_progress_bar=False)
-        similarities = self.st_model.similarity(encodings, encodings)
-        indices = torch.argsort(similarities, dim=1, descending=True)
-        best_response = responses[indices[0][1] - 1]
-        self.logger.debug(f"Best response: {best_response}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Generate: %s", json.dumps(messages))
+        responses = self.generate(messages, session_id, **self.gen_kwargs)
+        return self.best_response(responses, subtopic)
+
+    def best_response(self, responses: List[str], subtopic: str) -> str:
+        """
+        Pick the response candidate that is most similar to a subtopic.
+
+        :param responses: Generated response candidates.
+        :param subtopic: Rubric question that the response should explore.
+        :return: The best candidate.
+        """
+        self.logger.debug("Response candidates: %s", responses)
+
+        with metrics.stage("encode"):
+            encodings = self.st_model.encode(responses, show_progress_bar=False)
+        similarities = self.st_model.similarity(
+            self.rubric_embeddings.get(subtopic)[None], encodings
+        )
+        best_response = responses[int(similarities[0].argmax())]
+        self.logger.debug("Best response: %s", best_response)
 
         return best_response
 
 
 class UnrestrictedUserSimulator(User):
+    __slots__ = ("persona",)
+
     llm = None
 
     base_prompt = (
@@ -313,94 +569,96 @@ class UnrestrictedUserSimulator(User):
         "top_p": None,
     }
 
-    def __init__(
-        self,
-        _id,
-        topics: Dict[str, Topic],
-        rubrics: Dict[str, List[str]],
-        ptkb: List[str],
-    ):
-        super().__init__(_id, topics)
-        self.rubrics = rubrics
-        self.ptkb = ptkb
+    def __init__(self, persona: Persona, topics: Dict[str, Topic]):
+        super().__init__(persona.id, topics)
+        self.persona = persona
 
-        if PlanningBasedUserSimulator.llm is None:
-            PlanningBasedUserSimulator.llm = HFModelQuantized(
-                LLMVersion.Gemma_3_4B_IT, quantization=Precision.NF4
-            )
+    @property
+    def rubrics(self) -> Mapping[str, Tuple[str, ...]]:
+        return self.persona.rubrics
 
-        if PlanningBasedUserSimulator.st_model is None:
-            PlanningBasedUserSimulator.st_model = SentenceTransformer(
-                "all-mpnet-base-v2"
-            )
+    @property
+    def ptkb(self) -> Tuple[str, ...]:
+        return self.persona.ptkb
 
-    def initiate(self, session: Session) -> UserUtterance:
-        topic = self.topics[session.topic_id]
+    def warm_up(self):
+        _load_llm()
 
-        init_system_prompt = self.base_prompt.format(
-            topic=topic.title.lower(), property_list="\n- ".join(self.ptkb)
-        )
+    def opening_prompts(self) -> Dict[str, List[Dict[str, str]]]:
+        if self.gen_kwargs.get("do_sample", None) is not False:
+            # sampled utterances differ between sessions
+            return {}
 
-        messages = [
-            {"role": "system", "content": init_system_prompt},
-            {"role": "user", "content": f"How may I help you?"},
-        ]
+        return {
+            topic_id: _conversation(system_prompt, [])
+            for topic_id, system_prompt in self.persona.system_prompts.items()
+        }
+
+    def select_opening(self, topic_id: str, responses: List[str]) -> UserUtterance:
+        return UserUtterance(self.best_response(responses), False)
+
+    def initiate(self, session: Session) -> UserUtterance:
+        opening = self.precomputed_opening(session)
+        if opening is not None:
+            return opening
+
+        self.warm_up()
+        messages = _conversation(self.persona.system_prompts[session.topic_id], [])
 
-        best_response = self.conditional_response_generation(messages)
+        best_response = self.conditional_response_generation(messages, session.id)
         return UserUtterance(best_response, False)
 
     def respond(self, session: Session) -> UserUtterance:
-        topic = self.topics[session.topic_id]
+        self.warm_up()
+        system_prompt = self.persona.system_prompts[session.topic_id]
 
         assistant_response = session.history[-1]["content"]
-        self.logger.debug(f"Assistant response: {assistant_response}")
-        init_system_prompt = self.base_prompt.format(
-            topic=topic.title.lower(), property_list="\n- ".join(self.ptkb)
-        )
-
-        new_messages = copy.deepcopy(session.history)
-        for m in new_messages:
-            if m["role"] == "user":
-                m["role"] = "assistant"
-            elif m["role"] == "assistant":
-                m["role"] = "user"
+        self.logger.debug("Assistant response: %s", assistant_response)
 
-        num_user_messages = len([m for m in new_messages if m["role"] == "user"])
+        # the history alternates between the simulator and the assistant, so
+        # half of it are the assistant's responses, i.e., user messages
+        num_user_messages = len(session.simulator_history) // 2
         if num_user_messages >= len(self.rubrics[session.topic_id]):
-            new_messages = [
-                {"role": "system", "content": init_system_prompt},
-                {"role": "user", "content": "How can I help you?"},
-                *new_messages,
-            ]
-
-            new_messages[0][
-                "content"
-            ] = f"You gathered all necessary information. Say thank you and farewell."
-            response = self.llm.generate(new_messages)[0]
+            messages = _conversation(
+                system_prompt,
+                session.simulator_history,
+                "\n\nYou gathered all necessary information. Say thank you and farewell.",
+            )
+            response = self.generate(messages, session.id)[0]
 
             return UserUtterance(response, True)
 
-        new_messages = [
-            {"role": "system", "content": init_system_prompt},
-            {"role": "user", "content": "How can I help you?"},
-            *new_messages,
-        ]
-
-        best_response = self.conditional_response_generation(new_messages)
+        best_response = self.conditional_response_generation(
+            _conversation(system_prompt, session.simulator_history), session.id
+        )
         return UserUtterance(best_response, False)
 
-    def conditional_response_generation(self, messages: List[Dict[str, Any]]) -> str:
-        self.logger.debug(f"Generate: {json.dumps(messages)}")
-        responses = self.llm.generate(messages, **self.gen_kwargs)
-        self.logger.debug(f"Response candidates: {responses}")
+    def conditional_response_generation(
+        self, messages: List[Dict[str, Any]], session_id: Optional[str] = None
+    ) -> str:
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Generate: %s", json.dumps(messages))
+        responses = self.generate(messages, session_id, **self.gen_kwargs)
+        return self.best_response(responses)
+
+    def best_response(self, responses: List[str]) -> str:
+        """
+        Pick the best response candidate, i.e., the most likely one.
+
+        :param responses: Generated response candidates.
+        :return: The best candidate.
+        """
+        self.logger.debug("Response candidates: %s", responses)
 
         best_response = responses[0]
-        self.logger.debug(f"Best response: {best_response}")
+        self.logger.debug("Best response: %s", best_response)
 
         return best_response
 
 
 class OpenAIPlanningBasedUserSimulator(PlanningBasedUserSimulator):
+    __slots__ = ()
+
     llm = None
 
     base_prompt = (
@@ -432,27 +690,39 @@ class OpenAIPlanningBasedUserSimulator(PlanningBasedUserSimulator):
 
     rubric_score_gen_kwargs = {"max_completion_tokens": 1, "n": 1}
 
-    def __init__(
-        self,
-        _id,
-        topics: Dict[str, Topic],
-        rubrics: Dict[str, List[str]],
-        ptkb: List[str],
-    ):
-        super().__init__(_id, topics, rubrics, ptkb)
+    def warm_up(self):
+        _load_openai_llm()
+        _load_sentence_encoder()
+        self.rubric_embeddings.precompute(
+            [rubric for rubrics in self.rubrics.values() for rubric in rubrics]
+        )
 
-        if OpenAIPlanningBasedUserSimulator.llm is None:
-            OpenAIPlanningBasedUserSimulator.llm = OpenAIModel(
-                OpenAIModelVersion.GPT_4_1
-            )
+    def get_rubric_score(self, rubric: str, response: str) -> Optional[int]:
+        # the API does not expose the logits of arbitrary tokens, so generate instead
+        rating = self.llm.generate(
+            [
+                {
+                    "role": "user",
+                    "content": self.rubric_score_prompt.format(
+                        answer=response, subtopic=rubric
+                    ),
+                }
+            ],
+            **self.rubric_score_gen_kwargs,
+        )[0]
 
-        if OpenAIPlanningBasedUserSimulator.st_model is None:
-            OpenAIPlanningBasedUserSimulator.st_model = SentenceTransformer(
-                "all-mpnet-base-v2"
-            )
+        self.logger.debug("Answer rating: %s", rating)
+        try:
+            rating = int(rating)
+        except ValueError:
+            return None
+
+        return rating
 
 
 class OpenAIUnrestrictedUserSimulator(UnrestrictedUserSimulator):
+    __slots__ = ()
+
     llm = None
 
     base_prompt = (
@@ -469,16 +739,5 @@ class OpenAIUnrestrictedUserSimulator(UnrestrictedUserSimulator):
 
     gen_kwargs = {"max_completion_tokens": 128, "n": 5}
 
-    def __init__(
-        self,
-        _id,
-        topics: Dict[str, Topic],
-        rubrics: Dict[str, List[str]],
-        ptkb: List[str],
-    ):
-        super().__init__(_id, topics, rubrics, ptkb)
-
-        if OpenAIPlanningBasedUserSimulator.llm is None:
-            OpenAIPlanningBasedUserSimulator.llm = OpenAIModel(
-                OpenAIModelVersion.GPT_4_1
-            )
+    def warm_up(self):
+        _load_openai_llm()
@@ -0,0 +1,183 @@
+"""
+Module for shared access to the Sqlite3 database of a shared task.
+"""
+
+import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, Optional
+
+from config import CONFIG, DATABASE_DIR
+
+
+def get_db_path(shared_task: Optional[str] = None) -> str:
+    """
+    Returns the path of the database file of a shared task.
+
+    :param shared_task: Name of the shared task. Defaults to the active shared task.
+    :return: Path to the Sqlite3 database file.
+    """
+    if shared_task is None:
+        # imported here since shared task modules depend on the storage layer
+        from shared_task.shared_task import SharedTaskManager
+
+        shared_task = SharedTaskManager().active_task.name
+
+    return os.path.join(DATABASE_DIR, f"{shared_task}.db")
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """Raised if no connection of a pool became free in time."""
+
+
+class ConnectionPool:
+    """
+    Pool of long-lived Sqlite3 connections to the database of a shared task.
+    There is exactly one pool per database file.
+
+    Connections run in WAL mode so that readers do not block the single writer.
+    Every connection keeps a cache of prepared statements, so SQL strings
+    should be passed with parameters instead of formatting values into them.
+    """
+
+    _instances: Dict[str, "ConnectionPool"] = {}
+    _instances_lock = Lock()
+
+    def __new__(cls, db_path: Optional[str] = None):
+        if db_path is None:
+            db_path = get_db_path()
+
+        with ConnectionPool._instances_lock:
+            if db_path not in cls._instances:
+                instance = super(ConnectionPool, cls).__new__(cls)
+                instance.db_path = db_path
+                instance.size = CONFIG["storage"]["pool_size"]
+                instance._idle = queue.LifoQueue()
+                instance._num_connections = 0
+                instance._lock = Lock()
+                instance._stats = {
+                    "acquire_waits": 0,
+                    "acquire_wait_time": 0.0,
+                    "acquire_timeouts": 0,
+                    "transactions": 0,
+                    "transaction_time": 0.0,
+                    "lock_timeouts": 0,
+                }
+                cls._instances[db_path] = instance
+
+            return cls._instances[db_path]
+
+    def _connect(self) -> sqlite3.Connection:
+        conf = CONFIG["storage"]
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=conf["busy_timeout"] / 1000,
+            check_same_thread=False,
+            cached_statements=conf["cached_statements"],
+        )
+        _ = conn.execute("PRAGMA journal_mode=WAL;")
+        _ = conn.execute("PRAGMA synchronous=NORMAL;")
+        _ = conn.execute("PRAGMA temp_store=MEMORY;")
+        _ = conn.execute(f"PRAGMA mmap_size={int(conf['mmap_size'])};")
+        # negative values are interpreted as KiB instead of pages
+        _ = conn.execute(f"PRAGMA cache_size=-{int(conf['cache_size'])};")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._num_connections < self.size:
+                self._num_connections += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._num_connections -= 1
+                raise
+
+        # a thread that holds a connection and asks for another one would wait
+        # forever once all connections are checked out
+        timeout = CONFIG["storage"]["acquire_timeout"] / 1000
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=timeout)
+        except queue.Empty as e:
+            with self._lock:
+                self._stats["acquire_timeouts"] += 1
+            raise PoolTimeoutError(
+                f"No connection of the {self.size} connections to {self.db_path} "
+                f"became free within {timeout:g}s."
+            ) from e
+        finally:
+            with self._lock:
+                self._stats["acquire_waits"] += 1
+                self._stats["acquire_wait_time"] += time.perf_counter() - start
+        return conn
+
+    def _release(self, conn: sqlite3.Connection):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrow a connection from the pool. Statements executed on the connection
+        form a single transaction that is committed when the context is left
+        without an error and rolled back otherwise.
+
+        :return: Context manager that yields a Sqlite3 connection.
+        """
+        conn = self._acquire()
+        start = time.perf_counter()
+        try:
+            with conn:
+                yield conn
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                with self._lock:
+                    self._stats["lock_timeouts"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats["transactions"] += 1
+                self._stats["transaction_time"] += time.perf_counter() - start
+            self._release(conn)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns counters of the pool: how often and how long callers waited for
+        a free connection and how often they gave up, the number and total
+        duration of transactions, which includes waiting for the write lock, and
+        how often the busy timeout expired.
+
+        :return: Dictionary of counters.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """
+        Close all idle connections of the pool.
+
+        :return: None
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            conn.close()
+            with self._lock:
+                self._num_connections -= 1
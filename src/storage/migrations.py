@@ -0,0 +1,196 @@
+"""
+Versioned schema migrations for databases created by older versions of Sim.API.
+
+The schema version of a database is stored in ``PRAGMA user_version``. Fresh
+databases are created from the schema file and start at the latest version.
+Existing databases run every migration above their version in order. Each
+migration runs in its own transaction together with the version update.
+"""
+
+import logging
+import sqlite3
+from typing import Callable, List
+
+
+def _add_team_token_digest(conn: sqlite3.Connection):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(teams);")]
+    if "token_digest" not in columns:
+        # digests of existing tokens are backfilled on their next authentication
+        _ = conn.execute("ALTER TABLE teams ADD COLUMN token_digest CHAR(64);")
+    _ = conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS teams_token_digest ON teams(token_digest);"
+    )
+
+    # digests cannot be computed from the bcrypt hashes, so unknown tokens are
+    # checked against all teams without a digest until each team authenticated
+    # once
+    cursor = conn.execute("SELECT COUNT(*) FROM teams WHERE token_digest IS NULL;")
+    num_legacy = cursor.fetchone()[0]
+    if num_legacy > 0:
+        logging.getLogger(__name__).warning(
+            "%d teams have no token digest yet. Unknown tokens are checked "
+            "against them with bcrypt until each of them authenticated once.",
+            num_legacy,
+        )
+
+
+def _index_requests(conn: sqlite3.Connection):
+    # the timestamp was the primary key, which requires to rebuild the table
+    _ = conn.execute("""
+        CREATE TABLE requests_new(
+            id              INTEGER PRIMARY KEY,
+            timestamp       DATETIME NOT NULL,
+            run_id          VARCHAR(256) NOT NULL,
+            team_id         VARCHAR(256) NOT NULL,
+            session_id      CHAR(36) NOT NULL,
+            topic_id        VARCHAR(20) NOT NULL,
+            user_id         CHAR(36) NOT NULL,
+            api             VARCHAR(10) NOT NULL,
+            user_utterance  TEXT NOT NULL,
+            user_meta       TEXT,
+            assistant_response        TEXT,
+            assistant_meta  TEXT,
+            assistant_citations       TEXT,
+
+
+            count_towards_credits BOOLEAN DEFAULT true,
+            FOREIGN KEY(run_id) REFERENCES runs(id),
+            FOREIGN KEY (team_id) REFERENCES teams(id)
+        );""")
+    _ = conn.execute("""
+        INSERT INTO requests_new(
+            timestamp, run_id, team_id, session_id, topic_id, user_id, api,
+            user_utterance, user_meta, assistant_response, assistant_meta,
+            assistant_citations, count_towards_credits)
+        SELECT
+            timestamp, run_id, team_id, session_id, topic_id, user_id, api,
+            user_utterance, user_meta, assistant_response, assistant_meta,
+            assistant_citations, count_towards_credits
+        FROM requests
+        ORDER BY timestamp;""")
+    _ = conn.execute("DROP TABLE requests;")
+    _ = conn.execute("ALTER TABLE requests_new RENAME TO requests;")
+    _ = conn.execute(
+        "CREATE INDEX IF NOT EXISTS requests_run_api_timestamp "
+        "ON requests(run_id, api, timestamp);"
+    )
+    _ = conn.execute(
+        "CREATE INDEX IF NOT EXISTS requests_team_api_credits_session "
+        "ON requests(team_id, api, count_towards_credits, session_id);"
+    )
+    _ = conn.execute(
+        "CREATE INDEX IF NOT EXISTS requests_run_topic ON requests(run_id, topic_id);"
+    )
+    _ = conn.execute("CREATE INDEX IF NOT EXISTS runs_team_id ON runs(team_id);")
+
+
+def _add_budgets(conn: sqlite3.Connection):
+    # counters of existing teams are computed from their requests on first access
+    _ = conn.execute("""
+        CREATE TABLE IF NOT EXISTS budgets(
+            team_id     VARCHAR(256) NOT NULL,
+            api         VARCHAR(10) NOT NULL,
+            sessions    INTEGER NOT NULL DEFAULT 0,
+            runs        INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (team_id, api)
+        );""")
+
+
+def _add_sessions(conn: sqlite3.Connection):
+    # active sessions were only kept in memory before
+    # sessions are identified by the API and the run, since runs of the debug API
+    # have no row in the runs table
+    _ = conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions(
+            id          CHAR(36) NOT NULL PRIMARY KEY,
+            api         VARCHAR(10) NOT NULL,
+            run_id      VARCHAR(256) NOT NULL,
+            team_id     VARCHAR(256) NOT NULL,
+            user_id     CHAR(36) NOT NULL,
+            topic_id    VARCHAR(20) NOT NULL,
+            version     INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (api, run_id)
+        );""")
+    _ = conn.execute("""
+        CREATE TABLE IF NOT EXISTS session_entries(
+            session_id  CHAR(36) NOT NULL,
+            kind        VARCHAR(16) NOT NULL,
+            position    INTEGER NOT NULL,
+            content     TEXT NOT NULL,
+            PRIMARY KEY (session_id, kind, position),
+            FOREIGN KEY(session_id) REFERENCES sessions(id)
+        ) WITHOUT ROWID;""")
+
+
+def _add_active_runs(conn: sqlite3.Connection):
+    # runs of the debug API have no row in the runs table, so the state of
+    # active runs is stored separately
+    _ = conn.execute("""
+        CREATE TABLE IF NOT EXISTS active_runs(
+            api         VARCHAR(10) NOT NULL,
+            run_id      VARCHAR(256) NOT NULL,
+            team_id     VARCHAR(256) NOT NULL,
+            description TEXT NOT NULL,
+            extra       TEXT,
+            open_topics TEXT NOT NULL,
+            PRIMARY KEY (api, run_id)
+        ) WITHOUT ROWID;""")
+
+
+def _add_active_run_versions(conn: sqlite3.Connection):
+    # workers that share the state must not overwrite each other's open topics
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(active_runs);")]
+    if "version" not in columns:
+        _ = conn.execute(
+            "ALTER TABLE active_runs ADD COLUMN version INTEGER NOT NULL DEFAULT 0;"
+        )
+
+
+# Append new migrations at the end. Never reorder or remove existing ones.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _add_team_token_digest,
+    _index_requests,
+    _add_budgets,
+    _add_sessions,
+    _add_active_runs,
+    _add_active_run_versions,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, schema: str) -> int:
+    """
+    Create a fresh database from the schema or upgrade an existing one to the
+    latest schema version.
+
+    :param conn: Connection to the shared task database.
+    :param schema: SQL script that creates the latest schema.
+    :return: Number of migrations that were applied.
+    """
+    cursor = conn.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='teams';"
+    )
+    if cursor.fetchone()[0] == 0:
+        _ = conn.executescript(schema)
+        _ = conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        conn.commit()
+        return 0
+
+    version = get_schema_version(conn)
+    for i in range(version, SCHEMA_VERSION):
+        conn.commit()
+        _ = conn.execute("BEGIN;")
+        try:
+            MIGRATIONS[i](conn)
+            _ = conn.execute(f"PRAGMA user_version = {i + 1};")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    return max(0, SCHEMA_VERSION - version)
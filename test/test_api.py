@@ -1,4 +1,7 @@
+import base64
 import json
+import threading
+import time
 import uuid
 from dataclasses import asdict
 
@@ -8,8 +11,9 @@ from starlette import status
 from starlette.testclient import TestClient
 
 from api.messages import UserUtteranceMessage, RunMetaMessage, AssistantResponseMessage
-from security.authenticator import Authenticator
+from security.authenticator import Authenticator, token_cache
 from shared_task.shared_task import SharedTaskManager
+from simulation.inference import InferenceService
 
 
 @pytest.fixture
@@ -138,7 +142,8 @@ def test_full_run(client, team_token):
     )
 
     assert response.status_code == status.HTTP_200_OK
-
+    # one entry per user utterance of both dummy topics
+    assert len(response.text.strip().split("\n")) == 4
 
 
 @pytest.mark.integration
@@ -167,4 +172,304 @@ def test_unauthorized_request(client):
         json=asdict(run_meta)
     )
 
-    assert response.status_code == status.HTTP_401_UNAUTHORIZED
\ No newline at end of file
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+@pytest.mark.integration
+def test_legacy_team_token(client):
+    authenticator = Authenticator()
+    name = "_test_legacy_team"
+    authenticator.rm_team(name)
+    token = authenticator.add_team(name)
+    with authenticator.pool.connection() as conn:
+        conn.execute("UPDATE teams SET token_digest = NULL WHERE id = ?;", (name,))
+
+    response = client.get(
+        "/auth/verify", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["team_id"] == name
+
+    with authenticator.pool.connection() as conn:
+        cursor = conn.execute("SELECT token_digest FROM teams WHERE id = ?;", (name,))
+        assert cursor.fetchone()[0] is not None
+    authenticator.rm_team(name)
+
+
+@pytest.mark.integration
+def test_invalid_token_skips_legacy_scan(client, monkeypatch):
+    authenticator = Authenticator()
+    name = "_test_legacy_team"
+    authenticator.rm_team(name)
+    authenticator.add_team(name)
+    with authenticator.pool.connection() as conn:
+        conn.execute("UPDATE teams SET token_digest = NULL WHERE id = ?;", (name,))
+
+    verified = []
+    verify = Authenticator.pwd_context.verify
+    monkeypatch.setattr(
+        Authenticator.pwd_context,
+        "verify",
+        lambda *args: verified.append(args) or verify(*args),
+    )
+    token = base64.b64encode(uuid.uuid4().hex.encode()).decode()
+    num_verified = []
+    for _ in range(2):
+        response = client.get(
+            "/auth/verify", headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+        num_verified.append(len(verified))
+
+    # only the first attempt is checked against the teams without a digest
+    assert num_verified[0] > 0 and num_verified[1] == num_verified[0]
+    authenticator.rm_team(name)
+
+
+@pytest.mark.integration
+def test_token_cache_revocation(client):
+    authenticator = Authenticator()
+    name = "_test_revoked_team"
+    authenticator.rm_team(name)
+    token = authenticator.add_team(name)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/auth/verify", headers=headers).status_code == status.HTTP_200_OK
+    hits = token_cache.hits
+    assert client.get("/auth/verify", headers=headers).status_code == status.HTTP_200_OK
+    assert token_cache.hits == hits + 1
+
+    authenticator.rm_team(name)
+    response = client.get("/auth/verify", headers=headers)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.integration
+def test_token_cache_revocation_by_other_process(client):
+    authenticator = Authenticator()
+    name = "_test_revoked_team"
+    authenticator.rm_team(name)
+    token = authenticator.add_team(name)
+    headers = {"Authorization": f"Bearer {token}"}
+    assert client.get("/auth/verify", headers=headers).status_code == status.HTTP_200_OK
+
+    # e.g., an admin script removes the team without reaching the API's cache
+    with authenticator.pool.connection() as conn:
+        conn.execute("DELETE FROM teams WHERE id = ?;", (name,))
+
+    response = client.get("/auth/verify", headers=headers)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.integration
+def test_budget_check(client, team_token):
+    headers = {"Authorization": f"Bearer {team_token}"}
+    response = client.get("/budget/check", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    remaining = response.json()["remaining"]["run"]["remaining"]
+
+    run_meta = RunMetaMessage("_test-run-budget", "This is a test run.", extra={"test": True})
+    response = client.post("/run/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+
+    response = client.get("/budget/check", headers=headers)
+    assert response.json()["remaining"]["run"]["remaining"] == remaining - 1
+
+
+@pytest.mark.integration
+def test_run_dump_all(client, team_token, admin_credentials, monkeypatch):
+    from config import CONFIG
+
+    # read every request with a query of its own
+    monkeypatch.setitem(CONFIG["storage"], "page_size", 1)
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-dump-all", "This is a test run.", extra={"test": True})
+    client.post("/run/start", headers=headers, json=asdict(run_meta))
+    assistant_response = AssistantResponseMessage(run_meta.run_id, "This is a test response!", {}, {})
+    client.post("/run/continue", headers=headers, json=asdict(assistant_response))
+
+    response = client.get(
+        "/run/dump-all", auth=admin_credentials, headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-encoding"] == "gzip"
+
+    entries = [json.loads(line) for line in response.text.splitlines()]
+    entries = [e for e in entries if e["metadata"]["run_id"] == run_meta.run_id]
+    assert [e["metadata"]["topic_id"] for e in entries] == ["dummy1_1", "dummy1_2"]
+
+
+@pytest.mark.integration
+def test_busy_simulator(client, team_token):
+    inference_service = InferenceService()
+    run_meta = RunMetaMessage("_test-run-busy", "This is a test run.", extra={"test": True})
+
+    inference_service.pending += inference_service.max_pending
+    try:
+        response = client.post(
+            "/debug/start",
+            headers={"Authorization": f"Bearer {team_token}"},
+            json=asdict(run_meta),
+        )
+    finally:
+        inference_service.pending -= inference_service.max_pending
+
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert "retry-after" in response.headers
+
+
+@pytest.mark.integration
+def test_retry_start_after_busy_simulator(client, team_token):
+    inference_service = InferenceService()
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-retry", "This is a test run.", extra={"test": True})
+    remaining = client.get("/budget/check", headers=headers).json()["remaining"]["run"]["remaining"]
+
+    inference_service.pending += inference_service.max_pending
+    try:
+        response = client.post("/run/start", headers=headers, json=asdict(run_meta))
+    finally:
+        inference_service.pending -= inference_service.max_pending
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+
+    # the rejected start neither registered the run nor used up budget
+    response = client.get("/budget/check", headers=headers)
+    assert response.json()["remaining"]["run"]["remaining"] == remaining
+
+    response = client.post("/run/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+
+
+@pytest.mark.integration
+def test_resubmit_after_simulator_timeout(client, team_token, monkeypatch):
+    from config import CONFIG
+    from simulation.user import DummyUser
+
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-timeout", "This is a test run.", extra={"test": True})
+    response = client.post("/debug/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+
+    release = threading.Event()
+    seen = []
+    respond = DummyUser.respond
+
+    def slow_respond(self, session):
+        release.wait()
+        seen.append(len(session.history))
+        return respond(self, session)
+
+    monkeypatch.setattr(DummyUser, "respond", slow_respond)
+    monkeypatch.setitem(CONFIG["simulation"]["inference"], "timeout", 0.1)
+    assistant_response = AssistantResponseMessage(run_meta.run_id, "This is a test response!", {}, {})
+    response = client.post("/debug/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+
+    # the timed out call still runs on the session
+    response = client.post("/debug/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert "retry-after" in response.headers
+
+    release.set()
+    while len(InferenceService().running) > 0:
+        time.sleep(0.01)
+    # the reverted response did not change the snapshot of the timed out call
+    assert seen == [2]
+
+    response = client.post("/debug/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.json()["history"]) == 3
+
+
+@pytest.mark.integration
+def test_readiness(client):
+    from shared_task.warm_up import WarmUp
+
+    warm_up = WarmUp()
+    warm_up.start(SharedTaskManager().active_task, background=False)
+
+    response = client.get("/health/ready")
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert data["ready"]
+    assert data["stage"] == "ready"
+    assert data["progress"]["done"] == data["progress"]["total"]
+
+
+@pytest.mark.integration
+def test_session_recovery(client, team_token):
+    from shared_task.participant_run import RunManager
+    from shared_task.sessions import SessionManager
+    from shared_task.state import get_state_backend
+
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-recovery", "This is a test run.", extra={"test": True})
+    response = client.post("/run/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+    topic_id = response.json()["topic_id"]
+
+    # simulate a restart that loses the active runs and sessions
+    RunManager().runs.clear()
+    SessionManager().sessions.clear()
+    get_state_backend.cache_clear()
+
+    assistant_response = AssistantResponseMessage(
+        run_meta.run_id, "This is a test response!", {"docA": 0.9}, {"test": True}
+    )
+    response = client.post("/run/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert data["topic_id"] == topic_id
+    assert [m["role"] for m in data["history"]] == ["user", "assistant", "user"]
+
+
+@pytest.mark.integration
+def test_prefetched_opening(client, team_token):
+    from shared_task.participant_run import RunManager
+
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-prefetch", "This is a test run.", extra={"test": True})
+    response = client.post("/debug/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+
+    assistant_response = AssistantResponseMessage(
+        run_meta.run_id, "This is a test response!", {"docA": 0.9}, {"test": True}
+    )
+    response = client.post("/debug/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["last_response_of_session"]
+
+    # the first utterance on the next topic is generated after the session ended
+    run = RunManager(debug=True).get_active_run(run_meta.run_id)
+    prefetch = run.prefetch
+    assert prefetch is not None
+    prefetch.future.result(timeout=10)
+
+    response = client.post("/debug/continue", headers=headers, json=asdict(assistant_response))
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert (data["topic_id"], data["user_id"]) == (prefetch.topic_id, prefetch.user_id)
+    assert data["utterance"] == prefetch.future.result().content
+    assert run.prefetch is None
+
+
+@pytest.mark.integration
+def test_metrics(client, team_token):
+    headers = {"Authorization": f"Bearer {team_token}"}
+    run_meta = RunMetaMessage("_test-run-metrics", "This is a test run.", extra={"test": True})
+    response = client.post("/debug/start", headers=headers, json=asdict(run_meta))
+    assert response.status_code == status.HTTP_200_OK
+
+    response = client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    text = response.text
+    assert 'sim_api_request_seconds_count{api="debug",endpoint="/debug/start",status="200"}' in text
+    for stage in ["authenticate", "check_request", "inference_queue", "initiate"]:
+        assert f'sim_api_stage_seconds_count{{stage="{stage}",api="debug"' in text
+    assert "# TYPE sim_api_cache_hits counter" in text
+    assert 'sim_api_cache_hits_total{cache="token"}' in text
+    assert "sim_api_inference_pending 0.0" in text
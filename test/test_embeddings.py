@@ -0,0 +1,44 @@
+import numpy as np
+
+from simulation.embeddings import EmbeddingCache, FakeSentenceEncoder
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, show_progress_bar=False):
+        self.encoded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+def test_embeddings_are_encoded_once():
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(encoder, "encoder")
+    cache.precompute(["a", "bb", "a"])
+
+    assert encoder.encoded == ["a", "bb"]
+    assert cache.get("bb").tolist() == [2.0, 1.0]
+    assert cache.get("ccc").tolist() == [3.0, 1.0]
+    assert encoder.encoded == ["a", "bb", "ccc"]
+
+
+def test_embeddings_are_persisted(tmp_path):
+    cache = EmbeddingCache(CountingEncoder(), "org/encoder", str(tmp_path))
+    cache.precompute(["a", "bb"])
+
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(encoder, "org/encoder", str(tmp_path))
+    cache.precompute(["a", "bb"])
+
+    assert encoder.encoded == []
+    assert cache.get("a").tolist() == [1.0, 1.0]
+
+
+def test_fake_sentence_encoder():
+    encoder = FakeSentenceEncoder()
+    encodings = encoder.encode(["renewable energy", "energy renewable", "pizza"])
+    similarities = encoder.similarity(encodings[:1], encodings)
+
+    assert similarities[0][1] > 0.99
+    assert similarities[0][2] < similarities[0][1]
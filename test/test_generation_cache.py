@@ -0,0 +1,135 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from simulation.generation_cache import CachedLLM, GenerationCache
+from simulation.llm import LLM
+
+
+class CountingModel(LLM):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def __str__(self) -> str:
+        return "counting"
+
+    def generate(
+        self,
+        messages: List[Dict[str, str]],
+        session_id: Optional[str] = None,
+        **kwargs,
+    ) -> List[str]:
+        self.calls += 1
+        return [f"{messages[-1]['content']} {i}" for i in range(kwargs.get("n", 1))]
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        self.calls += 1
+        return [
+            f"{m[-1]['content']} {i}"
+            for m in messages
+            for i in range(kwargs.get("n", 1))
+        ]
+
+    def score_choices(
+        self, messages: List[Dict[str, str]], choices: List[str]
+    ) -> List[float]:
+        self.calls += 1
+        return [1.0] + [0.0] * (len(choices) - 1)
+
+
+def conversation(content: str) -> List[Dict[str, str]]:
+    return [{"role": "user", "content": content, "name": "ignored"}]
+
+
+def test_caches_deterministic_calls():
+    model = CountingModel()
+    llm = CachedLLM(model, GenerationCache(max_size=8))
+
+    for session_id in ["first", "second"]:
+        assert llm.generate(conversation("a"), session_id, n=2, do_sample=False) == [
+            "a 0",
+            "a 1",
+        ]
+        assert llm.score_choices(conversation("a"), ["1", "2"]) == [1.0, 0.0]
+    assert model.calls == 2
+
+    # other arguments and sampled generations are computed
+    llm.generate(conversation("a"), n=1, do_sample=False)
+    llm.generate(conversation("a"), n=2, do_sample=True)
+    llm.generate(conversation("a"), n=2, do_sample=True)
+    assert model.calls == 5
+
+    stats = llm.cache.stats()
+    assert stats["memory_hits"] == 2 and stats["misses"] == 3
+
+
+def test_batches_only_missing_conversations():
+    model = CountingModel()
+    llm = CachedLLM(model, GenerationCache(max_size=8))
+
+    llm.generate(conversation("b"), do_sample=False)
+    outputs = llm.batch_generate(
+        [conversation("a"), conversation("b"), conversation("c")], do_sample=False
+    )
+
+    assert outputs == ["a 0", "b 0", "c 0"]
+    assert model.calls == 2
+
+
+def test_computes_concurrent_misses_once():
+    model = CountingModel()
+    llm = CachedLLM(model, GenerationCache(max_size=8))
+    release = threading.Event()
+    generate = model.generate
+
+    def blocking_generate(*args, **kwargs):
+        release.wait()
+        return generate(*args, **kwargs)
+
+    model.generate = blocking_generate
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(llm.generate, conversation("a"), do_sample=False)
+            for _ in range(4)
+        ]
+        time.sleep(0.2)
+        release.set()
+        outputs = [future.result() for future in futures]
+
+    assert outputs == [["a 0"]] * 4
+    assert model.calls == 1
+
+
+def test_generations_are_persisted(tmp_path):
+    db_path = str(tmp_path / "generations.db")
+    model = CountingModel()
+    CachedLLM(model, GenerationCache(8, db_path)).generate(
+        conversation("a"), do_sample=False
+    )
+
+    llm = CachedLLM(model, GenerationCache(8, db_path))
+    assert llm.generate(conversation("a"), do_sample=False) == ["a 0"]
+    assert model.calls == 1 and llm.cache.stats()["disk_hits"] == 1
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = GenerationCache(0, str(tmp_path / "generations.db"), max_rows=2)
+    for key in ["a", "b", "c"]:
+        cache.put(key, "model", [key])
+
+    assert cache.get("a") is None
+    assert cache.get("b") == ["b"] and cache.get("c") == ["c"]
+
+
+def test_memory_tier_is_bounded():
+    cache = GenerationCache(max_size=2)
+    for key in ["a", "b", "c"]:
+        cache.put(key, "model", [key])
+
+    assert cache.get("a") is None
+    assert cache.get("c") == ["c"]
+    assert cache.stats()["size"] == 2
@@ -0,0 +1,261 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+
+import pytest
+import torch
+
+from simulation.llm import (
+    LLM,
+    BatchedLLM,
+    FakeLLM,
+    PrefixCache,
+    SharedPrefixCache,
+    create_llm,
+    to_sampling_kwargs,
+)
+
+
+class EchoModel(LLM):
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+        self.session_ids = []
+
+    def generate(self, messages: List[Dict[str, str]], **kwargs) -> List[str]:
+        self.batch_sizes.append(1)
+        return [messages[-1]["content"]] * kwargs.get("n", 1)
+
+    def batch_generate(
+        self, messages: List[List[Dict[str, str]]], **kwargs
+    ) -> List[str]:
+        self.batch_sizes.append(len(messages))
+        return [m[-1]["content"] for m in messages for _ in range(kwargs.get("n", 1))]
+
+    def batch_generate_sessions(
+        self,
+        messages: List[List[Dict[str, str]]],
+        session_ids: List[str],
+        **kwargs,
+    ) -> List[str]:
+        self.session_ids.extend(session_ids)
+        return self.batch_generate(messages, **kwargs)
+
+
+def test_batched_generation():
+    model = EchoModel()
+    llm = BatchedLLM(model, max_batch_size=4, max_wait=0.5)
+
+    def generate(i):
+        return llm.generate([{"role": "user", "content": str(i)}], f"session-{i}", n=2)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(generate, range(4)))
+
+    assert outputs == [[str(i), str(i)] for i in range(4)]
+    assert model.batch_sizes == [4]
+    # the sessions are passed on to reuse their cached prompts
+    assert sorted(model.session_ids) == [f"session-{i}" for i in range(4)]
+
+
+def test_batches_group_generation_arguments():
+    model = EchoModel()
+    llm = BatchedLLM(model, max_batch_size=4, max_wait=0.2)
+
+    def generate(i):
+        return llm.generate([{"role": "user", "content": str(i)}], n=1 + i % 2)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(generate, range(4)))
+
+    assert outputs == [[str(i)] * (1 + i % 2) for i in range(4)]
+    assert sorted(model.batch_sizes) == [2, 2]
+
+
+def tiny_model():
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    model_config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    return LlamaForCausalLM(model_config).eval()
+
+
+def test_prefix_cache_reuses_session_prompt():
+    model = tiny_model()
+    cache = PrefixCache(max_memory=1024 * 1024)
+    gen_kwargs = {"max_new_tokens": 5, "do_sample": False, "pad_token_id": 0}
+
+    first_turn = torch.tensor([[1, 5, 7, 9, 11, 13]])
+    second_turn = torch.tensor([[1, 5, 7, 9, 12, 14, 16, 18]])
+    for input_ids in [first_turn, second_turn]:
+        expected = model.generate(input_ids, **gen_kwargs)
+        past_key_values = cache.prepare(model, "session", input_ids)
+        actual = model.generate(
+            input_ids, past_key_values=past_key_values, **gen_kwargs
+        )
+        assert torch.equal(actual, expected)
+
+    assert cache.misses == 1 and cache.hits == 1
+    cache.evict("session")
+    assert len(cache) == 0 and cache.memory == 0
+
+
+def test_prefix_cache_beam_search():
+    model = tiny_model()
+    cache = PrefixCache(max_memory=1024 * 1024)
+    gen_kwargs = {
+        "max_new_tokens": 5,
+        "do_sample": False,
+        "num_beams": 4,
+        "num_return_sequences": 2,
+        "pad_token_id": 0,
+    }
+
+    input_ids = torch.tensor([[1, 5, 7, 9, 11, 13]])
+    expected = model.generate(input_ids, **gen_kwargs)
+    past_key_values = cache.prepare(model, "session", input_ids, num_beams=4)
+    actual = model.generate(input_ids, past_key_values=past_key_values, **gen_kwargs)
+    assert torch.equal(actual, expected)
+
+
+def test_prefix_cache_memory_budget():
+    model = tiny_model()
+    cache = PrefixCache(max_memory=1024 * 1024)
+    cache.prepare(model, "first", torch.tensor([[1, 2, 3, 4]]))
+    cache.max_memory = cache.memory
+    cache.prepare(model, "second", torch.tensor([[1, 2, 3, 4]]))
+
+    assert len(cache) == 1
+    assert cache.memory <= cache.max_memory
+
+
+def test_shared_prefix_cache_between_sessions():
+    model = tiny_model()
+    shared = SharedPrefixCache(max_memory=1024 * 1024)
+    cache = PrefixCache(max_memory=1024 * 1024, shared=shared)
+    gen_kwargs = {"max_new_tokens": 5, "do_sample": False, "pad_token_id": 0}
+
+    prompts = {
+        "first": torch.tensor([[1, 5, 7, 9, 11, 13]]),
+        "second": torch.tensor([[1, 5, 7, 9, 12, 14, 16]]),
+        # diverges inside the shared prefix of the other sessions
+        "third": torch.tensor([[1, 5, 8, 10, 12, 14]]),
+    }
+    for session_id, input_ids in prompts.items():
+        expected = model.generate(input_ids, **gen_kwargs)
+        past_key_values = cache.prepare(model, session_id, input_ids, shared_length=4)
+        actual = model.generate(
+            input_ids, past_key_values=past_key_values, **gen_kwargs
+        )
+        assert torch.equal(actual, expected)
+
+    assert shared.misses == 1 and shared.hits == 2
+    # [1, 5] is split from [7, 9] and [8, 10]
+    assert len(shared) == 3
+    assert shared.match(torch.tensor([1, 5, 8, 10, 3]))[0] == 4
+
+
+def test_prefix_cache_batch():
+    model = tiny_model()
+    shared = SharedPrefixCache(max_memory=1024 * 1024)
+    cache = PrefixCache(max_memory=1024 * 1024, shared=shared)
+    gen_kwargs = {
+        "max_new_tokens": 5,
+        "do_sample": False,
+        "num_beams": 4,
+        "num_return_sequences": 2,
+        "pad_token_id": 0,
+    }
+
+    prompts = [
+        torch.tensor([[1, 5, 7, 9, 11, 13]]),
+        torch.tensor([[1, 5, 7, 9, 12, 14, 16, 18]]),
+        torch.tensor([[1, 5, 8]]),
+    ]
+    expected = [
+        model.generate(input_ids, **gen_kwargs)[:, input_ids.shape[1] :]
+        for input_ids in prompts
+    ]
+    # the second round reuses the prompts of the first
+    for _ in range(2):
+        input_ids, attention_mask, past_key_values = cache.prepare_batch(
+            model, ["first", "second", None], prompts, 0, 4, [4, 4, 0]
+        )
+        actual = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            **gen_kwargs,
+        )[:, input_ids.shape[1] :]
+        assert all(torch.equal(a, e) for a, e in zip(actual.split(2), expected))
+
+    assert cache.hits == 2 and shared.hits == 1
+
+
+def test_shared_prefix_cache_memory_budget():
+    model = tiny_model()
+    shared = SharedPrefixCache(max_memory=1024 * 1024)
+    cache = PrefixCache(max_memory=0, shared=shared)
+    cache.prepare(model, None, torch.tensor([[1, 2, 3, 4, 5]]), shared_length=4)
+    shared.max_memory = shared.memory
+    cache.prepare(model, None, torch.tensor([[6, 7, 8, 9, 10]]), shared_length=4)
+
+    assert len(shared) == 1 and len(cache) == 0
+    assert shared.memory <= shared.max_memory
+    assert shared.match(torch.tensor([6, 7, 8, 9]))[0] == 4
+
+
+def test_sampling_kwargs():
+    sampling = to_sampling_kwargs(
+        {
+            "max_new_tokens": 64,
+            "num_return_sequences": 5,
+            "num_beams": 10,
+            "num_beam_groups": 5,
+            "diversity_penalty": 8.0,
+            "do_sample": False,
+            "top_k": None,
+        }
+    )
+    assert sampling == {"n": 5, "max_tokens": 64, "num_beams": 10, "temperature": 0.0}
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_llm({"backend": "unknown"})
+
+
+def test_fake_model_is_deterministic():
+    model = FakeLLM(prefill_ms=0, decode_ms=0)
+    messages = [{"role": "user", "content": "How can I help you?"}]
+
+    outputs = model.generate(messages, num_return_sequences=3, max_new_tokens=8)
+    assert len(outputs) == 3 and len(set(outputs)) == 3
+    assert outputs == model.generate(messages, num_return_sequences=3, max_new_tokens=8)
+    assert model.batch_generate([messages, messages], num_return_sequences=3) == [
+        *model.generate(messages, num_return_sequences=3),
+        *model.generate(messages, num_return_sequences=3),
+    ]
+
+    scores = model.score_choices(messages, ["0", "1", "2", "3", "4", "5"])
+    assert sorted(scores) == [0.0] * 5 + [1.0]
+
+
+def test_fake_model_counts_cached_prefix():
+    model = FakeLLM()
+    messages = [{"role": "user", "content": "one two three"}]
+
+    assert model._prefill(messages, "session") == 4
+    messages.append({"role": "assistant", "content": "four"})
+    assert model._prefill(messages, "session") == 2
+    model.release_session("session")
+    # the opening message is still cached for all sessions
+    assert model._prefill(messages, "session") == 2
+    other = [messages[0], {"role": "assistant", "content": "five six"}]
+    assert model._prefill(other, "other") == 3
@@ -0,0 +1,55 @@
+import pytest
+
+import metrics
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram(
+        "_test_seconds", "Test.", ["stage"], buckets=[0.1, 1.0]
+    )
+    metrics.REGISTRY.remove(histogram)
+
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5.0, stage="a")
+
+    assert histogram.render().split("\n") == [
+        "# HELP _test_seconds Test.",
+        "# TYPE _test_seconds histogram",
+        '_test_seconds_bucket{stage="a",le="0.1"} 1.0',
+        '_test_seconds_bucket{stage="a",le="1.0"} 2.0',
+        '_test_seconds_bucket{stage="a",le="+Inf"} 3.0',
+        '_test_seconds_sum{stage="a"} 5.55',
+        '_test_seconds_count{stage="a"} 3.0',
+    ]
+
+
+def test_labels():
+    counter = metrics.Counter("_test_tokens", "Test.", ["model"])
+    metrics.REGISTRY.remove(counter)
+    counter.inc(3, model='a "quoted" name')
+    assert counter.render().endswith(
+        '_test_tokens_total{model="a \\"quoted\\" name"} 3.0'
+    )
+
+    with pytest.raises(ValueError):
+        counter.inc(model="a", stage="b")
+
+    # totals of other components replace the value
+    counter.set_total(5, model="b")
+    counter.set_total(7, model="b")
+    assert counter.render().endswith('_test_tokens_total{model="b"} 7.0')
+
+    with pytest.raises(TypeError):
+        metrics.Metric("_test_untyped", "Test.")
+
+    token = metrics.API.set("run")
+    try:
+        with metrics.stage("_test_stage", simulator="Simulator"):
+            pass
+    finally:
+        metrics.API.reset(token)
+    assert (
+        'sim_api_stage_seconds_count{stage="_test_stage",api="run",simulator="Simulator"} 1.0'
+        in metrics.render()
+    )
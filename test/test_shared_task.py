@@ -0,0 +1,98 @@
+import pytest
+
+from api.messages import AssistantResponseMessage
+from shared_task.sessions import Session
+from shared_task.shared_task import SharedTask, TREC_iKAT25
+from shared_task.topic import Topic
+from simulation.llm import FakeLLM
+from simulation.user import (
+    Persona,
+    UnrestrictedUserSimulator,
+    UserUtterance,
+    _conversation,
+)
+
+
+def test_persona_is_immutable():
+    topics = {"1-1": Topic("1-1", "Renewable Energy")}
+    persona = Persona.create(
+        "Persona_1_1",
+        topics,
+        {"1-1": ["What is solar power?"]},
+        ["I live in Berlin.", "I rent a flat."],
+        "Interested in {topic}.\n- {property_list}",
+    )
+
+    assert persona.system_prompts["1-1"] == (
+        "Interested in renewable energy.\n- I live in Berlin.\n- I rent a flat."
+    )
+    assert persona.rubrics["1-1"] == ("What is solar power?",)
+    with pytest.raises(AttributeError):
+        persona.ptkb = ()
+    with pytest.raises(TypeError):
+        persona.rubrics["1-1"] = ()
+
+
+def test_trec_ikat25_shares_users_between_pools():
+    task = TREC_iKAT25()
+    task.initialize()
+
+    assert len(task.users_by_id) > 0
+    for topic_id, users in task.users_per_topic.items():
+        assert task.debug_users_per_topic[topic_id] == users
+        for user in users:
+            assert isinstance(user, UnrestrictedUserSimulator)
+            assert task.users_by_id[user.id] is user
+            assert topic_id in user.persona.system_prompts
+
+
+def test_simulator_history_swaps_roles():
+    session = Session("team", "user", "1-1")
+    SharedTask.update_session(session, utterance=UserUtterance("Hi", False))
+    SharedTask.update_session(
+        session, response=AssistantResponseMessage("run", "Hello", {"doc": 1.0})
+    )
+
+    assert session.simulator_history == [
+        {"role": "assistant", "content": "Hi"},
+        {"role": "user", "content": "Hello"},
+    ]
+
+    messages = _conversation("System", session.simulator_history, " Farewell.")
+    assert [m["role"] for m in messages] == [
+        "system",
+        "user",
+        "assistant",
+        "user",
+    ]
+    assert messages[-1]["content"] == "Hello Farewell."
+    assert session.simulator_history[-1]["content"] == "Hello"
+
+    SharedTask.revert_response(session)
+    assert session.simulator_history == [{"role": "assistant", "content": "Hi"}]
+
+
+def test_precomputed_openings(monkeypatch):
+    llm = FakeLLM(prefill_ms=0.0, decode_ms=0.0)
+    monkeypatch.setattr(UnrestrictedUserSimulator, "llm", llm)
+    task = TREC_iKAT25()
+    task.initialize()
+
+    progress = []
+    task.precompute_openings(4, lambda done, total: progress.append((done, total)))
+    total = sum(len(user.opening_prompts()) for user in task.users_by_id.values())
+    assert total > 0 and progress[-1] == (total, total)
+    assert len(progress) == (total + 3) // 4
+
+    user = next(iter(task.users_by_id.values()))
+    topic_id = next(iter(user.persona.system_prompts))
+    session = Session("team", user.id, topic_id)
+    opening = user.initiate(session)
+    expected = llm.generate(
+        _conversation(user.persona.system_prompts[topic_id], []), **user.gen_kwargs
+    )[0]
+    assert opening.content == expected
+
+    # only new sessions start with the precomputed utterance
+    SharedTask.update_session(session, utterance=opening)
+    assert user.precomputed_opening(session) is None
@@ -0,0 +1,281 @@
+import sqlite3
+
+import pytest
+
+from api.messages import AssistantResponseMessage, RunMetaMessage
+from config import CONFIG
+from security.request_tracker import RequestTracker, UnwrittenRequestsError
+from shared_task.participant_run import ParticipantRun
+from shared_task.sessions import Session
+from shared_task.shared_task import SharedTask, SharedTaskManager
+from shared_task.state import SqliteStateBackend, StateConflictError
+from simulation.user import UserUtterance
+from storage.database import ConnectionPool, PoolTimeoutError
+from storage.migrations import SCHEMA_VERSION, get_schema_version, migrate
+
+LEGACY_SCHEMA = """
+CREATE TABLE teams(
+    id    VARCHAR(256) NOT NULL PRIMARY KEY,
+    token   CHAR(32) NOT NULL UNIQUE
+);
+CREATE TABLE admins(
+    name        VARCHAR(256) NOT NULL PRIMARY KEY,
+    password    CHAR(32) NOT NULL
+);
+CREATE TABLE runs(
+    id          VARCHAR(256) NOT NULL PRIMARY KEY,
+    team_id     VARCHAR(256) NOT NULL,
+    description TEXT NOT NULL,
+    extra       TEXT
+);
+CREATE TABLE requests(
+    timestamp       DATETIME NOT NULL PRIMARY KEY,
+    run_id          VARCHAR(256) NOT NULL,
+    team_id         VARCHAR(256) NOT NULL,
+    session_id      CHAR(36) NOT NULL,
+    topic_id        VARCHAR(20) NOT NULL,
+    user_id         CHAR(36) NOT NULL,
+    api             VARCHAR(10) NOT NULL,
+    user_utterance  TEXT NOT NULL,
+    user_meta       TEXT,
+    assistant_response        TEXT,
+    assistant_meta  TEXT,
+    assistant_citations       TEXT,
+    count_towards_credits BOOLEAN DEFAULT true
+);
+"""
+
+
+def read_schema():
+    with open("data/db-schema.sql", "r", encoding="utf-8") as in_file:
+        return in_file.read()
+
+
+def test_migrate_fresh_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / "fresh.db")
+    migrate(conn, read_schema())
+
+    assert get_schema_version(conn) == SCHEMA_VERSION
+    assert migrate(conn, read_schema()) == 0
+
+
+def test_migrate_legacy_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / "legacy.db")
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute("INSERT INTO teams VALUES ('team', 'hash');")
+    for i in range(3):
+        conn.execute(
+            "INSERT INTO requests(timestamp, run_id, team_id, session_id, topic_id, "
+            "user_id, api, user_utterance) VALUES (?, 'run', 'team', 's', 't', 'u', "
+            "'run', ?);",
+            (f"2025-01-0{i + 1}", f"utterance {i}"),
+        )
+    conn.commit()
+
+    assert migrate(conn, read_schema()) == SCHEMA_VERSION
+    assert get_schema_version(conn) == SCHEMA_VERSION
+
+    team_columns = [row[1] for row in conn.execute("PRAGMA table_info(teams);")]
+    assert "token_digest" in team_columns
+
+    rows = conn.execute("SELECT id, user_utterance FROM requests ORDER BY id;")
+    assert rows.fetchall() == [
+        (1, "utterance 0"),
+        (2, "utterance 1"),
+        (3, "utterance 2"),
+    ]
+
+    session_columns = [row[1] for row in conn.execute("PRAGMA table_info(sessions);")]
+    assert session_columns[:2] == ["id", "api"] and "version" in session_columns
+
+    indexes = [row[1] for row in conn.execute("PRAGMA index_list(requests);")]
+    assert "requests_run_api_timestamp" in indexes
+    assert "requests_team_api_credits_session" in indexes
+    assert "requests_run_topic" in indexes
+
+
+@pytest.fixture
+def state_pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "state.db"))
+    with pool.connection() as conn:
+        migrate(conn, read_schema())
+    yield pool
+    pool.close()
+
+
+def test_pool_timeout(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG["storage"], "pool_size", 1)
+    monkeypatch.setitem(CONFIG["storage"], "acquire_timeout", 50)
+    pool = ConnectionPool(str(tmp_path / "pool.db"))
+
+    # a second connection of the same thread would wait forever
+    with pool.connection():
+        with pytest.raises(PoolTimeoutError):
+            with pool.connection():
+                pass
+
+    with pool.connection() as conn:
+        assert conn.execute("SELECT 1;").fetchone() == (1,)
+    assert pool.stats()["acquire_timeouts"] == 1
+    pool.close()
+
+
+def test_state_sessions(state_pool):
+    state = SqliteStateBackend(pool=state_pool)
+    session = Session("team", "user", "topic")
+    SharedTask.update_session(session, utterance=UserUtterance("Hi", False, {"a": 1}))
+    state.add_session("run", "run-1", session)
+
+    response = AssistantResponseMessage("run-1", "Hello", meta={"b": 2})
+    SharedTask.update_session(session, response=response)
+    state.save_session(session)
+    SharedTask.revert_response(session)
+    state.save_session(session)
+    # a new backend, e.g., after a restart
+    assert SqliteStateBackend(pool=state_pool).get_session("run", "run-1") == session
+    assert SqliteStateBackend(pool=state_pool).get_session("debug", "run-1") is None
+
+    SharedTask.update_session(session, response=response)
+    SharedTask.update_session(session, utterance=UserUtterance("Bye", False))
+    state.save_session(session)
+    recovered = SqliteStateBackend(pool=state_pool).get_session("run", "run-1")
+    assert recovered == session
+    assert recovered.simulator_history[-1] == {"role": "assistant", "content": "Bye"}
+
+    state.remove_session(session)
+    assert SqliteStateBackend(pool=state_pool).get_session("run", "run-1") is None
+
+
+def test_state_conflict(state_pool):
+    state = SqliteStateBackend(pool=state_pool)
+    state.add_session("run", "run-1", Session("team", "user", "topic"))
+
+    # two workers load the session at the same time
+    worker_a = SqliteStateBackend(shared=True, pool=state_pool)
+    worker_b = SqliteStateBackend(shared=True, pool=state_pool)
+    session_a = worker_a.get_session("run", "run-1")
+    session_b = worker_b.get_session("run", "run-1")
+
+    SharedTask.update_session(session_a, utterance=UserUtterance("A", False))
+    worker_a.save_session(session_a)
+    SharedTask.update_session(session_b, utterance=UserUtterance("B", False))
+    with pytest.raises(StateConflictError):
+        worker_b.save_session(session_b)
+
+    assert worker_b.get_session("run", "run-1").history == session_a.history
+
+
+def test_state_runs(state_pool):
+    task_manager = SharedTaskManager()
+    task_manager.set_active_task("dummy")
+    task_manager.active_task.initialize()
+
+    state = SqliteStateBackend(pool=state_pool)
+    run = ParticipantRun(RunMetaMessage("run-1", "Test run.", {"test": True}, "team"))
+    state.put_run("debug", run)
+    run.next_topic()
+    state.put_run("debug", run)
+
+    recovered = state.get_run("debug", "run-1")
+    assert recovered.run_meta == run.run_meta
+    assert list(recovered._open_topics) == list(run._open_topics)
+    assert state.get_run("run", "run-1") is None
+
+
+def test_state_run_conflict(state_pool):
+    task_manager = SharedTaskManager()
+    task_manager.set_active_task("dummy")
+    task_manager.active_task.initialize()
+
+    worker_a = SqliteStateBackend(shared=True, pool=state_pool)
+    worker_b = SqliteStateBackend(shared=True, pool=state_pool)
+    run_meta = RunMetaMessage("run-1", "Test run.", {"test": True}, "team")
+
+    # concurrent starts of the same run
+    worker_a.put_run("run", ParticipantRun(run_meta))
+    with pytest.raises(StateConflictError):
+        worker_b.put_run("run", ParticipantRun(run_meta))
+
+    # concurrent sessions on the next topic of the run
+    run_a = worker_a.get_run("run", "run-1")
+    run_b = worker_b.get_run("run", "run-1")
+    topic_a = run_a.next_topic()
+    run_b.next_topic()
+    worker_a.add_session("run", "run-1", Session("team", "user", topic_a.id))
+    with pytest.raises(StateConflictError):
+        worker_b.add_session("run", "run-1", Session("team", "user", topic_a.id))
+
+    worker_a.put_run("run", run_a)
+    with pytest.raises(StateConflictError):
+        worker_b.put_run("run", run_b)
+    assert list(worker_b.get_run("run", "run-1")._open_topics) == list(
+        run_a._open_topics
+    )
+
+
+def test_request_tracker_restarts_after_close(state_pool, monkeypatch):
+    tracker = RequestTracker()
+    tracker.close()
+    monkeypatch.setattr(tracker, "pool", state_pool)
+
+    for i in range(2):
+        tracker.register_request(
+            "run", "team", "s", "t", "u", "run", f"utterance {i}", None, {}, {}, {}
+        )
+        tracker.flush()
+        with state_pool.connection() as conn:
+            cursor = conn.execute("SELECT COUNT(*) FROM requests;")
+            assert cursor.fetchone()[0] == i + 1
+        tracker.close()
+
+    # closed trackers return right away
+    tracker.flush()
+
+
+class FlakyPool:
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.failing = True
+
+    def connection(self):
+        if self.failing:
+            raise sqlite3.OperationalError("database is locked")
+        return self.pool.connection()
+
+
+def test_request_tracker_retries_failed_writes(state_pool, monkeypatch):
+    tracker = RequestTracker()
+    tracker.close()
+    pool = FlakyPool(state_pool)
+    monkeypatch.setattr(tracker, "pool", pool)
+    monkeypatch.setitem(CONFIG["storage"]["write_behind"], "min_retry_delay", 10)
+
+    tracker.register_request(
+        "run", "team", "s", "t", "u", "run", "utterance", None, {}, {}, {}
+    )
+    with pytest.raises(UnwrittenRequestsError):
+        tracker.flush()
+    assert tracker.queue_size() == 1
+
+    # the row is kept and written once the database is available again
+    pool.failing = False
+    tracker.flush()
+    with state_pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM requests;").fetchone()[0] == 1
+    assert tracker.queue_size() == 0
+    tracker.close()
+
+
+def test_request_tracker_writes_synchronously_with_workers(state_pool, monkeypatch):
+    tracker = RequestTracker()
+    tracker.close()
+    monkeypatch.setattr(tracker, "pool", state_pool)
+    monkeypatch.setattr(tracker, "synchronous", True)
+
+    tracker.register_request(
+        "run", "team", "s", "t", "u", "run", "utterance", None, {}, {}, {}
+    )
+    # visible to other workers without a flush
+    with state_pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM requests;").fetchone()[0] == 1
+    assert tracker.queue_size() == 0